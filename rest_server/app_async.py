@@ -0,0 +1,283 @@
+import contextlib
+import os
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from db import DB_CONFIG, POOL_MAX_SIZE
+from emails_query import (
+    EXPORT_BATCH, EXPORT_FORMATS, PageQuery, bulk_delete_ids, bulk_insert_rows,
+    bulk_notify_payload, bulk_update_rows, format_export_batch, is_page_request,
+    parse_bulk_body, parse_fields
+)
+from listener import (
+    SSE_COALESCE_MS, SSE_KEEPALIVE, SSE_LOG_SIZE, SSE_MAX_PENDING, Resync, register_client_gauge
+)
+from listener_async import AsyncNotifyListener
+from metrics import REGISTRY
+
+# =====================
+# emails API / SSE の asyncio (ASGI) 版
+# =====================
+# emails.py と同じエンドポイント・イベント形式を asyncpg + Starlette で提供する。
+# SSE 接続はスレッドを占有せず、1 本あたりコルーチン 1 つで済む。
+#
+#   cd rest_server
+#   uvicorn app_async:app --host localhost --port 5001
+
+# asyncpg のプールには接続の寿命 (db.py の DB_POOL_MAX_AGE) が無く、遊んでいた時間で閉じる。
+# 同じ変数を別の意味で読まないよう、こちらは別の設定にする
+POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))      # 秒: これ以上遊んでいた接続は閉じる
+
+DSN = {
+    "database": DB_CONFIG["dbname"],
+    "user": DB_CONFIG["user"],
+    "password": DB_CONFIG["password"],
+    "host": DB_CONFIG["host"],
+    "port": int(DB_CONFIG["port"]),
+}
+
+pool = None
+
+
+async def connect():
+    return await asyncpg.connect(**DSN)
+
+async def fetch_emails():
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM emails ORDER BY id;")
+    return [dict(r) for r in rows]
+
+async def fetch_email(id):
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM emails WHERE id=$1;", id)
+    return dict(row) if row is not None else None
+
+listener = AsyncNotifyListener(
+    "emails_channel", connect, fetch_emails,
+    fetch_row=fetch_email,
+    max_pending=SSE_MAX_PENDING,
+    log_size=SSE_LOG_SIZE,
+    coalesce_ms=SSE_COALESCE_MS
+)
+register_client_gauge(listener)
+
+
+# SSE用ジェネレーター（emails.event_stream の asyncio 版）
+async def event_stream(delta=False, last_event_id=None):
+    sub = listener.subscribe(delta=delta)
+    last_seq = listener.parse_event_id(last_event_id)
+    try:
+        if delta:
+            missed = None
+            if last_seq is not None:
+                missed = listener.replay(last_seq, sub.start_seq)
+            if missed is None:
+                yield await listener.snapshot_event("snapshot", sub.start_seq)
+            else:
+                for message in missed:
+                    yield message
+        elif last_event_id is not None and last_seq != sub.start_seq:
+            yield await listener.full_event()
+
+        while True:
+            message = await sub.get(timeout=SSE_KEEPALIVE)
+            if message is None:
+                if sub.closed:
+                    return
+                # 切断検知用のコメント行
+                yield ": keepalive\n\n"
+                continue
+            if isinstance(message, Resync):
+                yield await listener.snapshot_event("resync", message.seq)
+                continue
+            yield message
+    finally:
+        listener.unsubscribe(sub)
+
+
+async def fetch_email_page(page):
+    query, params = page.sql(placeholder="$")
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(query, *params)
+    return page.response(dict(r) for r in rows)
+
+
+async def get_emails(request):
+    if not is_page_request(request.query_params):
+        return JSONResponse(await fetch_emails())
+    try:
+        page = PageQuery.from_args(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(await fetch_email_page(page))
+
+# 一括更新: 1 トランザクションで COPY / unnest / ANY() を使って書き込み、通知は 1 回だけ
+async def bulk_write(action, rows):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SET LOCAL emails.bulk = 'on'")
+            if action == "insert":
+                await conn.copy_records_to_table(
+                    "emails", records=rows, columns=["name", "email"]
+                )
+                count = len(rows)
+            elif action == "update":
+                ids, names, emails = zip(*rows)
+                updated = await conn.fetch(
+                    "UPDATE emails SET name=v.name, email=v.email "
+                    "FROM unnest($1::int[], $2::text[], $3::text[]) AS v(id, name, email) "
+                    "WHERE emails.id = v.id RETURNING emails.id",
+                    list(ids), list(names), list(emails)
+                )
+                count = len(updated)
+            else:
+                status = await conn.execute(
+                    "DELETE FROM emails WHERE id = ANY($1::int[])", rows
+                )
+                count = int(status.split()[-1])
+            await conn.execute(
+                "SELECT pg_notify('emails_channel', $1)",
+                bulk_notify_payload(action, count)
+            )
+    return count
+
+BULK_ACTIONS = {
+    "POST": ("insert", bulk_insert_rows),
+    "PUT": ("update", bulk_update_rows),
+    "DELETE": ("delete", bulk_delete_ids),
+}
+
+async def bulk(request):
+    action, to_rows = BULK_ACTIONS[request.method]
+    try:
+        items = parse_bulk_body(await request.body(), request.headers.get("content-type"))
+        rows = to_rows(items)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    count = await bulk_write(action, rows)
+    status = 201 if action == "insert" else 200
+    return JSONResponse({"status": "ok", action: count}, status_code=status)
+
+# エクスポート (NDJSON / CSV): asyncpg のカーソルで EXPORT_BATCH 行ずつ流す
+async def export_emails(fields, fmt):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            cur = await conn.cursor(f"SELECT {', '.join(fields)} FROM emails ORDER BY id;")
+            header = True
+            while True:
+                rows = [tuple(r) for r in await cur.fetch(EXPORT_BATCH)]
+                if not rows and not header:
+                    break
+                yield format_export_batch(rows, fields, fmt, header=header)
+                header = False
+
+async def export(request):
+    fmt = request.query_params.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return JSONResponse({"error": "format must be ndjson or csv"}, status_code=400)
+    try:
+        fields = parse_fields(request.query_params.get("fields"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    return StreamingResponse(
+        export_emails(fields, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=emails.{fmt}"}
+    )
+
+async def stream_emails(request):
+    delta = request.query_params.get("mode") == "delta"
+    last_event_id = (
+        request.headers.get("last-event-id")
+        or request.query_params.get("last_event_id")
+    )
+    return StreamingResponse(
+        event_stream(delta, last_event_id),
+        media_type="text/event-stream"
+    )
+
+async def add_email(request):
+    payload = await request.json()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO emails (name,email) VALUES ($1,$2)",
+            payload['name'], payload['email']
+        )
+    return JSONResponse({"status": "ok"}, status_code=201)
+
+##更新
+async def update_email(request):
+    id = request.path_params["id"]
+    payload = await request.json()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE emails SET name=$1, email=$2 WHERE id=$3",
+            payload.get('name'), payload.get('email'), id
+        )
+    return JSONResponse({"status": "ok"})
+
+#削除
+async def delete_email(request):
+    id = request.path_params["id"]
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM emails WHERE id=$1", id)
+    return JSONResponse({"status": "ok"})
+
+async def pool_stats(request):
+    return JSONResponse({
+        "max_size": pool.get_max_size(),
+        "open": pool.get_size(),
+        "idle": pool.get_idle_size(),
+    })
+
+async def stream_stats(request):
+    return JSONResponse(listener.stats())
+
+# SSE の接続数・通知の遅れ (Prometheus のテキスト形式)
+async def metrics(request):
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(
+        min_size=1,
+        max_size=POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=POOL_MAX_IDLE,
+        **DSN
+    )
+    try:
+        yield
+    finally:
+        await listener.stop()
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/emails", get_emails, methods=["GET"]),
+        Route("/emails", add_email, methods=["POST"]),
+        Route("/emails/bulk", bulk, methods=["POST", "PUT", "DELETE"]),
+        Route("/emails/export", export),
+        Route("/emails/stream", stream_emails),
+        Route("/emails/stream/stats", stream_stats),
+        Route("/emails/{id:int}", update_email, methods=["PUT"]),
+        Route("/emails/{id:int}", delete_email, methods=["DELETE"]),
+        Route("/db/stats", pool_stats),
+        Route("/metrics", metrics),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="localhost", port=5001)
@@ -0,0 +1,235 @@
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import Counter
+
+import numpy as np
+
+from metrics import REGISTRY
+
+# =====================
+# 推論マイクロバッチ
+# =====================
+# Flask の各リクエストスレッドが個別に sess.run(batch=1) を呼ぶ代わりに、
+# 同時に届いた blob を最大 max_batch_size 枚 / max_wait_ms ミリ秒まで
+# まとめて 1 回の sess.run で推論し、結果を各リクエストへ返す。
+# 1 回の sess.run は max_batch_size 枚を超えない（複数枚の blob は入りきらなければ
+# 次のバッチへ回し、それだけで上限を超える blob は分けて流す）。
+#
+# キューの長さとバッチの枚数は /metrics にも出す
+# (predict_batch_queue_depth / predict_batch_size。プロセス内の全スケジューラの合計)。
+
+# 生きているスケジューラ (捨てられたものは参照を持たない)
+_schedulers = weakref.WeakSet()
+IDLE_CHECK = 1.0        # 秒。キューが空のとき、スケジューラが捨てられていないか見る間隔
+
+BATCH_SIZE = REGISTRY.histogram(
+    "predict_batch_size", "Images per batched inference run.",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+REGISTRY.gauge(
+    "predict_batch_queue_depth", "Requests waiting for the batch scheduler.",
+    lambda: sum(s.queue_depth() for s in list(_schedulers))
+)
+
+
+def _restart_after_fork():
+    # gunicorn --preload などで読み込み後に fork されると子にはスレッドが無いので、
+    # 子プロセスで作り直す (フックは 1 つだけ。捨てられたスケジューラは含まない)
+    for scheduler in list(_schedulers):
+        scheduler._start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+class BoundRunner:
+    """sess.run(None, {input_name: blob}) と同じ戻り値を IOBinding 経由で返す
+
+    入力を ONNX Runtime に直接渡し、GPU 実行時のコピーを減らす。
+    """
+
+    def __init__(self, sess, input_name):
+        self.sess = sess
+        self.input_name = input_name
+        self.output_names = [o.name for o in sess.get_outputs()]
+
+    def __call__(self, blob):
+        binding = self.sess.io_binding()
+        binding.bind_cpu_input(self.input_name, np.ascontiguousarray(blob))
+        for name in self.output_names:
+            binding.bind_output(name)
+        self.sess.run_with_iobinding(binding)
+        return binding.copy_outputs_to_cpu()
+
+
+class _Request:
+    __slots__ = ("blob", "event", "outputs", "error")
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.event = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+def _serve(ref, requests):
+    """スケジューラのスレッド。キューを待つ間はスケジューラへの強い参照を持たない"""
+    while True:
+        scheduler = ref()
+        if scheduler is None:
+            return
+        first, scheduler._carry = scheduler._carry, None
+        del scheduler
+        if first is None:
+            try:
+                first = requests.get(timeout=IDLE_CHECK)
+            except queue.Empty:
+                continue
+        # キューに入れた run() がスケジューラを持っているので、ここでは生きている
+        ref()._collect(first)
+
+
+class BatchScheduler:
+
+    def __init__(self, sess, input_name, max_batch_size=8, max_wait_ms=5.0,
+                 io_binding=False):
+        # バッチ次元が固定のモデル (例: 1) はその枚数を上限にする
+        fixed = sess.get_inputs()[0].shape[0]
+        if isinstance(fixed, int) and fixed > 0:
+            max_batch_size = min(max_batch_size, fixed)
+
+        self.sess = sess
+        self.input_name = input_name
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+        self.io_binding = io_binding
+        self._bound = BoundRunner(sess, input_name) if io_binding else None
+
+        self._batch_sizes = Counter()
+        self._batches = 0
+        self._images = 0
+        self._last_batch_size = 0
+        self._start()
+        _schedulers.add(self)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._carry = None      # 前のバッチに入りきらず、次のバッチの先頭にするリクエスト
+        self._lock = threading.Lock()
+        # スレッドは弱参照だけ持つ (捨てられたスケジューラはスレッドごと止まる)
+        self._thread = threading.Thread(
+            target=_serve, args=(weakref.ref(self), self._queue),
+            name="batch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    # --------------------
+    # リクエスト側 (sess.run と同じ戻り値)
+    # --------------------
+    def run(self, blob):
+        n = self.max_batch_size
+        if blob.shape[0] > n:
+            # 1 つで上限を超える blob は上限ごとに分けて流し、出力をつなぎ直す
+            reqs = [_Request(blob[i:i + n]) for i in range(0, blob.shape[0], n)]
+        else:
+            reqs = [_Request(blob)]
+        for req in reqs:
+            self._queue.put(req)
+        for req in reqs:
+            req.event.wait()
+            if req.error is not None:
+                raise req.error
+        if len(reqs) == 1:
+            return reqs[0].outputs
+        return [np.concatenate(parts, axis=0) for parts in zip(*(r.outputs for r in reqs))]
+
+    # --------------------
+    # バッチ収集ループ
+    # --------------------
+    def _collect(self, first):
+        """first から始めて 1 バッチ分を集めて推論する"""
+        batch = [first]
+        size = first.blob.shape[0]
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + req.blob.shape[0] > self.max_batch_size:
+                # 入りきらない分は次のバッチへ (バッチ次元と IOBinding の大きさを守る)
+                self._carry = req
+                break
+            batch.append(req)
+            size += req.blob.shape[0]
+
+        # 入力サイズごとにまとめて推論
+        groups = {}
+        for req in batch:
+            groups.setdefault(req.blob.shape[1:], []).append(req)
+        for reqs in groups.values():
+            self._run_batch(reqs)
+
+    def _run_batch(self, reqs):
+        counts = [req.blob.shape[0] for req in reqs]
+        total = sum(counts)
+
+        try:
+            if len(reqs) == 1:
+                blob = reqs[0].blob
+            else:
+                blob = np.concatenate([req.blob for req in reqs], axis=0)
+            if self._bound is not None:
+                outputs = self._bound(blob)
+            else:
+                outputs = self.sess.run(None, {self.input_name: blob})
+        except Exception as e:
+            for req in reqs:
+                req.error = e
+                req.event.set()
+            return
+
+        BATCH_SIZE.observe(total)
+        with self._lock:
+            self._batch_sizes[total] += 1
+            self._batches += 1
+            self._images += total
+            self._last_batch_size = total
+
+        # 出力をリクエストごとに切り分けて返す
+        start = 0
+        for req, n in zip(reqs, counts):
+            req.outputs = [o[start:start + n] for o in outputs]
+            req.event.set()
+            start += n
+
+    # --------------------
+    # メトリクス
+    # --------------------
+    def queue_depth(self):
+        return self._queue.qsize() + (self._carry is not None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "io_binding": self.io_binding,
+                "batches": self._batches,
+                "images": self._images,
+                "last_batch_size": self._last_batch_size,
+                "mean_batch_size": (
+                    self._images / self._batches if self._batches else 0.0
+                ),
+                "batch_size_histogram": {
+                    str(k): v for k, v in sorted(self._batch_sizes.items())
+                },
+            }
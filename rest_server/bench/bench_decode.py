@@ -0,0 +1,109 @@
+"""縮小デコードのベンチマーク
+
+24 MP (6000×4000) の JPEG を IMREAD_COLOR と IMREAD_REDUCED_COLOR_2/4/8 で展開し、
+1 枚あたりのデコード時間と、プロセスのピーク RSS の増分を比べる。
+RSS は倍率ごとに別プロセスで測る (/proc/self/status の VmHWM)。
+
+    python bench/bench_decode.py --size 6000x4000 --repeat 10
+    python bench/bench_decode.py --image photo.jpg
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decode import DECODE_FLAGS, jpeg_size, pick_factor  # noqa: E402
+
+
+def vm_kib(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def child(path, factor, repeat):
+    """1 つの倍率だけを測って 1 行で出力する (別プロセス)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    buf = np.frombuffer(data, np.uint8)
+    base = vm_kib("VmHWM")
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        img = cv2.imdecode(buf, DECODE_FLAGS[factor])
+        times.append(time.perf_counter() - t0)
+        del img
+    times.sort()
+    print(times[len(times) // 2], times[-1], vm_kib("VmHWM") - base)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", help="測る JPEG (省略時は --size の合成画像)")
+    parser.add_argument("--size", default="6000x4000")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]), args.repeat)
+        return
+
+    tmp = None
+    path = args.image
+    if path is None:
+        w, h = (int(v) for v in args.size.lower().split("x"))
+        # 写真に近い圧縮率になるよう、ノイズではなく滑らかな模様にする
+        yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+        img = np.stack([
+            127 + 120 * np.sin(xx / 37.0), 127 + 120 * np.cos(yy / 23.0),
+            127 + 120 * np.sin((xx + yy) / 51.0)
+        ], axis=2).astype(np.uint8)
+        tmp = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+        tmp.write(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+        tmp.close()
+        path = tmp.name
+        del img, yy, xx
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        w, h = jpeg_size(data)
+        print(f"image={w}x{h} ({len(data) / 2**20:.1f} MiB)  input={args.input_size}")
+        print(
+            "factor picked: stretch (full image) "
+            f"{pick_factor(w, h, args.input_size)}, "
+            f"letterbox (full image) {pick_factor(w, h, args.input_size, letterbox=True)}"
+        )
+        print(f"{'factor':>6} {'decoded':>11} {'p50 ms':>8} {'max ms':>8} {'peak RSS +MiB':>14}")
+
+        for factor in sorted(DECODE_FLAGS):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__),
+                 "--child", path, str(factor), "--repeat", str(args.repeat)],
+                check=True, capture_output=True, text=True
+            ).stdout.split()
+            p50, worst, rss_kib = float(out[0]), float(out[1]), int(out[2])
+            decoded = f"{-(-w // factor)}x{-(-h // factor)}"
+            print(
+                f"{factor:>6} {decoded:>11} {p50 * 1000:>8.1f} {worst * 1000:>8.1f} "
+                f"{rss_kib / 1024:>14.1f}"
+            )
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""NMS のベンチマーク (cv2.dnn.NMSBoxes と nms.py)
+
+パイプの束を真上から撮ったような合成の候補 (六方細密に並んだ円形の端に、1 本あたり
+数個ずつずれた二重検出) を 1k / 10k / 30k 個作り、
+  cv2       : これまでの流れ (リストにして cv2.dnn.NMSBoxes、クラスを区別しない)
+  hard      : nms.nms (NMSBoxes と同じ結果になることも確かめる)
+  aware     : クラスごと (class_aware)
+  top-k     : スコア上位 --top-k 件だけで hard
+  center    : hard + 中心距離 (--center-thres)
+  soft      : Gaussian soft-NMS (--sigma)
+の中央値の時間と、残った数・本当の本数との差を出す。
+
+    python bench/bench_nms.py --counts 1000,10000,30000 --repeat 5
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nms import nms, soft_nms  # noqa: E402
+
+
+def make_bundle(n_candidates, per_pipe=3, diameter=24, jitter=0.12, seed=0):
+    """(boxes [x, y, w, h] int, scores, class_ids, パイプの本数)"""
+    rng = np.random.default_rng(seed)
+    n_pipes = max(1, n_candidates // per_pipe)
+    cols = int(np.ceil(np.sqrt(n_pipes)))
+
+    # 六方細密 (1 行おきに半径ぶんずらす)
+    r, c = np.divmod(np.arange(n_pipes), cols)
+    cx = diameter * (c + 0.5 * (r % 2)) + diameter
+    cy = diameter * 0.866 * r + diameter
+    pipe_class = (rng.random(n_pipes) < 0.2).astype(np.int64)      # 2 割は muku
+
+    pipe = np.repeat(np.arange(n_pipes), per_pipe)[:n_candidates]
+    pipe = np.concatenate([pipe, rng.integers(0, n_pipes, n_candidates - len(pipe))])
+    d = diameter * (1 + rng.normal(0, 0.08, n_candidates))
+    x = cx[pipe] + rng.normal(0, jitter * diameter, n_candidates) - d / 2
+    y = cy[pipe] + rng.normal(0, jitter * diameter, n_candidates) - d / 2
+    boxes = np.stack([x, y, d, d], axis=1).astype(np.int64)
+
+    scores = rng.uniform(0.35, 0.95, n_candidates).astype(np.float32)
+    class_ids = pipe_class[pipe].copy()
+    flip = rng.random(n_candidates) < 0.1                          # クラスを取り違えた二重検出
+    class_ids[flip] = 1 - class_ids[flip]
+
+    order = rng.permutation(n_candidates)
+    return boxes[order], scores[order], class_ids[order], n_pipes
+
+
+def bench(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return result, float(np.median(times)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="1000,10000,30000", help="候補の数 (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--score-thres", type=float, default=0.3)
+    parser.add_argument("--iou-thres", type=float, default=0.5)
+    parser.add_argument("--top-k", type=int, default=0, help="0 なら候補数の 1/2")
+    parser.add_argument("--center-thres", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--diameter", type=int, default=24, help="パイプ端の直径 (画素)")
+    args = parser.parse_args()
+
+    print(
+        f"score>{args.score_thres} iou>{args.iou_thres} center<{args.center_thres} "
+        f"sigma={args.sigma} repeat={args.repeat}"
+    )
+    print(
+        f"{'candidates':>10} {'pipes':>6} {'method':>7} {'ms':>9} {'speedup':>8} "
+        f"{'kept':>6} {'kept-pipes':>10} {'same as cv2':>11}"
+    )
+    for n in (int(v) for v in args.counts.split(",")):
+        boxes, scores, class_ids, n_pipes = make_bundle(n, diameter=args.diameter)
+        top_k = args.top_k or n // 2
+
+        def run_cv2():
+            # これまでのサーバーと同じく、リストにしてから渡す
+            indices = cv2.dnn.NMSBoxes(
+                boxes.tolist(), scores.tolist(),
+                score_threshold=args.score_thres, nms_threshold=args.iou_thres
+            )
+            return np.asarray(indices, np.int64).reshape(-1)
+
+        methods = [
+            ("cv2", run_cv2),
+            ("hard", lambda: nms(boxes, scores, args.iou_thres, args.score_thres)),
+            ("aware", lambda: nms(
+                boxes, scores, args.iou_thres, args.score_thres,
+                class_ids=class_ids, class_aware=True
+            )),
+            ("top-k", lambda: nms(
+                boxes, scores, args.iou_thres, args.score_thres, top_k=top_k
+            )),
+            ("center", lambda: nms(
+                boxes, scores, args.iou_thres, args.score_thres,
+                center_thres=args.center_thres
+            )),
+            ("soft", lambda: soft_nms(boxes, scores, args.score_thres, args.sigma)[0]),
+        ]
+
+        reference, base_ms = None, None
+        for name, fn in methods:
+            keep, ms = bench(fn, args.repeat)
+            if reference is None:
+                reference, base_ms = keep, ms
+            same = "yes" if np.array_equal(keep, reference) else "-"
+            print(
+                f"{n:>10} {n_pipes:>6} {name:>7} {ms:>9.2f} {base_ms / ms:>7.1f}x "
+                f"{len(keep):>6} {len(keep) - n_pipes:>+10} {same:>11}"
+            )
+            if name == "hard" and same != "yes":
+                sys.exit("hard NMS differs from cv2.dnn.NMSBoxes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""/predict パイプラインのベンチマークと回帰チェック
+
+画像フォルダ (省略時は合成画像) を解像度・ROI の大きさ・応答形式ごとに
+  predict/<mode>/<WxH>/roi<割合> : アプリの /predict をまるごと (test_client)
+  stage/<段>/<WxH>/roi<割合>     : decode / preprocess / run / postprocess / nms / draw / encode を単独で
+流し、p50 / p95 / p99 レイテンシ・スループット・ピーク RSS を JSON で書き出す。
+--baseline の JSON と比べて、許容幅を超えて遅く (重く) なった項目があれば一覧を出して終了コード 1。
+
+best.onnx がなければ、同じ入出力の形 (YOLOv8: (N, 4+クラス数, アンカー数)) の
+小さな合成モデルを作って使う (レイテンシの絶対値は本物と比べられない。回帰の検出用)。
+
+    python bench/bench_pipeline.py --app app3 --out result.json --save-baseline bench/baseline.json
+    python bench/bench_pipeline.py --app app3 --images site_a/ --baseline bench/baseline.json
+    python bench/bench_pipeline.py --sizes 1280x960,6000x4000 --rois 1,0.25 --modes json --repeat 30
+"""
+import argparse
+import atexit
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+# アプリごとの前処理と NMS のしきい値 (各アプリの /predict と同じ)
+APP_SETTINGS = {
+    "app": ("letterbox", 0.3, 0.3),
+    "app2": ("stretch", 1e-4, 0.5),
+    "app3": ("stretch", 0.3, 0.5),
+}
+STAGES = ("decode", "preprocess", "run", "postprocess", "nms", "draw", "encode")
+
+# 回帰とみなす幅 (--tolerance の割合に加えて、これ以下の差はノイズとして無視)
+MIN_DIFF_MS = 1.0
+MIN_DIFF_RSS_MB = 16.0
+
+
+# =====================
+# 合成モデル
+# =====================
+def synthetic_model(path, input_size=1280, n_classes=2, stride=8, box=48):
+    """YOLOv8 と同じ形の出力を返す小さな ONNX モデルを書き出す
+
+    8×8 画素の平均の明るさからクラスのスコア (sigmoid) を作り、
+    箱はグリッドの中心に固定の大きさで置く。明るい領域に候補が集まる。
+    """
+    from onnx import TensorProto, helper, numpy_helper
+
+    cells = input_size // stride
+    ys, xs = np.mgrid[0:cells, 0:cells].astype(np.float32)
+    grid = np.stack([
+        (xs.ravel() + 0.5) * stride, (ys.ravel() + 0.5) * stride,
+        np.full(cells * cells, box, np.float32), np.full(cells * cells, box, np.float32),
+    ])[None]                                                 # (1, 4, A)
+
+    rng = np.random.default_rng(0)
+    weight = rng.uniform(2.0, 8.0, (n_classes, 3, 1, 1)).astype(np.float32)
+    bias = np.full(n_classes, -9.0, np.float32)
+
+    nodes = [
+        helper.make_node("AveragePool", ["images"], ["pooled"],
+                         kernel_shape=[stride, stride], strides=[stride, stride]),
+        helper.make_node("Conv", ["pooled", "W", "B"], ["logits"]),
+        helper.make_node("Sigmoid", ["logits"], ["prob"]),
+        helper.make_node("Reshape", ["prob", "cls_shape"], ["cls"]),
+        # バッチ数に合わせて箱を広げるため、cls の 1 チャンネル目に 0 を掛けて足す
+        helper.make_node("Slice", ["cls", "zero_i", "one_i", "one_i"], ["first"]),
+        helper.make_node("Mul", ["first", "zero_f"], ["zeros"]),
+        helper.make_node("Add", ["grid", "zeros"], ["boxes"]),
+        helper.make_node("Concat", ["boxes", "cls"], ["output0"], axis=1),
+    ]
+    inits = [
+        numpy_helper.from_array(weight, "W"),
+        numpy_helper.from_array(bias, "B"),
+        numpy_helper.from_array(np.array([0, n_classes, -1], np.int64), "cls_shape"),
+        numpy_helper.from_array(np.array([0], np.int64), "zero_i"),
+        numpy_helper.from_array(np.array([1], np.int64), "one_i"),
+        numpy_helper.from_array(np.array(0, np.float32), "zero_f"),
+        numpy_helper.from_array(grid, "grid"),
+    ]
+    graph = helper.make_graph(
+        nodes, "synthetic_yolo",
+        [helper.make_tensor_value_info(
+            "images", TensorProto.FLOAT, ["batch", 3, input_size, input_size])],
+        [helper.make_tensor_value_info(
+            "output0", TensorProto.FLOAT, ["batch", 4 + n_classes, cells * cells])],
+        inits,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    with open(path, "wb") as f:
+        f.write(model.SerializeToString())
+
+
+# =====================
+# 計測
+# =====================
+def vm_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def reset_peak_rss():
+    """VmHWM を今の RSS に戻す (Linux 4.0+)。できなければプロセス全体のピークになる"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def summarize(times, wall=None):
+    t = np.sort(np.asarray(times)) * 1000
+    wall = wall if wall is not None else t.sum() / 1000
+    return {
+        "n": int(len(t)),
+        "p50_ms": round(float(np.percentile(t, 50)), 3),
+        "p95_ms": round(float(np.percentile(t, 95)), 3),
+        "p99_ms": round(float(np.percentile(t, 99)), 3),
+        "mean_ms": round(float(t.mean()), 3),
+        "throughput_per_s": round(len(t) / wall, 3) if wall > 0 else 0.0,
+    }
+
+
+def measure(fn, repeat, concurrency=1):
+    fn()   # 1 回目 (初回だけの準備) は数えない
+    reset_peak_rss()
+    times = []
+    lock = threading.Lock()
+
+    def one(_):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        with lock:
+            times.append(dt)
+
+    t0 = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as ex:
+            list(ex.map(one, range(repeat)))
+    else:
+        for i in range(repeat):
+            one(i)
+    result = summarize(times, time.perf_counter() - t0)
+    result["peak_rss_mb"] = round(vm_mb("VmHWM"), 1)
+    return result
+
+
+def make_image(size, seed=0):
+    """写真に近い圧縮率になる合成画像 (滑らかな模様 + 少しのノイズ)"""
+    w, h = (int(v) for v in size.lower().split("x"))
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    img = np.stack([
+        127 + 120 * np.sin(xx / 37.0 + seed), 127 + 120 * np.cos(yy / 23.0),
+        127 + 120 * np.sin((xx + yy) / 51.0)
+    ], axis=2)
+    img += np.random.default_rng(seed).normal(0, 8, img.shape)
+    return cv2.imencode(
+        ".jpg", np.clip(img, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 90]
+    )[1].tobytes()
+
+
+def center_roi(w, h, frac):
+    rw, rh = max(1, int(w * frac)), max(1, int(h * frac))
+    x1, y1 = (w - rw) // 2, (h - rh) // 2
+    return x1, y1, x1 + rw, y1 + rh
+
+
+# =====================
+# 各段を単独で
+# =====================
+def stage_benchmarks(data, roi, args, sess, fit, score_thres, nms_thres):
+    from decode import decode_upload
+    from nms import suppress
+    from postprocess import decode_yolo, letterbox_to_xywh, stretch_to_xywh
+    from preprocess import InputBuffers, input_dtype
+
+    size = args.input_size
+    input_name = sess.get_inputs()[0].name
+    buffers = InputBuffers(size, dtype=input_dtype(sess))
+    x1, y1, x2, y2 = roi
+
+    # 各段は画像を返す応答 (縮小デコードなし) の流れで測る
+    img, _, _ = decode_upload(data, input_size=size, reduce=False)
+    roi_img = img[y1:y2, x1:x2]
+    roi_h, roi_w = roi_img.shape[:2]
+
+    def preprocess():
+        if fit == "letterbox":
+            return buffers.letterbox(roi_img)
+        return buffers.stretch(roi_img), None, None
+
+    if fit == "letterbox":
+        blob, ratio, (dw, dh) = preprocess()
+    else:
+        blob = preprocess()[0]
+    preds = sess.run(None, {input_name: blob})[0][0]
+
+    def postprocess():
+        decoded = decode_yolo(preds, conf_thres=0.3)
+        if fit == "letterbox":
+            return letterbox_to_xywh(decoded, ratio, dw, dh, roi_w, roi_h)
+        return stretch_to_xywh(decoded, roi_w / size, roi_h / size, offset=(x1, y1))
+
+    boxes, scores, class_ids = postprocess()
+
+    def nms():
+        return suppress(boxes, scores, class_ids, score_thres, nms_thres)[0]
+
+    keep = nms()
+    boxes, scores = boxes.tolist(), scores.tolist()
+
+    def draw():
+        out = roi_img.copy()
+        for i in keep:
+            x, y, w, h = boxes[i]
+            cv2.rectangle(out, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            cv2.putText(out, f"{class_ids[i]} {scores[i] * 100:.1f}%", (x, max(20, y - 5)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+        return out
+
+    drawn = draw()
+    fns = {
+        "decode": lambda: decode_upload(data, input_size=size, reduce=False),
+        "preprocess": preprocess,
+        "run": lambda: sess.run(None, {input_name: blob}),
+        "postprocess": postprocess,
+        "nms": nms,
+        "draw": draw,
+        "encode": lambda: cv2.imencode(".jpg", drawn),
+    }
+    results = {name: measure(fns[name], args.repeat) for name in STAGES}
+    results["nms"]["candidates"] = len(boxes)
+    results["nms"]["kept"] = int(len(keep))
+    return results
+
+
+# =====================
+# ベースラインとの比較
+# =====================
+def compare(result, baseline, tolerance):
+    """(回帰の一覧, 改善の一覧)。各要素は (項目, 指標, 基準, 今回)"""
+    regressions, improvements = [], []
+    for key, cur in result["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            b, c = base[metric], cur[metric]
+            if c > b * (1 + tolerance) and c - b > MIN_DIFF_MS:
+                regressions.append((key, metric, b, c))
+            elif c < b * (1 - tolerance) and b - c > MIN_DIFF_MS:
+                improvements.append((key, metric, b, c))
+        b, c = base["throughput_per_s"], cur["throughput_per_s"]
+        if c < b * (1 - tolerance):
+            regressions.append((key, "throughput_per_s", b, c))
+        b, c = base.get("peak_rss_mb"), cur.get("peak_rss_mb")
+        if b and c and c > b * (1 + tolerance) and c - b > MIN_DIFF_RSS_MB:
+            regressions.append((key, "peak_rss_mb", b, c))
+    return regressions, improvements
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default="app3", choices=sorted(APP_SETTINGS))
+    parser.add_argument("--model", default="best.onnx", help="なければ合成モデルを使う")
+    parser.add_argument("--images", help="画像フォルダ (省略時は --sizes の合成画像)")
+    parser.add_argument("--sizes", default="1280x960,4000x3000,6000x4000")
+    parser.add_argument("--rois", default="1,0.5", help="ROI の一辺の割合 (中央) をカンマ区切り")
+    parser.add_argument("--modes", default="image,json", help="/predict の response をカンマ区切り")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1, help="/predict を同時に投げる数")
+    parser.add_argument("--no-stages", action="store_true", help="各段の単独計測を省く")
+    parser.add_argument("--out", help="結果の JSON (省略時は標準出力)")
+    parser.add_argument("--baseline", help="比べるベースラインの JSON")
+    parser.add_argument("--save-baseline", help="今回の結果をベースラインとして保存する")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="許容する悪化の割合")
+    args = parser.parse_args()
+
+    from cache import model_hash
+    from decode import decode_upload
+
+    # アプリは cwd の best.onnx を読むので、モデルのあるディレクトリで読み込む
+    # (出力先などのパスは移動する前に絶対パスにしておく)
+    for name in ("images", "out", "baseline", "save_baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    model = os.path.abspath(args.model)
+    synthetic = not os.path.exists(model)
+    workdir = os.path.dirname(model)
+    if synthetic:
+        workdir = tempfile.mkdtemp()
+        model = os.path.join(workdir, "best.onnx")
+        synthetic_model(model, args.input_size)
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    elif os.path.basename(model) != "best.onnx":
+        parser.error("--model must be named best.onnx (the apps load it by that name)")
+
+    images = []
+    if args.images:
+        from profiles import calibration_images
+        for path in calibration_images(args.images):
+            with open(path, "rb") as f:
+                images.append((os.path.basename(path), f.read()))
+    else:
+        images = [(size, make_image(size, i)) for i, size in enumerate(args.sizes.split(","))]
+
+    # 推論結果キャッシュに当たると計測にならないので切る
+    os.environ["PREDICT_CACHE_MB"] = "0"
+    os.chdir(workdir)
+    mod = __import__(args.app)
+    client = mod.app.test_client()
+
+    fit, score_thres, nms_thres = APP_SETTINGS[args.app]
+    sess = ort.InferenceSession(model, providers=["CPUExecutionProvider"])
+    # app2.py は ROI を受け取らない
+    fractions = [1.0] if args.app == "app2" else [float(v) for v in args.rois.split(",")]
+    modes = args.modes.split(",")
+
+    results = {}
+    for name, data in images:
+        _, _, (w, h) = decode_upload(data, input_size=args.input_size)
+        label = f"{w}x{h}" if not args.images else name
+
+        for frac in fractions:
+            roi = center_roi(w, h, frac)
+            tag = f"{label}/roi{frac:g}"
+
+            for mode in modes:
+                def predict():
+                    form = {"image": (io.BytesIO(data), "bench.jpg"), "response": mode}
+                    form.update(zip(("x1", "y1", "x2", "y2"), map(str, roi)))
+                    r = client.post("/predict", data=form, content_type="multipart/form-data")
+                    if r.status_code != 200:
+                        raise RuntimeError(f"/predict {r.status_code}: {r.data[:200]}")
+
+                results[f"predict/{mode}/{tag}"] = measure(
+                    predict, args.repeat, args.concurrency
+                )
+                print(f"predict/{mode}/{tag}: {results[f'predict/{mode}/{tag}']}", file=sys.stderr)
+
+            if not args.no_stages:
+                for stage, r in stage_benchmarks(
+                    data, roi, args, sess, fit, score_thres, nms_thres
+                ).items():
+                    results[f"stage/{stage}/{tag}"] = r
+
+    result = {
+        "meta": {
+            "app": args.app,
+            "model": "synthetic" if synthetic else model_hash(model),
+            "input_size": args.input_size,
+            "repeat": args.repeat,
+            "concurrency": args.concurrency,
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "onnxruntime": ort.__version__,
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for k in ("model", "cpus", "input_size", "onnxruntime"):
+            if baseline["meta"].get(k) != result["meta"][k]:
+                print(
+                    f"warning: baseline {k}={baseline['meta'].get(k)} "
+                    f"differs from this run ({result['meta'][k]})", file=sys.stderr
+                )
+        regressions, improvements = compare(result, baseline, args.tolerance)
+        for key, metric, b, c in improvements:
+            print(f"improved   {key} {metric}: {b} -> {c}", file=sys.stderr)
+        if regressions:
+            print(
+                f"\n!!! {len(regressions)} PERFORMANCE REGRESSION(S) "
+                f"(tolerance {args.tolerance:.0%}) !!!", file=sys.stderr
+            )
+            for key, metric, b, c in regressions:
+                print(f"REGRESSION {key} {metric}: {b} -> {c}", file=sys.stderr)
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
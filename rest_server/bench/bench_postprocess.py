@@ -0,0 +1,177 @@
+"""後処理マイクロベンチマーク
+
+旧実装 (アンカーごとの Python ループ) と postprocess.py のベクトル化版を
+同じ合成出力で比較し、結果が一致することも確認する。
+
+    python bench/bench_postprocess.py --anchors 33600 --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postprocess import decode_yolo, letterbox_to_xywh, stretch_to_xywh  # noqa: E402
+
+
+# =====================
+# 旧実装 (app.py / app2.py / app3.py のループをそのまま移植)
+# =====================
+def loop_letterbox(preds, ratio, dw, dh, roi_w, roi_h):
+    boxes, scores, class_ids = [], [], []
+    for i in range(preds.shape[1]):
+        xc, yc, bw, bh = preds[0:4, i]
+        class_scores = preds[4:, i]
+        cls = int(np.argmax(class_scores))
+        score = float(class_scores[cls])
+        if score < 0.3:
+            continue
+        x = (xc - bw / 2 - dw) / ratio
+        y = (yc - bh / 2 - dh) / ratio
+        w_box = bw / ratio
+        h_box = bh / ratio
+        x = int(max(0, min(x, roi_w - 1)))
+        y = int(max(0, min(y, roi_h - 1)))
+        w_box = int(min(roi_w - x, w_box))
+        h_box = int(min(roi_h - y, h_box))
+        boxes.append([x, y, w_box, h_box])
+        scores.append(score)
+        class_ids.append(cls)
+    return boxes, scores, class_ids
+
+
+def loop_stretch_clip(preds, scale_x, scale_y, orig_w, orig_h):
+    boxes, scores, class_ids = [], [], []
+    for i in range(preds.shape[1]):
+        xc, yc, bw, bh = preds[0:4, i]
+        class_scores = preds[4:, i]
+        cls = int(np.argmax(class_scores))
+        score = float(class_scores[cls])
+        if score < 0.3:
+            continue
+        x1 = int((xc - bw / 2) * scale_x)
+        y1 = int((yc - bh / 2) * scale_y)
+        x2 = int((xc + bw / 2) * scale_x)
+        y2 = int((yc + bh / 2) * scale_y)
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        x2 = min(orig_w, x2)
+        y2 = min(orig_h, y2)
+        boxes.append([x1, y1, x2 - x1, y2 - y1])
+        scores.append(score)
+        class_ids.append(cls)
+    return boxes, scores, class_ids
+
+
+def loop_stretch_roi(preds, scale_x, scale_y, x1, y1):
+    boxes, scores, class_ids = [], [], []
+    for i in range(preds.shape[1]):
+        xc, yc, bw, bh = preds[0:4, i]
+        class_scores = preds[4:, i]
+        cls = int(np.argmax(class_scores))
+        score = float(class_scores[cls])
+        if score < 0.3:
+            continue
+        x = (xc - bw / 2) * scale_x
+        y = (yc - bh / 2) * scale_y
+        w_box = bw * scale_x
+        h_box = bh * scale_y
+        x = int(x + x1)
+        y = int(y + y1)
+        w_box = int(w_box)
+        h_box = int(h_box)
+        boxes.append([x, y, w_box, h_box])
+        scores.append(score)
+        class_ids.append(cls)
+    return boxes, scores, class_ids
+
+
+# =====================
+# ベクトル化版 (各サーバーと同じ呼び出し方)
+# =====================
+def vec_letterbox(preds, ratio, dw, dh, roi_w, roi_h):
+    boxes, scores, class_ids = letterbox_to_xywh(
+        decode_yolo(preds, conf_thres=0.3), ratio, dw, dh, roi_w, roi_h
+    )
+    return boxes.tolist(), scores.tolist(), class_ids.tolist()
+
+
+def vec_stretch_clip(preds, scale_x, scale_y, orig_w, orig_h):
+    boxes, scores, class_ids = stretch_to_xywh(
+        decode_yolo(preds, conf_thres=0.3), scale_x, scale_y,
+        clip_size=(orig_w, orig_h)
+    )
+    return boxes.tolist(), scores.tolist(), class_ids.tolist()
+
+
+def vec_stretch_roi(preds, scale_x, scale_y, x1, y1):
+    boxes, scores, class_ids = stretch_to_xywh(
+        decode_yolo(preds, conf_thres=0.3), scale_x, scale_y,
+        offset=(x1, y1)
+    )
+    return boxes.tolist(), scores.tolist(), class_ids.tolist()
+
+
+def make_preds(num_anchors, num_classes, input_size, positive_rate, seed=0):
+    rng = np.random.default_rng(seed)
+    preds = np.empty((4 + num_classes, num_anchors), np.float32)
+    preds[0] = rng.uniform(0, input_size, num_anchors)
+    preds[1] = rng.uniform(0, input_size, num_anchors)
+    preds[2] = rng.uniform(4, 120, num_anchors)
+    preds[3] = rng.uniform(4, 120, num_anchors)
+    preds[4:] = rng.uniform(0, 0.3, (num_classes, num_anchors))
+    hit = rng.random(num_anchors) < positive_rate
+    preds[4:, hit] = rng.uniform(0, 1, (num_classes, int(hit.sum())))
+    return preds
+
+
+def bench(fn, args, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - t0)
+    return result, float(np.median(times)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--anchors", type=int, default=33600)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--positive-rate", type=float, default=0.02)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    preds = make_preds(
+        args.anchors, args.classes, args.input_size, args.positive_rate
+    )
+
+    cases = [
+        ("letterbox (app.py)", loop_letterbox, vec_letterbox,
+         (preds, 0.4, 0.0, 160.0, 3200, 2400)),
+        ("stretch+clip (app2.py)", loop_stretch_clip, vec_stretch_clip,
+         (preds, 6000 / args.input_size, 4000 / args.input_size, 6000, 4000)),
+        ("stretch+roi (app3.py)", loop_stretch_roi, vec_stretch_roi,
+         (preds, 2400 / args.input_size, 1800 / args.input_size, 350, 720)),
+    ]
+
+    print(f"anchors={args.anchors} classes={args.classes} repeat={args.repeat}")
+    for name, loop_fn, vec_fn, fn_args in cases:
+        loop_res, loop_ms = bench(loop_fn, fn_args, max(1, args.repeat // 5))
+        vec_res, vec_ms = bench(vec_fn, fn_args, args.repeat)
+        same = loop_res == vec_res
+        print(
+            f"{name:24s} loop={loop_ms:9.2f} ms  vectorized={vec_ms:7.3f} ms  "
+            f"speedup={loop_ms / vec_ms:7.1f}x  boxes={len(vec_res[0])}  "
+            f"identical={same}"
+        )
+        if not same:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
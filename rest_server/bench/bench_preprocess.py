@@ -0,0 +1,109 @@
+"""前処理マイクロベンチマーク
+
+旧実装 (letterbox → cvtColor → astype → /255 → transpose → expand_dims) と
+preprocess.InputBuffers (確保済みバッファへの直接書き込み) を比べ、
+1 枚あたりの時間とピークメモリ (tracemalloc: NumPy / OpenCV の配列分) を出す。結果が一致することも確認する。
+
+    python bench/bench_preprocess.py --size 4000x3000 --repeat 20
+    python bench/bench_preprocess.py --model best.onnx        # sess.run まで含めて比較
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocess import InputBuffers  # noqa: E402
+
+
+# =====================
+# 旧実装 (app.py / app2.py の preprocess をそのまま移植)
+# =====================
+def legacy_letterbox(img, new_shape=1280, color=(114, 114, 114)):
+    shape = img.shape[:2]
+    r = min(new_shape / shape[0], new_shape / shape[1])
+    new_unpad = (int(round(shape[1] * r)), int(round(shape[0] * r)))
+    dw = (new_shape - new_unpad[0]) / 2
+    dh = (new_shape - new_unpad[1]) / 2
+    if shape[::-1] != new_unpad:
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img_rgb = img_rgb.astype(np.float32) / 255.0
+    img_chw = np.transpose(img_rgb, (2, 0, 1))
+    return np.expand_dims(img_chw, axis=0)
+
+
+def legacy_stretch(img, size=1280):
+    img_resized = cv2.resize(img, (size, size))
+    img_rgb = cv2.cvtColor(img_resized, cv2.COLOR_BGR2RGB)
+    img_rgb = img_rgb.astype(np.float32) / 255.0
+    img_chw = np.transpose(img_rgb, (2, 0, 1))
+    return np.expand_dims(img_chw, axis=0)
+
+
+def measure(fn, repeat):
+    fn()    # ウォームアップ (InputBuffers はここでバッファを確保する)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - t0) / repeat
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="4000x3000", help="入力画像 WxH")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--fp16", action="store_true", help="float16 の入力テンソルに書き込む")
+    parser.add_argument("--model", help="指定すると sess.run まで含めて測る")
+    args = parser.parse_args()
+
+    w, h = (int(v) for v in args.size.lower().split("x"))
+    img = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    size = args.input_size
+    buffers = InputBuffers(size, dtype=np.float16 if args.fp16 else np.float32)
+
+    if not args.fp16:
+        assert np.array_equal(legacy_letterbox(img, size), buffers.letterbox(img)[0])
+        assert np.array_equal(legacy_stretch(img, size), buffers.stretch(img))
+
+    cases = [
+        ("letterbox", lambda: legacy_letterbox(img, size), lambda: buffers.letterbox(img)),
+        ("stretch", lambda: legacy_stretch(img, size), lambda: buffers.stretch(img)),
+    ]
+
+    if args.model:
+        import onnxruntime as ort
+        sess = ort.InferenceSession(args.model, providers=["CPUExecutionProvider"])
+        input_name = sess.get_inputs()[0].name
+        cases.append((
+            "stretch+run",
+            lambda: sess.run(None, {input_name: legacy_stretch(img, size)}),
+            lambda: sess.run(None, {input_name: buffers.stretch(img)}),
+        ))
+
+    print(f"image={w}x{h} input={size} dtype={buffers.blob.dtype} repeat={args.repeat}")
+    print(f"{'case':>12} {'impl':>7} {'ms/img':>8} {'peak MiB':>9}")
+    for name, legacy, fused in cases:
+        for impl, fn in (("legacy", legacy), ("fused", fused)):
+            elapsed, peak = measure(fn, args.repeat)
+            print(f"{name:>12} {impl:>7} {elapsed * 1000:>8.2f} {peak / 2**20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""統合サーバー (server.py) の起動時間とワーカーごとのメモリの計測
+
+次の構成を gunicorn で起動し、
+  scripts  : app.py / app2.py / app3.py を別々のサーバーで 1 ワーカーずつ (従来の動かし方)
+  no-preload : server.py を --workers N、各ワーカーがモデルを読み込む
+  preload    : server.py を --workers N、マスターで読み込んでから fork (gunicorn.conf.py の既定)
+起動から全ワーカーが /ready に 200 を返すまでの時間と、/predict を何回か流した後の
+プロセスごとの RSS / USS (そのプロセスだけのページ) / PSS (共有ページを按分) を出す。
+PSS の合計がマシンの実際のメモリ使用量にあたる。
+
+gunicorn が必要。モデル (best.onnx) のあるディレクトリで実行する。
+
+    python bench/bench_server.py --workers 4 --requests 20
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def smaps(pid):
+    """/proc/<pid>/smaps_rollup の Rss / Pss / USS (MiB)"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return {
+        "rss": values.get("Rss", 0.0),
+        "pss": values.get("Pss", 0.0),
+        "uss": values.get("Private_Clean", 0.0) + values.get("Private_Dirty", 0.0),
+    }
+
+
+def children(pid):
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            found.append(int(entry))
+    return found
+
+
+def multipart(fields, image):
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields.items():
+        out.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+        )
+    out.write(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="a.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n".encode()
+    )
+    out.write(image)
+    out.write(f"\r\n--{boundary}--\r\n".encode())
+    return out.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+def ready_pid(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=2) as r:
+            return json.loads(r.read()).get("pid")
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+
+
+def wait_ready(procs, ports, workers, started, limit=300):
+    """全サーバーの全ワーカーが /ready に答えるまで待ち、起動からの秒数"""
+    seen = {port: set() for port in ports}
+    while time.monotonic() - started < limit:
+        for proc in procs:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+        for port in ports:
+            pid = ready_pid(port)
+            if pid is not None:
+                seen[port].add(pid)
+        if all(len(s) >= workers for s in seen.values()):
+            return time.monotonic() - started
+        time.sleep(0.05)
+    raise RuntimeError("servers did not become ready")
+
+
+def predict(port, image, size):
+    w, h = size
+    body, content_type = multipart(
+        {"response": "json", "x1": 0, "y1": 0, "x2": w, "y2": h}, image
+    )
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/predict", data=body,
+        headers={"Content-Type": content_type}
+    )
+    with urllib.request.urlopen(req, timeout=120) as r:
+        r.read()
+
+
+def run_config(label, commands, workers, args, images):
+    ports = [port for port, _, _ in commands]
+    started = time.monotonic()
+    procs = [
+        subprocess.Popen(
+            cmd, env={**os.environ, **env}, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        for _, cmd, env in commands
+    ]
+    try:
+        ready = wait_ready(procs, ports, workers, started)
+        # 推論の作業メモリも載った状態で測る (キャッシュに当たらないよう画像を替える)
+        for i in range(args.requests):
+            for port in ports:
+                predict(port, images[i % len(images)], args.size_wh)
+
+        rows = []
+        for proc in procs:
+            rows.append(("master", smaps(proc.pid)))
+            rows.extend(("worker", smaps(pid)) for pid in children(proc.pid))
+    finally:
+        for proc in procs:
+            os.killpg(proc.pid, signal.SIGTERM)
+        for proc in procs:
+            proc.wait()
+
+    worker_rows = [m for kind, m in rows if kind == "worker"]
+    total_pss = sum(m["pss"] for _, m in rows)
+    mean = lambda key: sum(m[key] for m in worker_rows) / max(1, len(worker_rows))  # noqa: E731
+    print(
+        f"{label:>10} {len(procs):>7} {len(worker_rows):>7} {ready:>7.2f} "
+        f"{total_pss:>9.0f} {mean('rss'):>9.0f} {mean('uss'):>9.0f} {mean('pss'):>9.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4, help="server.py のワーカー数")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=10, help="サーバーごとの /predict 回数")
+    parser.add_argument("--size", default="4000x3000", help="送る JPEG の大きさ WxH")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument(
+        "--configs", default="scripts,no-preload,preload", help="計測する構成 (カンマ区切り)"
+    )
+    args = parser.parse_args()
+    args.size_wh = tuple(int(v) for v in args.size.lower().split("x"))
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        sys.exit("gunicorn が見つからない (pip install gunicorn)")
+
+    w, h = args.size_wh
+    rng = np.random.default_rng(0)
+    images = [
+        cv2.imencode(".jpg", rng.integers(0, 256, (h, w, 3), dtype=np.uint8))[1].tobytes()
+        for _ in range(4)
+    ]
+
+    gunicorn = [sys.executable, "-m", "gunicorn", "--pythonpath", HERE]
+    config = os.path.join(HERE, "gunicorn.conf.py")
+    # 各構成の (ポート, コマンド, 環境変数)
+    configs = {
+        "scripts": (1, [
+            (args.port + i, gunicorn + [
+                "-b", f"127.0.0.1:{args.port + i}", "-w", "1", "-k", "gthread",
+                "--threads", str(args.threads), f"{name}:app"
+            ], {"INFER_WORKERS": "0"})
+            for i, name in enumerate(("app", "app2", "app3"))
+        ]),
+        "no-preload": (args.workers, [
+            (args.port, gunicorn + ["-c", config, "server:app"], {
+                "SERVER_PRELOAD": "0", "SERVER_WORKERS": str(args.workers),
+                "SERVER_THREADS": str(args.threads), "SERVER_BIND": f"127.0.0.1:{args.port}",
+            })
+        ]),
+        "preload": (args.workers, [
+            (args.port, gunicorn + ["-c", config, "server:app"], {
+                "SERVER_PRELOAD": "1", "SERVER_WORKERS": str(args.workers),
+                "SERVER_THREADS": str(args.threads), "SERVER_BIND": f"127.0.0.1:{args.port}",
+            })
+        ]),
+    }
+
+    print(f"workers={args.workers} threads={args.threads} image={args.size} requests={args.requests}")
+    print(
+        f"{'config':>10} {'servers':>7} {'workers':>7} {'ready s':>7} {'PSS MiB':>9} "
+        f"{'RSS/wkr':>9} {'USS/wkr':>9} {'PSS/wkr':>9}"
+    )
+    for label in args.configs.split(","):
+        workers, commands = configs[label]
+        run_config(label, commands, workers, args, images)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""SSE 同時接続ベンチマーク
+
+起動中のサーバー (Flask の app2.py / app3.py、または ASGI の app_async.py) に
+N 本の /emails/stream を同時に張り、次を測る。
+
+- サーバープロセスの RSS / スレッド数の増分 (--pid 指定時、/proc から取得)
+- INSERT の commit から全クライアントにイベントが届くまでの遅延 (p50 / p95 / max)
+
+    ulimit -n 65536
+    python bench/bench_sse.py --url http://localhost:5000/emails/stream --clients 200 --pid <flask pid>
+    python bench/bench_sse.py --url http://localhost:5001/emails/stream --clients 5000 --pid <uvicorn pid>
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import get_connection  # noqa: E402
+
+
+def proc_status(pid):
+    """(RSS KiB, スレッド数)"""
+    rss = threads = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Client:
+
+    def __init__(self):
+        self.waiting = {}       # marker -> Future
+
+
+async def run_client(host, port, path, client, connected):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+        "Accept: text/event-stream\r\nCache-Control: no-cache\r\n\r\n".encode()
+    )
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    connected()
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            now = time.perf_counter()
+            for marker, fut in list(client.waiting.items()):
+                if marker.encode() in line:
+                    del client.waiting[marker]
+                    if not fut.done():
+                        fut.set_result(now)
+    finally:
+        writer.close()
+
+
+def insert_marker(marker):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO emails (name,email) VALUES (%s,%s)",
+                (marker, f"{marker}@bench.local")
+            )
+        conn.commit()
+        return time.perf_counter()
+    finally:
+        conn.close()
+
+
+def delete_markers(prefix):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM emails WHERE name LIKE %s", (prefix + "%",))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000/emails/stream")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--mode", choices=["snapshot", "delta"], default="delta")
+    parser.add_argument("--pid", type=int, help="サーバープロセスの PID (RSS 計測用)")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    path = url.path + ("?mode=delta" if args.mode == "delta" else "")
+    loop = asyncio.get_running_loop()
+
+    before = proc_status(args.pid) if args.pid else None
+
+    clients = [Client() for _ in range(args.clients)]
+    ready = 0
+    all_ready = loop.create_future()
+
+    def connected():
+        nonlocal ready
+        ready += 1
+        if ready == args.clients and not all_ready.done():
+            all_ready.set_result(None)
+
+    t0 = time.perf_counter()
+    tasks = [
+        loop.create_task(run_client(url.hostname, url.port or 80, path, c, connected))
+        for c in clients
+    ]
+    await asyncio.wait_for(all_ready, args.timeout)
+    connect_s = time.perf_counter() - t0
+    await asyncio.sleep(1.0)
+
+    print(f"url={args.url} mode={args.mode} clients={args.clients} connect={connect_s:.2f}s")
+    if before:
+        after = proc_status(args.pid)
+        rss_kib = after[0] - before[0]
+        print(
+            f"server RSS +{rss_kib / 1024:.1f} MiB "
+            f"({rss_kib / args.clients:.1f} KiB/client), "
+            f"threads {before[1]} -> {after[1]}"
+        )
+
+    prefix = f"sse-bench-{uuid.uuid4().hex[:8]}-"
+    latencies = []
+    try:
+        for i in range(args.rounds):
+            marker = f"{prefix}{i}"
+            futures = []
+            for c in clients:
+                fut = loop.create_future()
+                c.waiting[marker] = fut
+                futures.append(fut)
+
+            committed = await loop.run_in_executor(None, insert_marker, marker)
+            done, pending = await asyncio.wait(futures, timeout=args.timeout)
+            arrived = [f.result() - committed for f in done]
+            latencies.extend(arrived)
+            print(
+                f"round {i}: delivered {len(done)}/{len(futures)}  "
+                f"p50={percentile(arrived, 50) * 1000:.1f} ms  "
+                f"max={max(arrived, default=float('nan')) * 1000:.1f} ms"
+            )
+            for c in clients:
+                c.waiting.pop(marker, None)
+    finally:
+        await loop.run_in_executor(None, delete_markers, prefix)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(
+        f"notify->delivery  p50={percentile(latencies, 50) * 1000:.1f} ms  "
+        f"p95={percentile(latencies, 95) * 1000:.1f} ms  "
+        f"max={max(latencies, default=float('nan')) * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
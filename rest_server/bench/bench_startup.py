@@ -0,0 +1,127 @@
+"""コールドスタートの計測 (time-to-first-prediction)
+
+アプリを毎回新しいプロセスで読み込み、プロセス起動から
+  ready      : モジュール読み込み (セッション作成・ウォームアップ) が終わるまで
+  1st        : 最初の /predict の応答が返るまで
+と、1 リクエスト目 / 2 リクエスト目のレイテンシを、
+ウォームアップの有無と最適化済みモデルの有無の組み合わせごとに出す。
+モデル (best.onnx) のあるディレクトリで実行する。
+
+    python bench/bench_startup.py --app app3 --warmup-runs 3 --repeat 3
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+
+def child(app_name, size):
+    import cv2
+    import numpy as np
+
+    mod = __import__(app_name)
+    client = mod.app.test_client()
+
+    w, h = (int(v) for v in size.lower().split("x"))
+    rng = np.random.default_rng(0)
+
+    latencies = []
+    for _ in range(2):
+        # 推論結果キャッシュに当たらないよう毎回別の画像にする
+        img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        data = cv2.imencode(".jpg", img)[1].tobytes()
+        form = {
+            "image": (io.BytesIO(data), "bench.jpg"), "response": "json",
+            "x1": "0", "y1": "0", "x2": str(w), "y2": str(h),
+        }
+        t0 = time.perf_counter()
+        r = client.post("/predict", data=form, content_type="multipart/form-data")
+        latencies.append(time.perf_counter() - t0)
+        assert r.status_code == 200, r.data
+
+    report = mod.startup.report()
+    report["latencies"] = latencies
+    print("RESULT " + json.dumps(report))
+
+
+def run_child(args, env):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", args.app, "--size", args.size],
+        env={**os.environ, **env}, check=True, capture_output=True, text=True
+    ).stdout
+    line = next(ln for ln in out.splitlines() if ln.startswith("RESULT "))
+    return json.loads(line[len("RESULT "):])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default="app3", choices=("app", "app2", "app3"))
+    parser.add_argument("--model", default="best.onnx")
+    parser.add_argument("--size", default="4000x3000", help="送る JPEG の大きさ WxH")
+    parser.add_argument("--warmup-runs", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="組み合わせごとの起動回数")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.size)
+        return
+
+    from profiles import (
+        MODEL_PROFILE, ORT_OPT_LEVEL, available_providers, create_session, optimized_path,
+        profile_path
+    )
+
+    cached = optimized_path(
+        profile_path(args.model, MODEL_PROFILE), ORT_OPT_LEVEL, available_providers()[0]
+    )
+    # 既存の最適化済みモデルは退避して、計測後に戻す
+    backup = cached + ".bak"
+    if os.path.exists(cached):
+        shutil.move(cached, backup)
+
+    print(f"app={args.app} profile={MODEL_PROFILE} opt={ORT_OPT_LEVEL} image={args.size}")
+    print(
+        f"{'optimized':>9} {'warmup':>6} {'import s':>8} {'session s':>9} {'warmup s':>8} "
+        f"{'ready s':>7} {'1st s':>6} {'req1 ms':>8} {'req2 ms':>8}"
+    )
+    try:
+        for optimized in (False, True):
+            if optimized:
+                create_session(args.model, save_optimized=True)
+            for warmup in (0, args.warmup_runs):
+                rows = [
+                    run_child(args, {"WARMUP_RUNS": str(warmup), "ORT_SAVE_OPTIMIZED": "0"})
+                    for _ in range(args.repeat)
+                ]
+
+                def med(get):
+                    values = sorted(get(r) for r in rows)
+                    return values[len(values) // 2]
+
+                print(
+                    f"{'yes' if optimized else 'no':>9} {warmup:>6} "
+                    f"{med(lambda r: r['phases_s']['import']):>8.2f} "
+                    f"{med(lambda r: r['phases_s']['session']):>9.2f} "
+                    f"{med(lambda r: r['phases_s'].get('warmup', 0)):>8.2f} "
+                    f"{med(lambda r: r['ready_after_s']):>7.2f} "
+                    f"{med(lambda r: r['first_prediction_after_s']):>6.2f} "
+                    f"{med(lambda r: r['latencies'][0]) * 1000:>8.0f} "
+                    f"{med(lambda r: r['latencies'][1]) * 1000:>8.0f}"
+                )
+    finally:
+        if os.path.exists(cached):
+            os.remove(cached)
+        if os.path.exists(backup):
+            shutil.move(backup, cached)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""/predict/stream の計測 (ローカルの動画ファイルで確認する)
+
+動画ファイル (省略時は合成した MJPEG の .avi) をアプリのプロセス内 (test_client) で
+/predict/stream に流し、推論できたフレーム数・捨てたフレーム数・推論 fps と、
+フレームが読まれてから検出が返るまでのレイテンシ (p50 / p95) を出す。
+
+  file realtime : GET source=<動画>、動画の fps で読む (カメラと同じ。追いつかなければ捨てる)
+  file all      : GET source=<動画>&realtime=0、全フレームを推論する
+  upload        : POST 本文に JPEG を動画の fps で送り続ける (chunked アップロード)
+
+    python bench/bench_stream.py --app app3 --frames 150 --fps 30
+    python bench/bench_stream.py --app app --video site_a.mp4 --skip 1
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_video(path, frames, fps, size):
+    w, h = (int(v) for v in size.lower().split("x"))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (w, h))
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    for i in range(frames):
+        writer.write(np.roll(base, i * 8, axis=1))
+    writer.release()
+
+
+class PacedFrames(io.RawIOBase):
+    """JPEG を fps の速さで 1 枚ずつ返す本文 (カメラからのアップロードの代わり)"""
+
+    def __init__(self, jpegs, fps):
+        self.jpegs = list(jpegs)
+        self.interval = 1.0 / fps
+        self.started = None
+        self.index = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.index >= len(self.jpegs):
+            return b""
+        if self.started is None:
+            self.started = time.monotonic()
+        delay = self.started + self.index * self.interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        data = self.jpegs[self.index]
+        self.index += 1
+        return data
+
+
+def consume(resp):
+    """SSE を最後まで読み、(各フレームの latency_ms, end イベントの統計)"""
+    latencies, end, buf = [], None, ""
+    for chunk in resp.response:
+        buf += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while "\n\n" in buf:
+            block, buf = buf.split("\n\n", 1)
+            lines = dict(
+                line.split(": ", 1) for line in block.splitlines() if ": " in line
+            )
+            if lines.get("event") == "detections":
+                latencies.append(json.loads(lines["data"])["latency_ms"])
+            elif lines.get("event") == "end":
+                end = json.loads(lines["data"])
+            elif lines.get("event") == "error":
+                raise RuntimeError(lines["data"])
+    return latencies, end
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default="app3", choices=("app", "app2", "app3"))
+    parser.add_argument("--video", help="動画ファイル (省略時は合成)")
+    parser.add_argument("--frames", type=int, default=150, help="合成する動画のフレーム数")
+    parser.add_argument("--fps", type=float, default=30, help="合成する動画 / アップロードの fps")
+    parser.add_argument("--size", default="1920x1080", help="合成する動画の大きさ WxH")
+    parser.add_argument("--skip", type=int, default=0, help="N+1 枚に 1 枚だけ推論する")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    video = args.video
+    if video is None:
+        video = os.path.join(tmp, "bench.avi")
+        make_video(video, args.frames, args.fps, args.size)
+    video = os.path.abspath(video)
+
+    # 動画のあるディレクトリだけを読めるようにしてからアプリを読み込む
+    os.environ["STREAM_VIDEO_DIR"] = os.path.dirname(video)
+    mod = __import__(args.app)
+    client = mod.app.test_client()
+
+    cap = cv2.VideoCapture(video)
+    fps = cap.get(cv2.CAP_PROP_FPS) or args.fps
+    jpegs = []
+    while True:
+        ok, img = cap.read()
+        if not ok:
+            break
+        jpegs.append(cv2.imencode(".jpg", img)[1].tobytes())
+    cap.release()
+
+    print(f"app={args.app} video={os.path.basename(video)} frames={len(jpegs)} fps={fps:.1f}")
+    print(
+        f"{'mode':>14} {'inferred':>8} {'dropped':>7} {'skipped':>7} {'infer fps':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'wall s':>7}"
+    )
+    name = os.path.basename(video)
+    runs = [
+        ("file realtime", lambda: client.get(
+            f"/predict/stream?source={name}&skip={args.skip}", buffered=False)),
+        ("file all", lambda: client.get(
+            f"/predict/stream?source={name}&realtime=0&skip={args.skip}", buffered=False)),
+        # chunked アップロードと同じく、長さの分からない本文として渡す
+        ("upload", lambda: client.post(
+            f"/predict/stream?skip={args.skip}", content_type="image/jpeg", buffered=False,
+            environ_overrides={
+                "wsgi.input": PacedFrames(jpegs, fps), "wsgi.input_terminated": True,
+            })),
+    ]
+    try:
+        for label, request in runs:
+            t0 = time.perf_counter()
+            latencies, end = consume(request())
+            wall = time.perf_counter() - t0
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] if latencies else 0.0
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+            print(
+                f"{label:>14} {end['inferred']:>8} {end['dropped']:>7} {end['skipped']:>7} "
+                f"{end['fps']:>9.2f} {p50:>8.1f} {p95:>8.1f} {wall:>7.2f}"
+            )
+    finally:
+        if args.video is None:
+            os.remove(video)
+        os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
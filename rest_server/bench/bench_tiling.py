@@ -0,0 +1,94 @@
+"""タイル分割推論のレイテンシ計測
+
+画像サイズを変えてタイル数を増やしながら tiling.tiled_detect を実行し、
+タイル数ごとの 1 リクエスト分のレイテンシ (p50 / max) と 1 タイルあたりの時間を出す。
+比較用に従来どおり 1 枚に縮小して推論した場合 (tiles=1, resize) も測る。
+
+    python bench/bench_tiling.py --model best.onnx --repeat 5
+    python bench/bench_tiling.py --model best.onnx --sizes 1280x1280,6000x4000 --batch 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tiling import TILE_OVERLAP, TILE_SIZE, tile_grid, tiled_detect  # noqa: E402
+
+DEFAULT_SIZES = "1280x1280,2304x1280,2304x2304,3328x2304,4352x3328,6000x4000"
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return times[len(times) // 2], times[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="best.onnx")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="WxH をカンマ区切り")
+    parser.add_argument("--tile", type=int, default=TILE_SIZE)
+    parser.add_argument("--overlap", type=int, default=TILE_OVERLAP)
+    parser.add_argument("--batch", type=int, default=8, help="1 回の sess.run に載せるタイル数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    sess = ort.InferenceSession(
+        args.model,
+        providers=["CUDAExecutionProvider", "CPUExecutionProvider"]
+    )
+    input_name = sess.get_inputs()[0].name
+
+    def run(blob):
+        return sess.run(None, {input_name: blob})
+
+    rng = np.random.default_rng(0)
+    size = args.input_size
+
+    print(f"model={args.model} tile={args.tile} overlap={args.overlap} batch={args.batch}")
+    print(f"{'image':>11} {'mode':>7} {'tiles':>5} {'p50 ms':>9} {'max ms':>9} {'ms/tile':>8} {'dets':>6}")
+
+    for spec in args.sizes.split(","):
+        w, h = (int(v) for v in spec.lower().split("x"))
+        img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+        # 従来: 全体を 1 枚に縮小
+        def resized():
+            src = cv2.resize(img, (size, size))
+            rgb = cv2.cvtColor(src, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+            return run(np.ascontiguousarray(rgb.transpose(2, 0, 1))[None])
+
+        run(np.zeros((1, 3, size, size), np.float32))   # ウォームアップ
+        p50, worst = measure(resized, args.repeat)
+        print(f"{spec:>11} {'resize':>7} {1:>5} {p50 * 1000:>9.1f} {worst * 1000:>9.1f} {p50 * 1000:>8.1f} {'-':>6}")
+
+        result = {}
+
+        def tiled():
+            result["out"] = tiled_detect(
+                img, run, size,
+                tile=args.tile, overlap=args.overlap, max_batch_size=args.batch
+            )
+
+        n_tiles = len(tile_grid(w, h, args.tile, args.overlap))
+        p50, worst = measure(tiled, args.repeat)
+        dets = len(result["out"][1])
+        print(
+            f"{spec:>11} {'tiled':>7} {n_tiles:>5} {p50 * 1000:>9.1f} {worst * 1000:>9.1f} "
+            f"{p50 * 1000 / n_tiles:>8.1f} {dets:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
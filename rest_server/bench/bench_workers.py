@@ -0,0 +1,148 @@
+"""プロセスプール推論のスループット計測
+
+同じ JPEG を --concurrency 本のスレッドから投げ続け、ワーカー数ごとの
+スループット (枚/秒) とレイテンシ (p50 / p95) を出す。
+workers=0 は従来どおり 1 つのセッションをスレッドで共有する場合
+(デコード〜NMS がすべて GIL の下で動く)。
+fork 前にスレッドが残らないよう、ワーカー数ごとに別プロセスで測る。
+
+    python bench/bench_workers.py --model best.onnx --workers 0,1,2,4,8 --requests 200
+    python bench/bench_workers.py --model best.onnx --workers 0,4 --roi 0,0,2000,1500 --reduce
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocess import InputBuffers, input_dtype  # noqa: E402
+from workers import WorkerPool, detect_upload, session_options  # noqa: E402
+
+
+def make_jpeg(size):
+    w, h = (int(v) for v in size.lower().split("x"))
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    img = np.stack([
+        127 + 120 * np.sin(xx / 37.0), 127 + 120 * np.cos(yy / 23.0),
+        127 + 120 * np.sin((xx + yy) / 51.0)
+    ], axis=2).astype(np.uint8)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def child(args, workers):
+    """1 つのワーカー数だけを測って 1 行で出力する (別プロセス)"""
+    data = make_jpeg(args.size)
+    params = dict(fit="letterbox", reduce=args.reduce)
+    if args.roi:
+        x1, y1, x2, y2 = (int(v) for v in args.roi.split(","))
+        params.update(roi=(x1, y1, x2, y2), frame="roi")
+
+    if workers > 0:
+        pool = WorkerPool(
+            args.model, workers=workers, input_size=args.input_size,
+            intra_threads=args.intra_threads
+        )
+        while pool.stats()["ready"] < workers:
+            time.sleep(0.05)
+        detect = pool.detect
+        threads = pool.intra_threads
+    else:
+        threads = args.intra_threads or (os.cpu_count() or 1)
+        sess = ort.InferenceSession(
+            args.model,
+            sess_options=session_options(threads, 1),
+            providers=["CPUExecutionProvider"]
+        )
+        input_name = sess.get_inputs()[0].name
+        buffers = InputBuffers(args.input_size, dtype=input_dtype(sess))
+
+        def run(blob):
+            return sess.run(None, {input_name: blob})
+
+        def detect(data, **params):
+            return detect_upload(data, run, buffers, args.input_size, **params)
+
+    for _ in range(max(1, workers)):
+        detect(data, **params)   # ウォームアップ
+
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        t0 = time.perf_counter()
+        detect(data, **params)
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as ex:
+        list(ex.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - t0
+
+    if workers > 0:
+        pool.close()
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(threads, args.requests / elapsed, latencies[len(latencies) // 2], p95)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="best.onnx")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--size", default="4000x3000", help="送る JPEG の大きさ WxH")
+    parser.add_argument("--roi", help="x1,y1,x2,y2 (省略時は画像全体)")
+    parser.add_argument("--reduce", action="store_true", help="縮小デコードを使う")
+    parser.add_argument("--workers", default="0,1,2,4", help="ワーカー数をカンマ区切り (0 はスレッド)")
+    parser.add_argument("--intra-threads", type=int, default=0, help="0 なら コア数 / ワーカー数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に投げるスレッド数")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args, args.child)
+        return
+
+    print(
+        f"model={args.model} image={args.size} roi={args.roi or 'full'} "
+        f"reduce={args.reduce} concurrency={args.concurrency} cpus={os.cpu_count()}"
+    )
+    print(f"{'workers':>7} {'intra':>5} {'img/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'speedup':>8}")
+
+    common = [
+        "--model", args.model, "--input-size", str(args.input_size), "--size", args.size,
+        "--intra-threads", str(args.intra_threads), "--concurrency", str(args.concurrency),
+        "--requests", str(args.requests),
+    ]
+    if args.roi:
+        common += ["--roi", args.roi]
+    if args.reduce:
+        common.append("--reduce")
+
+    base = None
+    for workers in (int(v) for v in args.workers.split(",")):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *common, "--child", str(workers)],
+            check=True, capture_output=True, text=True
+        ).stdout.split()
+        threads, rate, p50, p95 = int(out[0]), float(out[1]), float(out[2]), float(out[3])
+        base = base or rate
+        label = "thread" if workers == 0 else str(workers)
+        print(
+            f"{label:>7} {threads:>5} {rate:>8.2f} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} "
+            f"{rate / base:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""実行プロファイル (FP32 / FP16 / INT8) の比較
+
+手元の画像フォルダを各プロファイルで推論し (デコード〜NMS、workers.detect_upload)、
+1 枚あたりのレイテンシと、FP32 に対する検出数の増減・一致度を出す。
+--labels に YOLO 形式のラベル (画像と同じ名前の .txt) があれば mAP@0.5 も、
+なければ FP32 の検出を正解とみなした mAP@0.5 を出す。
+
+    python profiles.py --model best.onnx --int8 static --calib calib/    # 先にモデルを作る
+    python bench/compare_profiles.py --model best.onnx --images site_a/ --labels site_a_labels/
+    python bench/compare_profiles.py --model best.onnx --images site_a/ --fit letterbox --opt-level extended
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocess import InputBuffers, input_dtype  # noqa: E402
+from profiles import calibration_images, create_session, profile_path  # noqa: E402
+from workers import detect_upload  # noqa: E402
+
+# アプリごとの NMS のしきい値 (score, nms)
+NMS_THRESHOLDS = {"letterbox": (0.3, 0.3), "stretch": (0.3, 0.5)}
+
+
+def iou_matrix(a, b):
+    """xywh 同士の IoU (len(a) x len(b))"""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.minimum(ax2[:, None], bx2[None]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    ih = np.minimum(ay2[:, None], by2[None]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def match(pred_boxes, pred_scores, gt_boxes, iou_thres):
+    """スコア順に貪欲に対応づけ、各予測が TP かどうかを返す"""
+    tp = np.zeros(len(pred_boxes), dtype=bool)
+    if len(pred_boxes) == 0 or len(gt_boxes) == 0:
+        return tp
+    ious = iou_matrix(pred_boxes, gt_boxes)
+    used = np.zeros(len(gt_boxes), dtype=bool)
+    for i in np.argsort(-np.asarray(pred_scores)):
+        cand = np.where(~used & (ious[i] >= iou_thres))[0]
+        if len(cand):
+            j = cand[np.argmax(ious[i, cand])]
+            used[j] = True
+            tp[i] = True
+    return tp
+
+
+def average_precision(preds, gts, n_classes, iou_thres=0.5):
+    """mAP (全点補間)。preds: [(boxes, scores, class_ids)]、gts: [(boxes, class_ids)] を画像ごとに"""
+    aps = []
+    for c in range(n_classes):
+        scores, flags, n_gt = [], [], 0
+        for (pb, ps, pc), (gb, gc) in zip(preds, gts):
+            pm, gm = pc == c, gc == c
+            n_gt += int(gm.sum())
+            scores.append(ps[pm])
+            flags.append(match(pb[pm], ps[pm], gb[gm], iou_thres))
+        if n_gt == 0:
+            continue
+        scores, flags = np.concatenate(scores), np.concatenate(flags)
+        order = np.argsort(-scores)
+        tp = np.cumsum(flags[order])
+        fp = np.cumsum(~flags[order])
+        recall = np.concatenate([[0.0], tp / n_gt, [1.0]])
+        precision = np.concatenate([[1.0], tp / np.maximum(tp + fp, 1), [0.0]])
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        aps.append(float(np.sum((recall[1:] - recall[:-1]) * precision[1:])))
+    return float(np.mean(aps)) if aps else float("nan")
+
+
+def load_labels(path, size):
+    """YOLO 形式 (class cx cy w h, 0〜1) を xywh 画素に"""
+    w, h = size
+    if not os.path.exists(path):
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    rows = np.loadtxt(path, ndmin=2)
+    if rows.size == 0:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    cx, cy, bw, bh = rows[:, 1] * w, rows[:, 2] * h, rows[:, 3] * w, rows[:, 4] * h
+    boxes = np.stack([cx - bw / 2, cy - bh / 2, bw, bh], axis=1)
+    return boxes, rows[:, 0].astype(np.int64)
+
+
+def run_profile(args, profile, images):
+    sess, loaded = create_session(
+        args.model, profile=profile, opt_level=args.opt_level,
+        providers=["CPUExecutionProvider"]
+    )
+    input_name = sess.get_inputs()[0].name
+    buffers = InputBuffers(args.input_size, dtype=input_dtype(sess))
+
+    def run(blob):
+        return sess.run(None, {input_name: blob})
+
+    score_thres, nms_thres = NMS_THRESHOLDS[args.fit]
+    params = dict(fit=args.fit, score_thres=score_thres, nms_thres=nms_thres)
+
+    detect_upload(images[0][1], run, buffers, args.input_size, **params)   # ウォームアップ
+    times, dets = [], []
+    for _, data in images:
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            d = detect_upload(data, run, buffers, args.input_size, **params)
+            times.append(time.perf_counter() - t0)
+        dets.append(d)
+    return loaded, np.sort(times), dets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="best.onnx")
+    parser.add_argument("--images", required=True, help="比較に使う画像フォルダ")
+    parser.add_argument("--labels", help="YOLO 形式のラベルフォルダ (省略時は FP32 を正解とみなす)")
+    parser.add_argument("--profiles", default="fp32,fp16,int8")
+    parser.add_argument("--fit", choices=("stretch", "letterbox"), default="stretch")
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--opt-level", default="all")
+    parser.add_argument("--names", default="pipe,muku")
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=1, help="1 枚あたりの計測回数")
+    args = parser.parse_args()
+
+    names = args.names.split(",")
+    images = []
+    for path in calibration_images(args.images):
+        with open(path, "rb") as f:
+            images.append((path, f.read()))
+
+    profiles = [p for p in args.profiles.split(",") if os.path.exists(profile_path(args.model, p))]
+    if "fp32" not in profiles:
+        profiles.insert(0, "fp32")
+    skipped = set(args.profiles.split(",")) - set(profiles)
+    if skipped:
+        print(f"skipped (model not built): {', '.join(sorted(skipped))}")
+
+    results = {p: run_profile(args, p, images) for p in profiles}
+
+    def as_preds(dets):
+        return [(d.boxes, d.scores, d.class_ids) for d in dets]
+
+    ref = results["fp32"][2]
+    if args.labels:
+        gts = []
+        for (path, _), d in zip(images, ref):
+            stem = os.path.splitext(os.path.basename(path))[0]
+            gts.append(load_labels(os.path.join(args.labels, stem + ".txt"), d.orig_size))
+        map_label = "mAP50"
+    else:
+        gts = [(d.boxes, d.class_ids) for d in ref]
+        map_label = "mAP50 vs fp32"
+
+    print(f"images={len(images)} fit={args.fit} input={args.input_size} opt={args.opt_level}")
+    print(
+        f"{'profile':>7} {'MiB':>6} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>8} {'dets':>6} "
+        f"{'Δdets':>7} {'F1 vs fp32':>10} {map_label:>14}  counts"
+    )
+    base_p50 = np.median(results["fp32"][1])
+    base_dets = sum(len(d.boxes) for d in ref)
+    for profile in profiles:
+        loaded, times, dets = results[profile]
+        n = sum(len(d.boxes) for d in dets)
+
+        # FP32 との一致度 (クラスも同じで IoU >= --iou)
+        tp = sum(
+            int(match(d.boxes[d.class_ids == c], d.scores[d.class_ids == c],
+                      r.boxes[r.class_ids == c], args.iou).sum())
+            for d, r in zip(dets, ref) for c in range(len(names))
+        )
+        f1 = 2 * tp / (n + base_dets) if n + base_dets else 1.0
+        m = average_precision(as_preds(dets), gts, len(names), args.iou)
+        counts = {
+            name: int(sum(np.count_nonzero(d.class_ids == i) for d in dets))
+            for i, name in enumerate(names)
+        }
+        p50 = np.median(times)
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        delta = (n - base_dets) / base_dets * 100 if base_dets else 0.0
+        print(
+            f"{profile:>7} {os.path.getsize(loaded) / 2**20:>6.1f} {p50 * 1000:>8.1f} "
+            f"{p95 * 1000:>8.1f} {base_p50 / p50:>7.2f}x {n:>6} {delta:>+6.1f}% "
+            f"{f1:>10.3f} {m:>14.3f}  {counts}"
+        )
+
+
+if __name__ == "__main__":
+    main()
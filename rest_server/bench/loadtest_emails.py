@@ -0,0 +1,98 @@
+"""emails API 負荷テスト
+
+ローカルの PostgreSQL に対して、リクエストごとに接続する旧方式と
+db.pool を使う新方式のスループット (req/s) を比較する。
+
+    # DB 層だけを比較 (接続毎回 vs プール)
+    python bench/loadtest_emails.py db --threads 16 --duration 10
+
+    # 起動中のサーバーに GET /emails を投げる (変更前後のサーバーでそれぞれ実行)
+    python bench/loadtest_emails.py http --url http://localhost:5000/emails
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import RealDictCursor  # noqa: E402
+
+from db import ConnectionPool, get_connection  # noqa: E402
+
+QUERY = "SELECT * FROM emails ORDER BY id;"
+
+
+def query_direct():
+    conn = get_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(QUERY)
+    cur.fetchall()
+    cur.close()
+    conn.close()
+
+
+def make_query_pooled(pool):
+    def query_pooled():
+        with pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(QUERY)
+                cur.fetchall()
+    return query_pooled
+
+
+def make_http(url):
+    def get():
+        with urllib.request.urlopen(url) as res:
+            res.read()
+    return get
+
+
+def run(fn, threads, duration):
+    stop = time.monotonic() + duration
+    counts = [0] * threads
+    errors = [0] * threads
+
+    def worker(i):
+        while time.monotonic() < stop:
+            try:
+                fn()
+                counts[i] += 1
+            except Exception:
+                errors[i] += 1
+
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    t0 = time.monotonic()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.monotonic() - t0
+    return sum(counts) / elapsed, sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["db", "http"])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--url", default="http://localhost:5000/emails")
+    args = parser.parse_args()
+
+    if args.mode == "http":
+        rps, errors = run(make_http(args.url), args.threads, args.duration)
+        print(f"http  {args.url}  threads={args.threads}  {rps:8.1f} req/s  errors={errors}")
+        return
+
+    pool = ConnectionPool(max_size=args.pool_size)
+    for name, fn in [("direct", query_direct), ("pooled", make_query_pooled(pool))]:
+        rps, errors = run(fn, args.threads, args.duration)
+        print(f"{name:7s} threads={args.threads}  {rps:8.1f} req/s  errors={errors}")
+    pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# =====================
+# 推論結果キャッシュ (LRU・メモリ上限つき)
+# =====================
+# ROI の調整や Box / Label の切り替えで同じ写真が何度も /predict に送られるので、
+# NMS 後の検出結果を (画像の内容ハッシュ, ROI, モデルファイルのハッシュ, 推論オプション)
+# をキーに保存しておき、ヒットしたら推論 (と JSON 応答ならデコードも) を省く。
+# 表示指定 (classes[]) はキーに含めないので、切り替えは描画し直すだけになる。
+
+PREDICT_CACHE_MB = float(os.environ.get("PREDICT_CACHE_MB", "64"))
+
+ENTRY_OVERHEAD = 512    # 配列以外 (キー・タプル・dict の枠) の概算バイト数
+
+
+class Detections(namedtuple(
+    "Detections", "boxes scores class_ids n_tiles factor orig_size"
+)):
+    """NMS 後の検出
+
+    boxes / scores / class_ids はそのアプリの描画座標 (縮小デコード時は縮小後の画素)。
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_nms(cls, boxes, scores, class_ids, indices, n_tiles=1, factor=1,
+                 orig_size=None):
+        keep = np.asarray(indices, dtype=np.int64).reshape(-1)
+        return cls(
+            np.asarray(boxes, dtype=np.int64).reshape(-1, 4)[keep],
+            np.asarray(scores, dtype=np.float64).reshape(-1)[keep],
+            np.asarray(class_ids, dtype=np.int64).reshape(-1)[keep],
+            n_tiles, factor, orig_size,
+        )
+
+    def unpack(self):
+        """(boxes, scores, class_ids, indices)。NMS 済みなので indices は全件"""
+        return (
+            self.boxes.tolist(), self.scores.tolist(), self.class_ids.tolist(),
+            np.arange(len(self.boxes)),
+        )
+
+
+def model_hash(path):
+    """モデルファイルの内容ハッシュ (差し替えたら別キーになる)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def cache_key(img_bytes, model, *options):
+    """画像の内容とモデル・ROI・推論オプションからキーを作る"""
+    h = hashlib.blake2b(img_bytes, digest_size=16)
+    h.update(repr((model,) + options).encode())
+    return h.digest()
+
+
+def _nbytes(value):
+    if not isinstance(value, Detections):
+        # 複数 ROI の検出 (Detections のタプル)
+        return ENTRY_OVERHEAD + sum(_nbytes(v) for v in value)
+    return ENTRY_OVERHEAD + sum(v.nbytes for v in value if isinstance(v, np.ndarray))
+
+
+class DetectionCache:
+
+    def __init__(self, max_mb=PREDICT_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._items = OrderedDict()    # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+
+            # 上限を超えたら古いものから捨てる
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
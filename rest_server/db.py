@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS
+
+# =====================
+# DB設定
+# =====================
+DB_CONFIG = {
+    "dbname": os.environ.get("PGDATABASE", "app_01"),
+    "user": os.environ.get("PGUSER", "postgres"),
+    "password": os.environ.get("PGPASSWORD", "tankei001"),
+    "host": os.environ.get("PGHOST", "localhost"),
+    "port": os.environ.get("PGPORT", "5432"),
+}
+
+# プール設定
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+POOL_MAX_AGE = float(os.environ.get("DB_POOL_MAX_AGE", "600"))        # 秒: これより古い接続は作り直す
+POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))   # 秒: これ以上遊んでいた接続は SELECT 1 で確認
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))         # 秒: 空き待ちの上限
+
+
+# 単発接続（LISTEN 専用など、プールに戻さない用途）
+def get_connection():
+    return psycopg2.connect(**DB_CONFIG)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# =====================
+# スレッドセーフな接続プール
+# =====================
+class ConnectionPool:
+
+    def __init__(self, max_size=POOL_MAX_SIZE, max_age=POOL_MAX_AGE,
+                 check_idle=POOL_CHECK_IDLE, timeout=POOL_TIMEOUT, **dsn):
+        self.dsn = dsn or DB_CONFIG
+        self.max_size = max_size
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self.timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = deque()      # (conn, 返却時刻)
+        self._created = {}        # conn -> 作成時刻
+        self._closed = False
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.dsn)
+        with self._lock:
+            self._created[conn] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn, now):
+        return now - self._created.get(conn, now) > self.max_age
+
+    def _healthy(self, conn, idle_since, now):
+        if conn.closed:
+            return False
+        if now - idle_since < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # --------------------
+    # 取得 / 返却
+    # --------------------
+    def getconn(self):
+        if self._closed:
+            raise PoolTimeout("pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"no connection available within {self.timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect()
+
+                conn, idle_since = item
+                now = time.monotonic()
+                if self._expired(conn, now) or not self._healthy(conn, idle_since, now):
+                    self._discard(conn)
+                    continue
+                return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, discard=False):
+        try:
+            if not discard and not conn.closed and not self._closed:
+                status = conn.info.transaction_status
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if not self._expired(conn, time.monotonic()):
+                    with self._lock:
+                        self._idle.append((conn, time.monotonic()))
+                    return
+            self._discard(conn)
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        # 空き待ちと、借りてから返すまで (問い合わせ〜commit) の時間を /metrics に積む
+        t0 = time.perf_counter()
+        conn = self.getconn()
+        acquired = time.perf_counter()
+        DB_WAIT_SECONDS.observe(acquired - t0)
+        discard = False
+        try:
+            yield conn
+        except psycopg2.Error:
+            # 接続が壊れている可能性があるので捨てる
+            discard = conn.closed != 0
+            raise
+        finally:
+            # ストリーミング中の切断 (GeneratorExit) でも必ず返却する
+            self.putconn(conn, discard=discard)
+            DB_QUERY_SECONDS.observe(time.perf_counter() - acquired)
+
+    def closeall(self):
+        self._closed = True
+        with self._lock:
+            items = list(self._idle)
+            self._idle.clear()
+        for conn, _ in items:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "open": len(self._created),
+                "idle": len(self._idle),
+            }
+
+
+pool = ConnectionPool()
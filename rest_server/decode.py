@@ -0,0 +1,155 @@
+import math
+import os
+
+import cv2
+import numpy as np
+
+# =====================
+# 縮小デコード (JPEG)
+# =====================
+# モデルに入るのは 1280 px なので、24 MP の写真を毎回フル解像度で展開する必要はない。
+# libjpeg は DCT の段階で 1/2・1/4・1/8 に縮小しながら展開できる (IMREAD_REDUCED_COLOR_*)。
+# JPEG のヘッダーから画像サイズだけ先に読み、ROI がモデル入力を下回らない範囲で
+# いちばん小さい倍率を選ぶ。
+#
+# 倍率 f で展開した画像の画素 (x, y) は元画像の (x * f, y * f) にあたる。
+
+DECODE_REDUCED = os.environ.get("DECODE_REDUCED", "1") == "1"
+
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# 画像サイズを持つ SOF マーカー (DHT / JPG / DAC を除く C0〜CF)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data):
+    """JPEG のヘッダーから (w, h)。JPEG でなければ None"""
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    i, n = 2, len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:                       # 詰め物
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            h = int.from_bytes(data[i + 5:i + 7], "big")
+            w = int.from_bytes(data[i + 7:i + 9], "big")
+            return (w, h) if w and h else None
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def jpeg_end(data, start=0):
+    """data[start:] の JPEG 1 枚が終わる位置 (EOI の直後)。まだ揃っていなければ None
+
+    連結された JPEG (MJPEG) を 1 枚ずつ切り出すのに使う。セグメント長を辿るので、
+    EXIF サムネイルの中の EOI では切れない。JPEG として壊れていれば ValueError。
+    """
+    if data[start:start + 2] != b"\xff\xd8":
+        raise ValueError("not a jpeg")
+
+    i, n = start + 2, len(data)
+    while i + 2 <= n:
+        if data[i] != 0xFF:
+            raise ValueError("corrupt jpeg")
+        marker = data[i + 1]
+        if marker == 0xFF:                       # 詰め物
+            i += 1
+            continue
+        if marker == 0xD9:                       # EOI
+            return i + 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if i + 4 > n:
+            return None
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+        if marker != 0xDA:
+            continue
+
+        # SOS の後はエントロピー符号。FF00 (バイト詰め) と RST 以外の FFxx が次のマーカー
+        while True:
+            i = data.find(b"\xff", i)
+            if i < 0 or i + 1 >= n:
+                return None
+            following = data[i + 1]
+            if following == 0x00 or 0xD0 <= following <= 0xD7:
+                i += 2
+            elif following == 0xFF:
+                i += 1
+            else:
+                break
+    return None
+
+
+def pick_factor(roi_w, roi_h, input_size, letterbox=False):
+    """ROI が input_size を下回らない最大の縮小倍率 (1 / 2 / 4 / 8)
+
+    letterbox は長辺を input_size に合わせるので長辺で、
+    引き伸ばし (app2 / app3) は両辺とも input_size になるので短辺で判定する。
+    """
+    side = max(roi_w, roi_h) if letterbox else min(roi_w, roi_h)
+    for factor in (8, 4, 2):
+        if side / factor >= input_size:
+            return factor
+    return 1
+
+
+def decode_upload(data, roi_size=None, input_size=1280, letterbox=False, reduce=True):
+    """アップロードされた画像を必要な解像度で展開する
+
+    roi_size=(w, h) は要求された ROI の大きさ (元画像の画素)。省略時は画像全体。
+    戻り値: (img, factor, (元画像の w, h))。展開できなければ img は None。
+    """
+    size = jpeg_size(data) if reduce and DECODE_REDUCED else None
+
+    factor = 1
+    if size is not None:
+        w, h = roi_size or size
+        longest = max(size)
+        factor = pick_factor(min(w, longest), min(h, longest), input_size, letterbox)
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), DECODE_FLAGS[factor])
+    if img is None:
+        return None, factor, None
+
+    img_h, img_w = img.shape[:2]
+    if factor == 1:
+        return img, 1, (img_w, img_h)
+
+    w, h = size
+    if (img_w, img_h) != (math.ceil(w / factor), math.ceil(h / factor)):
+        # EXIF の向き補正で縦横が入れ替わっている
+        w, h = h, w
+    return img, factor, (w, h)
+
+
+def clip_roi(roi, size):
+    """ROI (x1, y1, x2, y2) を画像 size=(w, h) の内側に収める。空になれば None"""
+    w, h = size
+    x1, y1, x2, y2 = roi
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(w, x2), min(h, y2)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return x1, y1, x2, y2
+
+
+def reduce_roi(roi, factor):
+    """元画像の ROI (x1, y1, x2, y2) → 倍率 factor で展開した画像上の ROI"""
+    x1, y1, x2, y2 = roi
+    return x1 // factor, y1 // factor, -(-x2 // factor), -(-y2 // factor)
@@ -0,0 +1,257 @@
+import base64
+import logging
+from collections import defaultdict
+
+import cv2
+import numpy as np
+from flask import Response, jsonify
+
+from metrics import LOG_BOXES
+
+try:
+    import msgpack
+except ImportError:          # msgpack 応答を使わないなら不要
+    msgpack = None
+
+# =====================
+# /predict の応答形式
+# =====================
+# image   : 従来どおりサーバーで描画した画像 (app.py は JSON + base64、app2/app3 は JPEG)
+# json    : 検出結果だけを返す。描画は Nuxt の canvas 側で行う
+# msgpack : json と同じ内容を MessagePack で返す (プレビューは base64 ではなく bytes)
+#
+# フォーム (またはクエリ) の response=json|msgpack で選ぶ。
+# Accept: application/msgpack でも msgpack になる。
+#
+# preview=<長辺の画素数> を付けると、縮小した画像に枠だけ描いたプレビューを添える。
+# preview_format=webp|jpeg (既定 webp)。
+
+RESPONSE_MODES = ("image", "json", "msgpack")
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+PREVIEW_FORMATS = {
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY, "image/webp"),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, "image/jpeg"),
+}
+PREVIEW_QUALITY = 80
+
+log = logging.getLogger(__name__)
+
+
+def _param(req, name):
+    return req.form.get(name) or req.args.get(name)
+
+
+def response_mode(req):
+    """リクエストから応答形式を決める。不明な値は ValueError"""
+    mode = _param(req, "response")
+    if not mode:
+        accept = req.headers.get("Accept", "")
+        return "msgpack" if any(t in accept for t in MSGPACK_TYPES) else "image"
+    if mode not in RESPONSE_MODES:
+        raise ValueError(f"response must be one of {', '.join(RESPONSE_MODES)}")
+    if mode == "msgpack" and msgpack is None:
+        raise ValueError("msgpack is not installed on the server")
+    return mode
+
+
+def preview_options(req):
+    """(長辺の画素数 or None, 形式)。不正な値は ValueError"""
+    size = _param(req, "preview")
+    fmt = _param(req, "preview_format") or "webp"
+    if fmt not in PREVIEW_FORMATS:
+        raise ValueError("preview_format must be webp or jpeg")
+    if not size:
+        return None, fmt
+    try:
+        size = int(size)
+    except ValueError:
+        raise ValueError("preview must be an integer")
+    if size <= 0:
+        raise ValueError("preview must be positive")
+    return size, fmt
+
+
+def build_result(boxes, scores, class_ids, keep, names, image_size, offset=(0, 0),
+                 scale=1):
+    """NMS 後の検出を応答用の dict にする
+
+    boxes は [x, y, w, h]。offset (ROI 左上など) を足し、縮小デコードした場合は
+    その倍率 scale を掛けて、アップロードされた画像の座標で返す。
+    """
+    keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+    kept = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)[keep]
+    kept[:, 0] += offset[0]
+    kept[:, 1] += offset[1]
+    kept *= scale
+    ids = np.asarray(class_ids, dtype=np.int64).reshape(-1)[keep]
+    kept_scores = np.asarray(scores, dtype=np.float64).reshape(-1)[keep]
+
+    return {
+        "image_size": list(image_size),
+        "boxes": kept.tolist(),
+        "classes": [names[i] for i in ids],
+        "class_ids": ids.tolist(),
+        "scores": np.round(kept_scores, 4).tolist(),
+        "counts": {
+            name: int(np.count_nonzero(ids == i)) for i, name in enumerate(names)
+        },
+    }
+
+
+def roi_counts(detections, rois, names):
+    """ROI ごとの件数 [{"id": ..., "counts": {クラス名: 件数}}, ...]"""
+    return [
+        {
+            "id": roi.id,
+            "counts": {
+                name: int(np.count_nonzero(det.class_ids == i)) for i, name in enumerate(names)
+            },
+        }
+        for roi, det in zip(rois, detections)
+    ]
+
+
+def build_rois_result(detections, rois, names, image_size, scale=1):
+    """複数 ROI の検出 (workers.detect_rois) を応答用の dict にする
+
+    ROI ごとに build_result と同じ項目と id / roi (/ polygon) を持ち、
+    counts には全 ROI の合計を入れる。座標はアップロードされた画像の座標。
+    """
+    items = []
+    totals = dict.fromkeys(names, 0)
+    for roi, det in zip(rois, detections):
+        item = {"id": roi.id, "roi": list(roi.box)}
+        if roi.polygon is not None:
+            item["polygon"] = [list(p) for p in roi.polygon]
+        boxes, scores, class_ids, keep = det.unpack()
+        item.update(build_result(boxes, scores, class_ids, keep, names, image_size, scale=scale))
+        del item["image_size"]
+        item["tiles"] = det.n_tiles
+        for name, n in item["counts"].items():
+            totals[name] += n
+        items.append(item)
+
+    return {"image_size": list(image_size), "counts": totals, "rois": items}
+
+
+def render_preview(img, boxes, max_side, fmt="webp", origin=(0, 0), factor=1):
+    """img を長辺 max_side に縮小し、枠だけ描いてエンコードした bytes
+
+    boxes は build_result の boxes (アップロード画像の座標)、
+    origin は img の左上がその座標系のどこにあたるか (ROI 左上)、
+    factor は img を縮小デコードした倍率。
+    """
+    h, w = img.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    box_scale = scale / factor
+    if scale < 1.0:
+        small = cv2.resize(
+            img, (max(1, round(w * scale)), max(1, round(h * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+    else:
+        small = img.copy()
+
+    for x, y, w_box, h_box in boxes:
+        p1 = (int((x - origin[0]) * box_scale), int((y - origin[1]) * box_scale))
+        p2 = (
+            int((x - origin[0] + w_box) * box_scale),
+            int((y - origin[1] + h_box) * box_scale),
+        )
+        cv2.rectangle(small, p1, p2, (0, 255, 0), 1)
+
+    ext, flag, _ = PREVIEW_FORMATS[fmt]
+    _, buf = cv2.imencode(ext, small, [flag, PREVIEW_QUALITY])
+    return buf.tobytes()
+
+
+# =====================
+# response=image の描画
+# =====================
+def draw_markers(img, boxes, scores, class_ids, keep, names, display=()):
+    """クラスごとに数えながら描く (プリセット app)。(描いた画像, {クラス名: 件数})
+
+    display に "Box" / "Label" があれば枠・ラベル、どちらもなければ中心に丸。
+    文字や丸の大きさは画像の長辺 640 px を基準に合わせる。
+    """
+    img_draw = img.copy()
+    counts = defaultdict(int)
+
+    h, w = img_draw.shape[:2]
+    scale = max(w, h) / 640.0
+    font_scale = 0.6 * scale
+    font_thickness = max(1, int(2 * scale * 0.8))
+    box_thickness = max(1, int(2 * scale))
+    circle_radius = max(3, int(5 * scale))
+
+    for i in keep:
+        x, y, w_box, h_box = boxes[i]
+        cls = class_ids[i]
+        counts[names[cls]] += 1
+
+        if "Box" in display:
+            cv2.rectangle(img_draw, (x, y), (x + w_box, y + h_box), (0, 255, 0), box_thickness)
+        if "Label" in display:
+            cv2.putText(
+                img_draw, f"{names[cls]} {scores[i] * 100:.1f}%",
+                (x, max(int(20 * scale), y - int(5 * scale))),
+                cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 255, 0), font_thickness,
+                cv2.LINE_AA
+            )
+        if len(display) == 0:
+            color = (0, 0, 255) if cls == 0 else (255, 0, 0)
+            cv2.circle(img_draw, (x + w_box // 2, y + h_box // 2), circle_radius, color, -1)
+
+    return img_draw, counts
+
+
+def draw_labels(img, boxes, scores, class_ids, keep, names):
+    """枠と「クラス名 スコア%」を描く (プリセット app2 / app3)"""
+    img_draw = img.copy()
+    for i in keep:
+        x, y, w_box, h_box = boxes[i]
+        cls = class_ids[i]
+        cv2.rectangle(img_draw, (x, y), (x + w_box, y + h_box), (0, 255, 0), 2)
+        cv2.putText(
+            img_draw, f"{names[cls]} {scores[i] * 100:.1f}%", (x, max(20, y - 5)),
+            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2
+        )
+        if LOG_BOXES:
+            log.info(
+                "draw %s %.3f %d %d %d %d", names[cls], scores[i], x, y, x + w_box, y + h_box
+            )
+    return img_draw
+
+
+def draw_rois(img, rois, factor=1, color=(255, 128, 0)):
+    """ROI の枠 (多角形はその形) を img に直接描く。factor は img を縮小デコードした倍率"""
+    thickness = max(1, int(2 * max(img.shape[:2]) / 640.0))
+    for roi in rois:
+        if roi.polygon is not None:
+            points = np.array([(x // factor, y // factor) for x, y in roi.polygon], np.int32)
+            cv2.polylines(img, [points], True, color, thickness)
+        else:
+            x1, y1, x2, y2 = roi.box
+            cv2.rectangle(
+                img, (x1 // factor, y1 // factor), (x2 // factor, y2 // factor), color, thickness
+            )
+    return img
+
+
+def detections_response(result, mode, preview=None, preview_format="webp"):
+    """build_result の dict を json / msgpack で返す"""
+    if preview is not None:
+        result["preview_format"] = preview_format
+
+    if mode == "msgpack":
+        if preview is not None:
+            result["preview"] = preview
+        return Response(
+            msgpack.packb(result, use_bin_type=True),
+            mimetype="application/msgpack"
+        )
+
+    if preview is not None:
+        result["preview"] = base64.b64encode(preview).decode("ascii")
+    return jsonify(result)
@@ -0,0 +1,239 @@
+from flask import Blueprint, Response, request, jsonify
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import pool
+from emails_query import (
+    EXPORT_BATCH, EXPORT_FORMATS, PageQuery, bulk_delete_ids, bulk_insert_rows,
+    bulk_notify_payload, bulk_update_rows, format_export_batch, is_page_request,
+    parse_bulk_body, parse_fields, to_csv
+)
+from listener import (
+    SSE_COALESCE_MS, SSE_KEEPALIVE, SSE_LOG_SIZE, SSE_MAX_PENDING, NotifyListener, Resync,
+    register_client_gauge
+)
+
+# =====================
+# emails API (app2.py / app3.py 共通)
+# =====================
+emails_bp = Blueprint("emails", __name__)
+
+
+def fetch_emails():
+    with pool.connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM emails ORDER BY id;")
+            return cur.fetchall()
+
+def fetch_email(id):
+    with pool.connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM emails WHERE id=%s;", (id,))
+            return cur.fetchone()
+
+# 1 本の LISTEN 接続を全 SSE クライアントで共有
+listener = NotifyListener(
+    "emails_channel", fetch_emails,
+    fetch_row=fetch_email,
+    max_pending=SSE_MAX_PENDING,
+    log_size=SSE_LOG_SIZE,
+    coalesce_ms=SSE_COALESCE_MS
+)
+register_client_gauge(listener)
+
+# SSE用ジェネレーター（クライアントごとにキュー 1 つ）
+#   delta=False: 変更のたびに全件 (data: [...])
+#   delta=True:  snapshot → insert / update / delete (seq 付き)、取りこぼし時は resync
+# 再接続時の Last-Event-ID がリングバッファ内なら差分だけを再送する
+def event_stream(delta=False, last_event_id=None):
+    sub = listener.subscribe(delta=delta)
+    last_seq = listener.parse_event_id(last_event_id)
+    try:
+        if delta:
+            missed = None
+            if last_seq is not None:
+                missed = listener.replay(last_seq, sub.start_seq)
+            if missed is None:
+                yield listener.snapshot_event("snapshot", sub.start_seq)
+            else:
+                yield from missed
+        elif last_event_id is not None and last_seq != sub.start_seq:
+            yield listener.full_event()
+
+        while True:
+            message = sub.get(timeout=SSE_KEEPALIVE)
+            if message is None:
+                if sub.closed:
+                    return
+                # 切断検知用のコメント行
+                yield ": keepalive\n\n"
+                continue
+            if isinstance(message, Resync):
+                yield listener.snapshot_event("resync", message.seq)
+                continue
+            yield message
+    finally:
+        listener.unsubscribe(sub)
+
+def fetch_email_page(page):
+    query, params = page.sql()
+    with pool.connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, params)
+            return page.response(cur.fetchall())
+
+# limit / cursor / fields / name / email が付いていればキーセットページング
+@emails_bp.route('/emails')
+def get_emails():
+    if not is_page_request(request.args):
+        return jsonify(fetch_emails())
+    try:
+        page = PageQuery.from_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(fetch_email_page(page))
+
+# =====================
+# 一括更新 (JSON 配列 / NDJSON)
+# =====================
+# 1 トランザクションで COPY / execute_values / ANY() を使って書き込む。
+# SET LOCAL emails.bulk で行ごとのトリガー通知を止め、最後に 1 回だけ通知する。
+def bulk_write(action, rows):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL emails.bulk = 'on'")
+            if action == "insert":
+                cur.copy_expert(
+                    "COPY emails (name, email) FROM STDIN WITH (FORMAT csv)",
+                    to_csv(rows)
+                )
+                count = len(rows)
+            elif action == "update":
+                updated = execute_values(
+                    cur,
+                    "UPDATE emails SET name=v.name, email=v.email "
+                    "FROM (VALUES %s) AS v(id, name, email) "
+                    "WHERE emails.id = v.id RETURNING emails.id",
+                    rows, page_size=1000, fetch=True
+                )
+                count = len(updated)
+            else:
+                cur.execute("DELETE FROM emails WHERE id = ANY(%s)", (rows,))
+                count = cur.rowcount
+            cur.execute(
+                "SELECT pg_notify('emails_channel', %s)",
+                (bulk_notify_payload(action, count),)
+            )
+        conn.commit()
+    return count
+
+BULK_ACTIONS = {
+    "POST": ("insert", bulk_insert_rows),
+    "PUT": ("update", bulk_update_rows),
+    "DELETE": ("delete", bulk_delete_ids),
+}
+
+@emails_bp.route('/emails/bulk', methods=['POST', 'PUT', 'DELETE'])
+def bulk():
+    action, to_rows = BULK_ACTIONS[request.method]
+    try:
+        items = parse_bulk_body(request.get_data(), request.content_type)
+        rows = to_rows(items)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    count = bulk_write(action, rows)
+    status = 201 if action == "insert" else 200
+    return jsonify({"status": "ok", action: count}), status
+
+# =====================
+# エクスポート (NDJSON / CSV)
+# =====================
+# サーバーサイドカーソル (名前付きカーソル) で EXPORT_BATCH 行ずつ取り出して
+# そのまま流すので、テーブルの大きさに関係なくメモリ使用量は一定。
+
+def export_emails(fields, fmt):
+    with pool.connection() as conn:
+        with conn.cursor(name="emails_export") as cur:
+            cur.itersize = EXPORT_BATCH
+            cur.execute(f"SELECT {', '.join(fields)} FROM emails ORDER BY id;")
+            header = True
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH)
+                if not rows and not header:
+                    break
+                yield format_export_batch(rows, fields, fmt, header=header)
+                header = False
+
+@emails_bp.route('/emails/export')
+def export():
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return Response(
+        export_emails(fields, fmt),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=emails.{fmt}"}
+    )
+
+@emails_bp.route('/emails/stream')
+def stream_emails():
+    delta = request.args.get("mode") == "delta"
+    # EventSource は再接続時に Last-Event-ID ヘッダーを自動で付ける
+    last_event_id = (
+        request.headers.get("Last-Event-ID")
+        or request.args.get("last_event_id")
+    )
+    return Response(
+        event_stream(delta, last_event_id),
+        mimetype="text/event-stream"
+    )
+
+@emails_bp.route('/emails', methods=['POST'])
+def add_email():
+    payload = request.json
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO emails (name,email) VALUES (%s,%s)",
+                (payload['name'], payload['email'])
+            )
+        conn.commit()
+    return jsonify({"status": "ok"}), 201
+
+
+##更新
+@emails_bp.route('/emails/<int:id>', methods=['PUT'])
+def update_email(id):
+    payload = request.json
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE emails SET name=%s, email=%s WHERE id=%s",
+                (payload.get('name'), payload.get('email'), id)
+            )
+        conn.commit()
+    return jsonify({"status": "ok"})
+
+#削除
+@emails_bp.route('/emails/<int:id>', methods=['DELETE'])
+def delete_email(id):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM emails WHERE id=%s", (id,))
+        conn.commit()
+    return jsonify({"status": "ok"})
+
+# プールの状態
+@emails_bp.route('/db/stats')
+def pool_stats():
+    return jsonify(pool.stats())
+
+# SSE の状態
+@emails_bp.route('/emails/stream/stats')
+def stream_stats():
+    return jsonify(listener.stats())
@@ -0,0 +1,229 @@
+import base64
+import csv
+import io
+import json
+import os
+
+# =====================
+# GET /emails のページング・列指定・絞り込み
+# =====================
+# OFFSET は使わず id のキーセットで次ページを取る:
+#   SELECT <fields> FROM emails WHERE id > <cursor> [AND name = ..] ORDER BY id LIMIT n+1
+# emails.py (psycopg2) と app_async.py (asyncpg) で共用する。
+#
+# エクスポート (GET /emails/export) の NDJSON / CSV 整形と、
+# 一括更新 (/emails/bulk) の入力チェックもここに置く。
+
+COLUMNS = ("id", "name", "email")
+FILTERS = ("name", "email")      # 完全一致 (インデックスは real_time_postgres.md 参照)
+
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 1000
+
+# これらのどれかが付いていればページング形式で返す (無ければ従来どおり全件の配列)
+PAGE_PARAMS = ("limit", "cursor", "fields") + FILTERS
+
+
+def is_page_request(args):
+    return any(k in args for k in PAGE_PARAMS)
+
+
+def parse_fields(value, require_id=False):
+    """"id,email" → ["id", "email"]。未指定なら全列、未知の列は ValueError"""
+    if not value:
+        return list(COLUMNS)
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    if require_id and "id" not in fields:
+        fields.insert(0, "id")
+    return fields
+
+
+def encode_cursor(last_id):
+    raw = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        last_id = json.loads(raw)["id"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("invalid cursor")
+    if not isinstance(last_id, int):
+        raise ValueError("invalid cursor")
+    return last_id
+
+
+class PageQuery:
+
+    def __init__(self, fields, filters, after_id, limit):
+        self.fields = fields
+        self.filters = filters
+        self.after_id = after_id
+        self.limit = limit
+
+    @classmethod
+    def from_args(cls, args):
+        """クエリ文字列 (dict 風) から作る。不正な値は ValueError"""
+        try:
+            limit = int(args.get("limit", PAGE_DEFAULT_LIMIT))
+        except (TypeError, ValueError):
+            raise ValueError("invalid limit")
+        if not 1 <= limit <= PAGE_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {PAGE_MAX_LIMIT}")
+
+        # id は次ページのカーソルに必要なので必ず含める
+        fields = parse_fields(args.get("fields"), require_id=True)
+
+        cursor = args.get("cursor")
+        after_id = decode_cursor(cursor) if cursor else None
+
+        filters = {k: args[k] for k in FILTERS if args.get(k) is not None}
+        return cls(fields, filters, after_id, limit)
+
+    def sql(self, placeholder="%s"):
+        """(SQL, params)。placeholder は psycopg2 なら "%s"、asyncpg なら "$" """
+        params = []
+
+        def param(value):
+            params.append(value)
+            return f"${len(params)}" if placeholder == "$" else placeholder
+
+        where = []
+        if self.after_id is not None:
+            where.append(f"id > {param(self.after_id)}")
+        for column, value in self.filters.items():
+            where.append(f"{column} = {param(value)}")
+
+        # 列名は COLUMNS / FILTERS のホワイトリストからのみ組み立てる
+        query = f"SELECT {', '.join(self.fields)} FROM emails"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY id LIMIT {param(self.limit + 1)}"
+        return query, params
+
+    def response(self, rows):
+        """limit+1 件取った結果からレスポンスを作る"""
+        rows = list(rows)
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        return {
+            "items": rows,
+            "next_cursor": encode_cursor(rows[-1]["id"]) if has_more else None,
+        }
+
+
+# =====================
+# エクスポート整形 (NDJSON / CSV)
+# =====================
+EXPORT_BATCH = int(os.environ.get("EMAILS_EXPORT_BATCH", "2000"))   # 1 回に取り出す行数
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def format_export_batch(rows, fields, fmt, header=False):
+    """タプルの行リストを 1 回分の出力文字列にする"""
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(fields)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+# =====================
+# 一括更新 (/emails/bulk) の入力
+# =====================
+BULK_MAX_ROWS = int(os.environ.get("EMAILS_BULK_MAX_ROWS", "100000"))
+
+
+def parse_bulk_body(body, content_type=""):
+    """JSON 配列 (または {"items": [...]}) / NDJSON の本文 → list。不正なら ValueError"""
+    try:
+        text = body.decode("utf-8") if isinstance(body, bytes) else body
+        if "ndjson" in (content_type or ""):
+            items = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            items = json.loads(text)
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError("body must be a JSON array or NDJSON")
+
+    if isinstance(items, dict):
+        items = items.get("items", items.get("ids"))
+    if not isinstance(items, list) or not items:
+        raise ValueError("body must be a non-empty JSON array or NDJSON")
+    if len(items) > BULK_MAX_ROWS:
+        raise ValueError(f"too many rows (max {BULK_MAX_ROWS})")
+    return items
+
+
+def _text(item, key, i):
+    value = item.get(key)
+    if not isinstance(value, str):
+        raise ValueError(f"row {i}: {key} must be a string")
+    return value
+
+
+def _optional_text(item, key, i):
+    value = item.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"row {i}: {key} must be a string")
+    return value
+
+
+def bulk_insert_rows(items):
+    """[{name, email}] → [(name, email)]"""
+    rows = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"row {i}: must be an object")
+        rows.append((_text(item, "name", i), _text(item, "email", i)))
+    return rows
+
+
+def bulk_update_rows(items):
+    """[{id, name, email}] → [(id, name, email)]"""
+    rows = []
+    for i, item in enumerate(items):
+        key = item.get("id") if isinstance(item, dict) else None
+        if not isinstance(key, int) or isinstance(key, bool):
+            raise ValueError(f"row {i}: id must be an integer")
+        # 単発の PUT と同じく、省略した列は NULL になる
+        rows.append((key, _optional_text(item, "name", i), _optional_text(item, "email", i)))
+    return rows
+
+
+def bulk_delete_ids(items):
+    """[id, ...] または [{id}, ...] → [id, ...]"""
+    ids = []
+    for i, item in enumerate(items):
+        key = item.get("id") if isinstance(item, dict) else item
+        if not isinstance(key, int) or isinstance(key, bool):
+            raise ValueError(f"row {i}: id must be an integer")
+        ids.append(key)
+    return ids
+
+
+def bulk_notify_payload(action, count):
+    """一括更新 1 回につき 1 回だけ送る通知 (行ごとの通知はトリガー側で止める)"""
+    return json.dumps({"op": "bulk", "action": action, "count": count})
+
+
+def to_csv(rows):
+    """COPY ... FROM STDIN (FORMAT csv) 用。空文字と NULL を区別するため全列を引用する"""
+    buf = io.StringIO()
+    csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(rows)
+    buf.seek(0)
+    return buf
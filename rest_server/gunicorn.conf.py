@@ -0,0 +1,37 @@
+import os
+
+# =====================
+# gunicorn 設定（server.py）
+# =====================
+#   cd rest_server              # best.onnx のあるディレクトリ
+#   gunicorn -c gunicorn.conf.py server:app
+#
+# preload_app でマスターがモデルの読み込みとウォームアップを済ませてから fork するので、
+# モデルの重みは全ワーカーでコピーオンライトで共有される（ワーカーごとに増えるのは
+# 推論中の作業メモリと Python のオブジェクトだけ）。起動も 1 回分で済む。
+#
+# fork 前に作ったスレッドは子に引き継がれないので:
+# - ONNX Runtime の intra-op スレッドプールは作らない（ORT_INTRA_THREADS=1。並列度はワーカー数で出す）
+# - INFER_WORKERS のプロセスプールは使わない（gunicorn のワーカーがその代わり）
+# - バッチスケジューラのスレッドは子で作り直す（batching.py）
+# - マスターでは cv2 の並列処理（リサイズなど）を呼ばない（ウォームアップは推論だけ）
+#
+# メトリクス（/metrics）はワーカーごとの値になる。
+
+bind = os.environ.get("SERVER_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("SERVER_WORKERS", str(os.cpu_count() or 1)))
+# gthread: ワーカー内の同時リクエスト（同時に来た推論はマイクロバッチにまとまる）
+worker_class = "gthread"
+threads = int(os.environ.get("SERVER_THREADS", "4"))
+preload_app = os.environ.get("SERVER_PRELOAD", "1") == "1"
+timeout = int(os.environ.get("SERVER_TIMEOUT", "120"))
+graceful_timeout = 30
+
+if preload_app:
+    os.environ.setdefault("ORT_INTRA_THREADS", "1")
+    os.environ["INFER_WORKERS"] = "0"
+else:
+    # ワーカーごとにモデルを読み込む。コアをワーカーで分ける
+    os.environ.setdefault(
+        "ORT_INTRA_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+    )
@@ -0,0 +1,486 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+import weakref
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+from db import get_connection
+from metrics import NOTIFY_LAG_SECONDS, REGISTRY
+
+log = logging.getLogger(__name__)
+
+# =====================
+# 共有 LISTEN ディスパッチャ
+# =====================
+# 1 本の LISTEN 接続をバックグラウンドスレッドが保持し、
+# 変更通知をクライアントごとのキューへ配る。
+#
+# - snapshot モード: 変更のたびに 1 回だけ全件を問い合わせて配る (従来互換)
+# - delta モード:    トリガーの JSON ペイロード (op / id / row) から
+#                    insert / update / delete イベントを連番 seq 付きで配る
+#
+# すべてのイベントに "id: <epoch>.<seq>" を付け、直近の差分をリングバッファに
+# 残しておく。再接続時の Last-Event-ID がバッファ内なら差分だけを再送する。
+
+# SSE設定
+SSE_MAX_PENDING = int(os.environ.get("SSE_MAX_PENDING", "8"))      # クライアントごとの未送信上限
+SSE_KEEPALIVE = float(os.environ.get("SSE_KEEPALIVE", "15"))       # 秒
+SSE_LOG_SIZE = int(os.environ.get("SSE_LOG_SIZE", "1024"))         # 再送用に残す差分の件数
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", "20"))   # 最初の通知からこの時間内の通知はまとめて 1 回で配る
+
+
+def format_event(event, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def parse_change(payload):
+    """通知ペイロード → (op, id, row)。旧トリガーや一括更新など行が分からなければ None
+
+    row が省かれている (ペイロード上限超え) 場合は row=None で返す。
+    """
+    try:
+        change = json.loads(payload)
+        op = change["op"].lower()
+        if op not in ("insert", "update", "delete"):
+            # 一括更新 (bulk) や文単位トリガー (statement) は行が分からないので全件を送り直す
+            return None
+        return op, change["id"], change.get("row")
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+class Resync:
+    """delta クライアントに全件を送り直す印 (seq 時点の状態)"""
+    __slots__ = ("seq",)
+
+    def __init__(self, seq):
+        self.seq = seq
+
+
+# =====================
+# 連番・イベント ID・再送用リングバッファ
+# =====================
+# スレッド版 (NotifyListener) と asyncio 版 (listener_async) で共用する。
+#
+# seq はプロセスごとに数えるので、世代 (epoch) にはプロセス ID を入れる。
+# gunicorn --preload でマスターが作ったログを fork したワーカーは世代を作り直し、
+# 別のワーカーが出した Last-Event-ID は受け付けない (全件を送り直す)。
+_logs = weakref.WeakSet()
+
+
+def _new_epoch():
+    return f"{int(time.time() * 1000):x}-{os.getpid():x}"
+
+
+class ChangeLog:
+
+    def __init__(self, log_size=1024):
+        self.lock = threading.Lock()
+        # (seq, message)。message が None の seq は差分を再現できない区間
+        self._log = deque(maxlen=log_size)
+        # サーバー再起動・ワーカーをまたいだ Last-Event-ID を見分けるための世代
+        self.epoch = _new_epoch()
+        self.seq = 0
+        self.replays = 0
+        _logs.add(self)
+
+    def _after_fork(self):
+        # lock は NotifyListener と共有しているので差し替えない
+        self._log.clear()
+        self.epoch = _new_epoch()
+        self.seq = 0
+        self.replays = 0
+
+    def event_id(self, seq):
+        return f"{self.epoch}.{seq}"
+
+    def parse_event_id(self, event_id):
+        """この世代の ID なら seq、そうでなければ None"""
+        try:
+            epoch, seq = event_id.rsplit(".", 1)
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or seq < 0 or seq > self.seq:
+            return None
+        return seq
+
+    def append(self, changes):
+        """changes を採番してログに積み、[(seq, message or None)] を返す
+
+        self.lock を持った状態で呼ぶ。
+        """
+        messages = []
+        for change in changes:
+            self.seq += 1
+            if change is None:
+                message = None
+            else:
+                op, key, row = change
+                message = format_event(
+                    op, {"seq": self.seq, "id": key, "row": row},
+                    self.event_id(self.seq)
+                )
+            self._log.append((self.seq, message))
+            messages.append((self.seq, message))
+        return messages
+
+    def replay(self, last_seq, upto):
+        """last_seq より後 upto までの差分。バッファから外れていれば None"""
+        if last_seq == upto:
+            return []
+        with self.lock:
+            entries = [(s, m) for s, m in self._log if last_seq < s <= upto]
+            oldest = self._log[0][0] if self._log else None
+        if oldest is None or oldest > last_seq + 1:
+            return None
+        if len(entries) != upto - last_seq or any(m is None for _, m in entries):
+            return None
+        self.replays += 1
+        return [m for _, m in entries]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "epoch": self.epoch,
+                "seq": self.seq,
+                "log_size": len(self._log),
+                "log_from_seq": self._log[0][0] if self._log else None,
+                "replays": self.replays,
+            }
+
+
+def _reset_logs_after_fork():
+    for changes in list(_logs):
+        changes._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_logs_after_fork)
+
+
+def register_client_gauge(listener):
+    """listener の SSE 接続数を /metrics の sse_clients (mode=snapshot / delta) に出す"""
+    def counts():
+        stats = listener.stats()
+        delta = stats["delta_subscribers"]
+        return {("snapshot",): stats["subscribers"] - delta, ("delta",): delta}
+
+    REGISTRY.gauge("sse_clients", "Connected SSE clients.", counts, ("mode",))
+
+
+def deliver_deltas(subs, messages, seq):
+    """[(seq, message or None)] を delta クライアントへ配る
+
+    行が分からない通知を含む場合や、キューに収まらないほどの件数を
+    まとめて受け取った場合は、差分を並べずに resync を 1 回だけ送る。
+    """
+    for sub in subs:
+        if not sub.delta:
+            continue
+        if len(messages) > sub.max_pending or any(m is None for _, m in messages):
+            sub.resync(seq)
+            continue
+        for s, message in messages:
+            sub.put(message, s)
+
+
+# =====================
+# 1 回の配信に何件の通知をまとめたか
+# =====================
+class PushStats:
+
+    def __init__(self):
+        self.pushes = 0
+        self.absorbed = 0
+        self.last = 0
+        self.max = 0
+        self.histogram = {}     # 2 の冪で区切った件数 → 回数
+
+    def record(self, n):
+        self.pushes += 1
+        self.absorbed += n
+        self.last = n
+        self.max = max(self.max, n)
+        bucket = 1
+        while bucket < n:
+            bucket *= 2
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def as_dict(self):
+        return {
+            "pushes": self.pushes,
+            "notifies_per_push_last": self.last,
+            "notifies_per_push_max": self.max,
+            "notifies_per_push_mean": self.absorbed / self.pushes if self.pushes else 0.0,
+            "notifies_per_push_histogram": {
+                f"<={k}": v for k, v in sorted(self.histogram.items())
+            },
+        }
+
+
+class Subscriber:
+    """SSE クライアント 1 本分の送信キュー
+
+    未送信が max_pending を超えた場合:
+    - snapshot モード: 古いものを捨てて最新だけ残す
+    - delta モード:    差分を捨てて Resync に置き換える
+    """
+
+    def __init__(self, max_pending, delta=False, seq=0):
+        self.max_pending = max_pending
+        self.delta = delta
+        self.start_seq = seq
+        self.coalesced = 0
+        self.closed = False
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def put(self, message, seq=None):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._items) >= self.max_pending:
+                self.coalesced += len(self._items)
+                self._items.clear()
+                if self.delta:
+                    message = Resync(seq)
+            self._items.append(message)
+            self._cond.notify()
+
+    def resync(self, seq):
+        with self._cond:
+            self.coalesced += len(self._items)
+            self._items.clear()
+            self._items.append(Resync(seq))
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """次のメッセージ。タイムアウトまたは close 済みなら None"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed, timeout)
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class NotifyListener:
+
+    def __init__(self, channel, fetch, fetch_row=None, max_pending=8,
+                 log_size=1024, coalesce_ms=0.0, poll_timeout=10.0,
+                 reconnect_delay=1.0):
+        self.channel = channel
+        self.fetch = fetch
+        self.fetch_row = fetch_row
+        self.max_pending = max_pending
+        self.coalesce = coalesce_ms / 1000.0
+        self.poll_timeout = poll_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.changes = ChangeLog(log_size)
+        self._lock = self.changes.lock
+        self._subscribers = set()
+        self._thread = None
+        self._last_payload = None
+
+        self.push_stats = PushStats()
+        self.notifies = 0
+        self.refreshes = 0
+        self.reconnects = 0
+
+    @property
+    def seq(self):
+        return self.changes.seq
+
+    def event_id(self, seq):
+        return self.changes.event_id(seq)
+
+    def parse_event_id(self, event_id):
+        return self.changes.parse_event_id(event_id)
+
+    def replay(self, last_seq, upto):
+        return self.changes.replay(last_seq, upto)
+
+    # --------------------
+    # クライアント登録
+    # --------------------
+    def subscribe(self, delta=False):
+        with self._lock:
+            sub = Subscriber(self.max_pending, delta=delta, seq=self.seq)
+            self._subscribers.add(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=f"listen-{self.channel}", daemon=True
+                )
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def _split_subscribers(self):
+        with self._lock:
+            subs = list(self._subscribers)
+        return [s for s in subs if not s.delta], [s for s in subs if s.delta]
+
+    def snapshot_event(self, event, seq):
+        """delta クライアント用の全件イベント (snapshot / resync)"""
+        return format_event(
+            event, {"seq": seq, "rows": self.fetch()}, self.event_id(seq)
+        )
+
+    def full_event(self):
+        """snapshot モードの全件イベント"""
+        seq = self.seq
+        return f"id: {self.event_id(seq)}\ndata: {json.dumps(self.fetch())}\n\n"
+
+    # --------------------
+    # snapshot モード: 変更 1 回につき問い合わせ 1 回
+    # --------------------
+    def _refresh(self, subs, seq):
+        if not subs:
+            # 誰も見ていなければ問い合わせない
+            self._last_payload = None
+            return
+
+        data = self.fetch()
+        payload = json.dumps(data)
+        self.refreshes += 1
+
+        if payload != self._last_payload:
+            self._last_payload = payload
+            message = f"id: {self.event_id(seq)}\ndata: {payload}\n\n"
+            for sub in subs:
+                sub.put(message)
+
+    # --------------------
+    # delta モード: 通知ペイロードから差分イベント
+    # --------------------
+    def _parse_change(self, payload):
+        change = parse_change(payload)
+        if change is None:
+            return None
+
+        op, key, row = change
+        if row is None and op != "delete" and self.fetch_row is not None:
+            # ペイロード上限で row が省かれた場合は 1 行だけ取り直す
+            row = self.fetch_row(key)
+            if row is None:
+                op = "delete"
+        return op, key, row
+
+    def _dispatch(self, notifies, received):
+        """received は最初の通知を受け取った時刻 (time.monotonic())"""
+        self.notifies += len(notifies)
+        changes = [self._parse_change(n.payload) for n in notifies]
+
+        # seq の採番・ログ追記・購読者の確定は同じロックの中で行う
+        # (この後に subscribe したクライアントはログからこの変更を再送できる)
+        with self._lock:
+            messages = self.changes.append(changes)
+            seq = self.seq
+            subs = list(self._subscribers)
+
+        deliver_deltas(subs, messages, seq)
+        snapshot_subs = [s for s in subs if not s.delta]
+        if len(snapshot_subs) < len(subs):
+            NOTIFY_LAG_SECONDS.observe(time.monotonic() - received, "delta")
+        self._refresh(snapshot_subs, seq)
+        if snapshot_subs:
+            NOTIFY_LAG_SECONDS.observe(time.monotonic() - received, "snapshot")
+        self.push_stats.record(len(notifies))
+
+    def _mark_gap(self):
+        """LISTEN が切れていた間の変更は再現できないので区切りを入れる"""
+        with self._lock:
+            seq = self.changes.append([None])[0][0]
+            subs = list(self._subscribers)
+
+        for sub in subs:
+            if sub.delta:
+                sub.resync(seq)
+        self._refresh([s for s in subs if not s.delta], seq)
+
+    def _wait_burst(self, conn):
+        """最初の通知から coalesce 秒の間に届く通知も溜めてからまとめて配る
+
+        FOR EACH ROW トリガーで 1 文が数千件の通知を出しても、
+        問い合わせ・SSE 送信は 1 回で済む。
+        """
+        deadline = time.monotonic() + self.coalesce
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if select.select([conn], [], [], remaining) != ([], [], []):
+                conn.poll()
+        conn.poll()
+
+    # --------------------
+    # LISTEN ループ (切断時は再接続)
+    # --------------------
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = get_connection()
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+                )
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel};")
+
+                # 再接続した場合は取りこぼした変更があり得る
+                if self.reconnects:
+                    self._mark_gap()
+
+                while True:
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if not conn.notifies:
+                        continue
+                    received = time.monotonic()
+                    self._wait_burst(conn)
+                    notifies = list(conn.notifies)
+                    conn.notifies.clear()
+                    self._dispatch(notifies, received)
+            except Exception as e:
+                log.warning("LISTEN loop error: %s", e)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self.reconnects += 1
+            time.sleep(self.reconnect_delay)
+
+    def stats(self):
+        snapshot_subs, delta_subs = self._split_subscribers()
+        subs = snapshot_subs + delta_subs
+        return {
+            "channel": self.channel,
+            "subscribers": len(subs),
+            "delta_subscribers": len(delta_subs),
+            **self.changes.stats(),
+            "notifies": self.notifies,
+            "refreshes": self.refreshes,
+            "reconnects": self.reconnects,
+            "coalesce_ms": self.coalesce * 1000.0,
+            **self.push_stats.as_dict(),
+            "coalesced": sum(s.coalesced for s in subs),
+        }
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from listener import (
+    ChangeLog, PushStats, Resync, deliver_deltas, format_event, parse_change
+)
+from metrics import NOTIFY_LAG_SECONDS
+
+log = logging.getLogger(__name__)
+
+# =====================
+# asyncio 版 共有 LISTEN ディスパッチャ
+# =====================
+# listener.NotifyListener と同じイベント形式・連番・再送バッファを、
+# スレッドではなくコルーチンで扱う (asyncpg の add_listener を使う)。
+# SSE クライアント 1 本あたりのコストはキュー 1 つとコルーチン 1 つ。
+
+
+class AsyncSubscriber:
+    """SSE クライアント 1 本分の送信キュー (listener.Subscriber の asyncio 版)"""
+
+    def __init__(self, max_pending, delta=False, seq=0):
+        self.max_pending = max_pending
+        self.delta = delta
+        self.start_seq = seq
+        self.coalesced = 0
+        self.closed = False
+        self._items = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, message, seq=None):
+        if self.closed:
+            return
+        if len(self._items) >= self.max_pending:
+            self.coalesced += len(self._items)
+            self._items.clear()
+            if self.delta:
+                message = Resync(seq)
+        self._items.append(message)
+        self._ready.set()
+
+    def resync(self, seq):
+        self.coalesced += len(self._items)
+        self._items.clear()
+        self._items.append(Resync(seq))
+        self._ready.set()
+
+    async def get(self, timeout=None):
+        """次のメッセージ。タイムアウトまたは close 済みなら None"""
+        if not self._items and not self.closed:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._items:
+            return self._items.popleft()
+        return None
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+
+class AsyncNotifyListener:
+
+    def __init__(self, channel, connect, fetch, fetch_row=None, max_pending=8,
+                 log_size=1024, coalesce_ms=0.0, poll_timeout=10.0,
+                 reconnect_delay=1.0):
+        # connect / fetch / fetch_row はコルーチン関数
+        self.channel = channel
+        self.connect = connect
+        self.fetch = fetch
+        self.fetch_row = fetch_row
+        self.max_pending = max_pending
+        self.coalesce = coalesce_ms / 1000.0
+        self.poll_timeout = poll_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.changes = ChangeLog(log_size)
+        self._subscribers = set()
+        self._task = None
+        self._payloads = None
+        self._last_payload = None
+
+        self.push_stats = PushStats()
+        self.notifies = 0
+        self.refreshes = 0
+        self.reconnects = 0
+
+    @property
+    def seq(self):
+        return self.changes.seq
+
+    def event_id(self, seq):
+        return self.changes.event_id(seq)
+
+    def parse_event_id(self, event_id):
+        return self.changes.parse_event_id(event_id)
+
+    def replay(self, last_seq, upto):
+        return self.changes.replay(last_seq, upto)
+
+    # --------------------
+    # クライアント登録
+    # --------------------
+    def subscribe(self, delta=False):
+        sub = AsyncSubscriber(self.max_pending, delta=delta, seq=self.seq)
+        self._subscribers.add(sub)
+        if self._task is None:
+            self._payloads = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        self._subscribers.discard(sub)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def snapshot_event(self, event, seq):
+        """delta クライアント用の全件イベント (snapshot / resync)"""
+        rows = await self.fetch()
+        return format_event(event, {"seq": seq, "rows": rows}, self.event_id(seq))
+
+    async def full_event(self):
+        """snapshot モードの全件イベント"""
+        seq = self.seq
+        rows = await self.fetch()
+        return f"id: {self.event_id(seq)}\ndata: {json.dumps(rows)}\n\n"
+
+    # --------------------
+    # snapshot モード: 変更 1 回につき問い合わせ 1 回
+    # --------------------
+    async def _refresh(self, subs, seq):
+        if not subs:
+            # 誰も見ていなければ問い合わせない
+            self._last_payload = None
+            return
+
+        payload = json.dumps(await self.fetch())
+        self.refreshes += 1
+
+        if payload != self._last_payload:
+            self._last_payload = payload
+            message = f"id: {self.event_id(seq)}\ndata: {payload}\n\n"
+            for sub in subs:
+                sub.put(message)
+
+    # --------------------
+    # delta モード: 通知ペイロードから差分イベント
+    # --------------------
+    async def _parse_change(self, payload):
+        change = parse_change(payload)
+        if change is None:
+            return None
+
+        op, key, row = change
+        if row is None and op != "delete" and self.fetch_row is not None:
+            # ペイロード上限で row が省かれた場合は 1 行だけ取り直す
+            row = await self.fetch_row(key)
+            if row is None:
+                op = "delete"
+        return op, key, row
+
+    async def _dispatch(self, payloads, received):
+        """received は最初の通知を受け取った時刻 (time.monotonic())"""
+        self.notifies += len(payloads)
+        changes = [await self._parse_change(p) for p in payloads]
+
+        # 採番から配布まで await を挟まないので、途中で subscribe されることはない
+        with self.changes.lock:
+            messages = self.changes.append(changes)
+        seq = self.seq
+        subs = list(self._subscribers)
+
+        deliver_deltas(subs, messages, seq)
+        snapshot_subs = [s for s in subs if not s.delta]
+        if len(snapshot_subs) < len(subs):
+            NOTIFY_LAG_SECONDS.observe(time.monotonic() - received, "delta")
+        await self._refresh(snapshot_subs, seq)
+        if snapshot_subs:
+            NOTIFY_LAG_SECONDS.observe(time.monotonic() - received, "snapshot")
+        self.push_stats.record(len(payloads))
+
+    async def _mark_gap(self):
+        """LISTEN が切れていた間の変更は再現できないので区切りを入れる"""
+        with self.changes.lock:
+            seq = self.changes.append([None])[0][0]
+        subs = list(self._subscribers)
+
+        for sub in subs:
+            if sub.delta:
+                sub.resync(seq)
+        await self._refresh([s for s in subs if not s.delta], seq)
+
+    # --------------------
+    # LISTEN ループ (切断時は再接続)
+    # --------------------
+    def _on_notify(self, conn, pid, channel, payload):
+        self._payloads.put_nowait(payload)
+
+    async def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = await self.connect()
+                await conn.add_listener(self.channel, self._on_notify)
+
+                # 再接続した場合は取りこぼした変更があり得る
+                if self.reconnects:
+                    await self._mark_gap()
+
+                while True:
+                    try:
+                        payload = await asyncio.wait_for(
+                            self._payloads.get(), self.poll_timeout
+                        )
+                    except asyncio.TimeoutError:
+                        if conn.is_closed():
+                            break
+                        continue
+
+                    # 最初の通知から coalesce 秒の間に届く通知もまとめて処理する
+                    received = time.monotonic()
+                    if self.coalesce > 0:
+                        await asyncio.sleep(self.coalesce)
+                    payloads = [payload]
+                    while not self._payloads.empty():
+                        payloads.append(self._payloads.get_nowait())
+                    await self._dispatch(payloads, received)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("LISTEN loop error: %s", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    try:
+                        await conn.close()
+                    except Exception:
+                        pass
+            self.reconnects += 1
+            await asyncio.sleep(self.reconnect_delay)
+
+    def stats(self):
+        subs = list(self._subscribers)
+        return {
+            "channel": self.channel,
+            "subscribers": len(subs),
+            "delta_subscribers": sum(1 for s in subs if s.delta),
+            **self.changes.stats(),
+            "notifies": self.notifies,
+            "refreshes": self.refreshes,
+            "reconnects": self.reconnects,
+            "coalesce_ms": self.coalesce * 1000.0,
+            **self.push_stats.as_dict(),
+            "coalesced": sum(s.coalesced for s in subs),
+        }
@@ -0,0 +1,306 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# =====================
+# メトリクス (/metrics、Prometheus のテキスト形式)
+# =====================
+# /predict の段ごとの所要時間 (decode / preprocess / infer / decode_boxes / nms /
+# render / encode) をヒストグラムに積み、DB 接続の待ち・保持時間、SSE の接続数、
+# 通知から配信までの遅れ、バッチスケジューラのキューの長さ・バッチの枚数と一緒に
+# /metrics で返す。
+#
+# 段ごとの計測は METRICS_SAMPLE の割合のリクエストだけ (既定は全件。perf_counter 2 回分)。
+# リクエスト全体の時間は常に積む。値はプロセスごとなので、gunicorn などで複数プロセス
+# 動かす場合はプロセスごとにスクレイプする。
+#
+# 任意で cProfile を取れる (PROFILE_ENABLE=1)。POST /debug/profile?requests=N で
+# 次の N 件の /predict を 1 件ずつプロファイルし、まとめて PROFILE_DIR に .prof を書く。
+# 推論そのもの (sess.run) はバッチスケジューラのスレッドで走るので、ここには待ち時間として出る。
+
+METRICS_SAMPLE = float(os.environ.get("METRICS_SAMPLE", "1"))
+LOG_BOXES = os.environ.get("LOG_BOXES", "0") == "1"        # 検出 1 件ごとのログ (既定は出さない)
+
+PROFILE_ENABLE = os.environ.get("PROFILE_ENABLE", "0") == "1"
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", "0"))   # 起動直後から N 件取る
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# 秒。推論 1 回 (数 ms〜数百 ms) と DB の問い合わせが両方収まる幅
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}       # ラベル値 -> [バケットごとの件数..., 合計, 件数]
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for labels, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """スクレイプのたびに fn() を呼んで値を返す
+
+    fn() は数値、またはラベル値のタプル -> 数値の dict を返す。
+    """
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in sorted(value.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {v}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, help, labelnames, buckets)
+        return self._metrics[name]
+
+    def gauge(self, name, help, fn, labelnames=()):
+        # 同じ名前で登録し直したら新しい fn に差し替える
+        self._metrics[name] = Gauge(name, help, fn, labelnames)
+        return self._metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "predict_stage_seconds", "Time spent in each /predict stage.", ("stage",)
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "Request handling time until the response is returned.",
+    ("endpoint", "status")
+)
+DB_WAIT_SECONDS = REGISTRY.histogram(
+    "db_pool_wait_seconds", "Time waiting for a pooled DB connection."
+)
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "db_query_seconds", "Time a pooled DB connection is held (queries and commit)."
+)
+NOTIFY_LAG_SECONDS = REGISTRY.histogram(
+    "sse_notify_lag_seconds",
+    "Time from receiving a NOTIFY until the event is queued for every SSE client.",
+    ("mode",)
+)
+
+
+# =====================
+# 段ごとの計測 (サンプリング)
+# =====================
+class _Sampling(threading.local):
+    on = True           # リクエスト外 (ワーカーやストリームのスレッド) では常に計測
+
+
+_sampling = _Sampling()
+
+
+@contextmanager
+def stage(name):
+    """with stage("decode"): ... の所要時間を predict_stage_seconds に積む"""
+    if not _sampling.on:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, name)
+
+
+# =====================
+# cProfile フック
+# =====================
+class RequestProfiler:
+    """次の N 件のリクエストを cProfile で取り、まとめて 1 つの .prof に書く
+
+    cProfile はスレッド単位なので、同時に来たリクエストは 1 件ずつしか取らない
+    (取っている間の他のリクエストは数えない)。
+    """
+
+    def __init__(self, out_dir=PROFILE_DIR):
+        self.out_dir = out_dir
+        self.remaining = 0
+        self.requested = 0
+        self.last_path = None
+        self._stats = None
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()
+
+    def arm(self, n):
+        with self._lock:
+            self.remaining = self.requested = n
+            self._stats = None
+
+    def start(self):
+        """プロファイルを始めたら cProfile.Profile、取らないなら None"""
+        if self.remaining <= 0 or not self._busy.acquire(blocking=False):
+            return None
+        if self.remaining <= 0:
+            self._busy.release()
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        profile.disable()
+        try:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.remaining -= 1
+                if self.remaining == 0:
+                    self._dump()
+        finally:
+            self._busy.release()
+
+    def _dump(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(
+            self.out_dir, f"predict-{time.strftime('%Y%m%d-%H%M%S')}-{self.requested}.prof"
+        )
+        self._stats.dump_stats(path)
+        self.last_path = path
+
+    def report(self, top=30):
+        with self._lock:
+            status = {
+                "requested": self.requested,
+                "remaining": self.remaining,
+                "last_profile": self.last_path,
+            }
+            if self._stats is not None and self.remaining == 0:
+                out = io.StringIO()
+                self._stats.stream = out
+                self._stats.sort_stats("cumulative").print_stats(top)
+                status["top"] = out.getvalue()
+        return status
+
+
+def install_metrics(app, endpoint="predict", profile=PROFILE_ENABLE):
+    """リクエスト時間の計測・段ごとのサンプリング・/metrics を登録する
+
+    profile=True なら endpoint のリクエストをプロファイルできるようにし、
+    /debug/profile (GET: 状況と上位の関数、POST ?requests=N: 次の N 件を取る) を登録する。
+    """
+    # db / listener 経由で asyncio 版 (app_async) からも読まれるので、Flask はここで読み込む
+    from flask import Response, g, jsonify, request
+
+    profiler = RequestProfiler() if profile else None
+    if profiler is not None and PROFILE_REQUESTS > 0:
+        profiler.arm(PROFILE_REQUESTS)
+
+    @app.before_request
+    def _start_metrics():
+        g.metrics_started = time.perf_counter()
+        _sampling.on = METRICS_SAMPLE >= 1 or random.random() < METRICS_SAMPLE
+        if profiler is not None and request.endpoint == endpoint:
+            g.profile = profiler.start()
+
+    @app.after_request
+    def _record_metrics(response):
+        started = g.get("metrics_started")
+        if started is not None:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                request.endpoint or "none", response.status_code
+            )
+        return response
+
+    @app.teardown_request
+    def _finish_metrics(exc):
+        # 例外で after_request が呼ばれなくても必ず止める
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profiler.stop(profile)
+        _sampling.on = True
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    if profiler is None:
+        return None
+
+    @app.route("/debug/profile", methods=["GET", "POST"])
+    def debug_profile():
+        if request.method == "POST":
+            try:
+                n = int(request.args.get("requests", "20"))
+            except ValueError:
+                return jsonify({"error": "requests must be an integer"}), 400
+            if n <= 0:
+                return jsonify({"error": "requests must be positive"}), 400
+            profiler.arm(n)
+        return jsonify(profiler.report())
+
+    return profiler
@@ -0,0 +1,414 @@
+import heapq
+import os
+
+import cv2
+import numpy as np
+
+# =====================
+# NMS（NumPy）
+# =====================
+# これまでは検出を Python のリスト [[x, y, w, h], ...] にして cv2.dnn.NMSBoxes に渡していた。
+# NMSBoxes は残した検出すべてと候補を 1 つずつ比べるので、束の写真で候補が数万・
+# 残りが数千になると比較が 候補数 × 残数 回になる（リストへの変換も毎回かかる）。
+#
+# ここでは NumPy の配列のまま、
+#   1. スコアのしきい値で絞り、スコア順（同点は元の順）に並べる（top_k 件まで）
+#   2. 格子（セル = 検出の大きさ）で近くにある組だけを作り、組ごとの重なりをまとめて計算
+#   3. 重なりすぎた組だけを辿って、スコア順に残す・消すを決める
+# とする。比較は近くの組だけなので、密に並んだパイプ端でも 候補数 × 近所の数 で済む。
+#
+#   hard   : NMSBoxes と同じ結果（重なりの計算・同点の順・面積 0 の扱いまで合わせてある）
+#   center : hard に加えて、中心が近すぎる検出も消す（CENTER_THRES × 小さいほうの直径より近い）。
+#            隙間なく並んだ円形のパイプ端は隣同士の IoU が小さいので、IoU では消えない
+#            ずれた二重検出を中心の距離で消す
+#   soft   : Gaussian soft-NMS。消す代わりに重なりに応じてスコアを下げ、しきい値を下回ったら消す
+#   cv2    : cv2.dnn.NMSBoxes そのもの（比較用）
+#
+# class_ids / class_aware でクラスごと、groups（ROI の番号など）で複数の画像・ROI を
+# まとめて 1 回で処理できる（違うクラス・グループ同士は抑制しない）。
+
+NMS_METHOD = os.environ.get("NMS_METHOD", "hard")
+NMS_TOP_K = int(os.environ.get("NMS_TOP_K", "0"))                  # 0 なら制限なし
+NMS_CENTER_THRES = float(os.environ.get("NMS_CENTER_THRES", "0.5"))
+NMS_SIGMA = float(os.environ.get("NMS_SIGMA", "0.5"))              # soft-NMS の Gaussian の幅
+
+METHODS = ("hard", "center", "soft", "cv2")
+
+LARGE_RATIO = 2.0       # 大きさの中央値のこの倍より大きい検出は格子に入れず、総当たりで比べる
+PAIR_LIMIT = 2_000_000  # 比べる組がこれを超える (同じ場所に候補が固まっている) ときは順に比べる
+
+
+# =====================
+# 候補の準備
+# =====================
+def _group_keys(n, class_ids, class_aware, groups):
+    """抑制し合う範囲（グループ × クラス）ごとの番号"""
+    keys = np.zeros(n, np.int64)
+    if groups is not None:
+        keys = np.asarray(groups, np.int64).reshape(-1).copy()
+    if class_aware and class_ids is not None:
+        keys = keys * (int(class_ids.max(initial=0)) + 1) + class_ids
+    return keys
+
+
+def _candidates(scores, class_ids, score_thres, iou_thres, class_thres, top_k):
+    """しきい値を超えた候補をスコア順に。(候補の元の番号, 候補ごとの IoU しきい値)"""
+    thr_score = np.full(len(scores), score_thres, np.float32)
+    thr_iou = np.full(len(scores), iou_thres, np.float32)
+    if class_thres and class_ids is not None:
+        for cls, (score, iou) in class_thres.items():
+            mask = class_ids == cls
+            thr_score[mask] = score
+            thr_iou[mask] = iou
+
+    cand = np.flatnonzero(scores > thr_score)
+    # NMSBoxes と同じく降順の安定ソート（同点は元の順）
+    cand = cand[np.argsort(-scores[cand], kind="stable")]
+    if top_k > 0:
+        cand = cand[:top_k]
+    return cand, thr_iou[cand]
+
+
+# =====================
+# 近くにある組
+# =====================
+def _expand(src, start, counts):
+    """src[k] と start[k]〜start[k]+counts[k]-1 の組を並べる"""
+    total = int(counts.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(src, counts), np.repeat(start, counts) + offsets
+
+
+def _grid_pairs(boxes, keys, idx, cell, limit):
+    """idx の検出のうち、同じか隣のセル（半分の近傍）にある組。セルは左上の座標で決める
+
+    組が limit を超えるなら None。
+    """
+    cx = boxes[idx, 0] // cell
+    cy = boxes[idx, 1] // cell
+    cx -= cx.min()
+    cy -= cy.min()
+    nx = int(cx.max()) + 3
+    ny = int(cy.max()) + 3
+    cell_key = (keys[idx] * nx + cx + 1) * ny + cy + 1
+
+    order = np.argsort(cell_key, kind="stable")
+    sorted_keys = cell_key[order]
+    position = np.empty(len(idx), np.int64)
+    position[order] = np.arange(len(idx))
+
+    ranges = []
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        target = cell_key + dx * ny + dy
+        end = np.searchsorted(sorted_keys, target, "right")
+        if dx == 0 and dy == 0:
+            start = position + 1            # 同じセルは自分より後ろだけ（組を重複させない）
+        else:
+            start = np.searchsorted(sorted_keys, target, "left")
+        ranges.append((start, np.maximum(end - start, 0)))
+    if sum(int(counts.sum()) for _, counts in ranges) > limit:
+        return None
+
+    src, dst = [], []
+    for start, counts in ranges:
+        a, b = _expand(np.arange(len(idx)), start, counts)
+        src.append(idx[a])
+        dst.append(idx[order[b]])
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def _pairs(boxes, keys, limit=None):
+    """同じ keys の中で重なりうる組 (i, j)、i < j（候補の順位）。組が limit (既定は PAIR_LIMIT)
+    を超えるなら None
+
+    面積 0 以下の検出は入れない（重なりが面積だけで決まるので、呼び出し側で扱う）。
+    """
+    if limit is None:
+        limit = PAIR_LIMIT
+    empty = np.empty(0, np.int64)
+    area = boxes[:, 2] * boxes[:, 3]
+    size = np.maximum(boxes[:, 2], boxes[:, 3])
+    normal = np.flatnonzero(area > 0)
+    if len(normal) < 2:
+        return empty, empty
+
+    # 極端に大きい検出はセルを大きくしてしまうので、格子に入れず総当たりで比べる
+    large = np.zeros(len(boxes), bool)
+    large[normal] = size[normal] > LARGE_RATIO * float(np.median(size[normal]))
+    rest = normal[~large[normal]]
+    if len(np.flatnonzero(large)) * len(normal) > limit:
+        return None
+
+    src, dst = [], []
+    if len(rest) > 1:
+        cell = max(1, int(size[rest].max()))
+        pairs = _grid_pairs(boxes, keys, rest, cell, limit)
+        if pairs is None:
+            return None
+        src.append(pairs[0])
+        dst.append(pairs[1])
+    for i in np.flatnonzero(large):
+        others = normal[keys[normal] == keys[i]]
+        others = others[(~large[others]) | (others > i)]
+        others = others[others != i]
+        src.append(np.full(len(others), i))
+        dst.append(others)
+
+    if not src:
+        return empty, empty
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+    return np.minimum(src, dst), np.maximum(src, dst)
+
+
+def _overlap(boxes, i, j):
+    """NMSBoxes (cv::rectOverlap) と同じ計算・同じ丸めの重なり (float32)"""
+    bi = boxes[i]
+    bj = boxes[j]
+    iw = np.minimum(bi[:, 0] + bi[:, 2], bj[:, 0] + bj[:, 2]) - np.maximum(bi[:, 0], bj[:, 0])
+    ih = np.minimum(bi[:, 1] + bi[:, 3], bj[:, 1] + bj[:, 3]) - np.maximum(bi[:, 1], bj[:, 1])
+    inter = np.where((iw > 0) & (ih > 0), iw * ih, 0)
+    total = bi[:, 2] * bi[:, 3] + bj[:, 2] * bj[:, 3]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance = (1.0 - inter / (total - inter)).astype(np.float32)
+    # 面積の和が 0 以下なら同じ検出とみなす (cv::jaccardDistance)
+    distance[total <= 0] = 0
+    return np.float32(1) - distance
+
+
+def _centers_close(boxes, i, j, center_thres):
+    """中心の距離が center_thres × 小さいほうの直径 (短辺) より近い組"""
+    bi = boxes[i].astype(np.float64)
+    bj = boxes[j].astype(np.float64)
+    dx = (bi[:, 0] + bi[:, 2] / 2) - (bj[:, 0] + bj[:, 2] / 2)
+    dy = (bi[:, 1] + bi[:, 3] / 2) - (bj[:, 1] + bj[:, 3] / 2)
+    diameter = np.minimum(np.minimum(bi[:, 2], bi[:, 3]), np.minimum(bj[:, 2], bj[:, 3]))
+    return np.hypot(dx, dy) < center_thres * diameter
+
+
+def _conflicts(boxes, i, j, thr_iou, center_thres):
+    """組 (i, j) のうち、i を残すと j が消えるもの"""
+    conflict = _overlap(boxes, i, j) > thr_iou[i]
+    if center_thres > 0:
+        conflict |= _centers_close(boxes, i, j, center_thres)
+    return conflict
+
+
+# =====================
+# NMS
+# =====================
+def _prepare(boxes, scores, class_ids, class_aware, groups, score_thres, iou_thres,
+             class_thres, top_k):
+    boxes = np.asarray(boxes, np.int64).reshape(-1, 4)
+    scores = np.asarray(scores, np.float32).reshape(-1)
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids, np.int64).reshape(-1)
+    cand, thr_iou = _candidates(scores, class_ids, score_thres, iou_thres, class_thres, top_k)
+    keys = _group_keys(len(scores), class_ids, class_aware, groups)[cand]
+    return boxes[cand], scores, cand, thr_iou, keys
+
+
+def _greedy_dense(boxes, keys, thr_iou, center_thres):
+    """組が多すぎるとき（同じ場所に候補が固まっている）: 残した検出と残りを順に比べる"""
+    alive = np.ones(len(boxes), bool)
+    for k in range(len(boxes)):
+        if not alive[k]:
+            continue
+        rest = k + 1 + np.flatnonzero(alive[k + 1:] & (keys[k + 1:] == keys[k]))
+        if len(rest):
+            conflict = _conflicts(boxes, np.full(len(rest), k), rest, thr_iou, center_thres)
+            alive[rest[conflict]] = False
+    return alive
+
+
+def nms(boxes, scores, iou_thres=0.5, score_thres=0.0, class_ids=None, class_aware=False,
+        class_thres=None, groups=None, top_k=0, center_thres=0.0):
+    """残す検出の番号 (スコアの高い順)
+
+    boxes は [x, y, w, h] (整数)。class_aware=True なら class_ids が同じもの同士だけ、
+    groups を渡すと同じグループ同士だけ抑制する。class_thres {class_id: (score, iou)} で
+    クラスごとのしきい値を上書きする。center_thres > 0 なら中心の近い検出も消す (1 以下)。
+    """
+    cand_boxes, scores, cand, thr_iou, keys = _prepare(
+        boxes, scores, class_ids, class_aware, groups, score_thres, iou_thres,
+        class_thres, top_k
+    )
+    pairs = _pairs(cand_boxes, keys)
+    if pairs is None:
+        return cand[_greedy_dense(cand_boxes, keys, thr_iou, center_thres)]
+
+    # 候補の番号 = 順位なので、i (上位) が残れば j が消える
+    i, j = pairs
+    conflict = _conflicts(cand_boxes, i, j, thr_iou, center_thres)
+    i, j = i[conflict], j[conflict]
+    order = np.argsort(i, kind="stable")
+    i, j = i[order], j[order]
+    ptr = np.searchsorted(i, np.arange(len(cand) + 1))
+
+    suppressed = np.zeros(len(cand), bool)
+    area = cand_boxes[:, 2] * cand_boxes[:, 3]
+    if not (area <= 0).any():
+        for s in np.unique(i).tolist():
+            if not suppressed[s]:
+                suppressed[j[ptr[s]:ptr[s + 1]]] = True
+        return cand[~suppressed]
+
+    # 面積 0 以下の検出が絡む組は、位置に関係なく面積の和が 0 以下なら重なり 1 (NMSBoxes と同じ)。
+    # 組は作らず、グループごとに残した検出の最小の面積と比べる
+    _, group = np.unique(keys, return_inverse=True)
+    min_kept = np.full(group.max(initial=0) + 1, np.inf)
+    for k, g, a, thr in zip(range(len(cand)), group.tolist(), area.tolist(), thr_iou.tolist()):
+        if suppressed[k]:
+            continue
+        if a + min_kept[g] <= 0:
+            suppressed[k] = True
+            continue
+        if thr < 1 and a < min_kept[g]:
+            min_kept[g] = a
+        suppressed[j[ptr[k]:ptr[k + 1]]] = True
+    return cand[~suppressed]
+
+
+def soft_nms(boxes, scores, score_thres=0.0, sigma=NMS_SIGMA, class_ids=None,
+             class_aware=False, class_thres=None, groups=None, top_k=0):
+    """Gaussian soft-NMS。(残す検出の番号 (下げた後のスコアの高い順), 下げた後のスコア)
+
+    重なった検出のスコアに exp(-IoU² / sigma) を掛けていき、score_thres 以下になったら消す。
+    戻り値のスコアは scores と同じ長さ (float64、消えた検出は元の値)。
+    面積 0 以下の検出は他を下げも下げられもしない。
+    """
+    cand_boxes, scores, cand, _, keys = _prepare(
+        boxes, scores, class_ids, class_aware, groups, score_thres, 0.0, class_thres, top_k
+    )
+    thr_score = np.full(len(scores), score_thres, np.float64)
+    if class_thres and class_ids is not None:
+        class_ids = np.asarray(class_ids, np.int64).reshape(-1)
+        for cls, (score, _) in class_thres.items():
+            thr_score[class_ids == cls] = score
+    thr_score = thr_score[cand]
+    current = scores[cand].astype(np.float64)
+    min_thres = thr_score.min(initial=np.inf)
+
+    pairs = _pairs(cand_boxes, keys)
+    if pairs is None:
+        kept = _soft_dense(cand_boxes, keys, current, thr_score, min_thres, sigma)
+    else:
+        kept = _soft_sparse(cand_boxes, pairs, current, thr_score, min_thres, sigma)
+
+    out = scores.astype(np.float64)
+    out[cand] = current
+    return cand[np.asarray(kept, np.int64)], out
+
+
+def _soft_sparse(boxes, pairs, current, thr_score, min_thres, sigma):
+    i, j = pairs
+    iou = _overlap(boxes, i, j).astype(np.float64)
+    touching = iou > 0
+    i, j, decay = i[touching], j[touching], np.exp(-iou[touching] ** 2 / sigma)
+
+    # 両向きの隣接リスト
+    src = np.concatenate([i, j])
+    dst = np.concatenate([j, i])
+    weight = np.concatenate([decay, decay])
+    order = np.argsort(src, kind="stable")
+    dst, weight = dst[order], weight[order]
+    ptr = np.searchsorted(src[order], np.arange(len(boxes) + 1))
+
+    done = np.zeros(len(boxes), bool)
+    heap = [(-s, k) for k, s in enumerate(current.tolist())]    # スコア順なのでそのままヒープ
+    kept = []
+    while heap:
+        neg, k = heapq.heappop(heap)
+        if done[k] or -neg != current[k]:
+            continue
+        done[k] = True
+        if current[k] <= thr_score[k]:
+            if current[k] <= min_thres:
+                break           # 残りはすべてどのしきい値も下回る
+            continue
+        kept.append(k)
+        a, b = ptr[k], ptr[k + 1]
+        neighbors = dst[a:b]
+        live = ~done[neighbors]
+        neighbors = neighbors[live]
+        current[neighbors] *= weight[a:b][live]
+        for t in neighbors.tolist():
+            heapq.heappush(heap, (-current[t], t))
+    return kept
+
+
+def _soft_dense(boxes, keys, current, thr_score, min_thres, sigma):
+    """組が多すぎるとき: 毎回残りから最大を選び、残り全部のスコアを下げる"""
+    area = boxes[:, 2] * boxes[:, 3]
+    live = np.flatnonzero(area > 0)
+    degenerate = np.flatnonzero(area <= 0)
+    kept = []
+    while len(live) or len(degenerate):
+        pool = np.concatenate([live, degenerate])
+        k = pool[np.lexsort((pool, -current[pool]))[0]]
+        if current[k] <= min_thres:
+            break
+        live = live[live != k]
+        degenerate = degenerate[degenerate != k]
+        if current[k] <= thr_score[k]:
+            continue
+        kept.append(int(k))
+        if area[k] <= 0:
+            continue
+        same = live[keys[live] == keys[k]]
+        iou = _overlap(boxes, np.full(len(same), k), same).astype(np.float64)
+        current[same] *= np.where(iou > 0, np.exp(-iou ** 2 / sigma), 1.0)
+    return kept
+
+
+def nms_cv2(boxes, scores, iou_thres=0.5, score_thres=0.0, class_ids=None, class_aware=False,
+            class_thres=None, groups=None, top_k=0):
+    """nms と同じ引数で cv2.dnn.NMSBoxes を呼ぶ (クラス・グループごとに 1 回。top_k もその単位)"""
+    boxes = np.asarray(boxes, np.int64).reshape(-1, 4)
+    scores = np.asarray(scores, np.float32).reshape(-1)
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids, np.int64).reshape(-1)
+    keys = _group_keys(len(scores), class_ids, class_aware, groups)
+
+    kept = []
+    for key in np.unique(keys):
+        idx = np.flatnonzero(keys == key)
+        score, iou = score_thres, iou_thres
+        if class_thres and class_aware and class_ids is not None:
+            score, iou = class_thres.get(int(class_ids[idx[0]]), (score_thres, iou_thres))
+        indices = cv2.dnn.NMSBoxes(
+            boxes[idx].tolist(), scores[idx].tolist(),
+            score_threshold=score, nms_threshold=iou, top_k=top_k
+        )
+        kept.append(idx[np.asarray(indices, np.int64).reshape(-1)])
+    if not kept:
+        return np.empty(0, np.int64)
+    kept = np.concatenate(kept)
+    return kept[np.lexsort((kept, -scores[kept]))]
+
+
+def suppress(boxes, scores, class_ids, score_thres, iou_thres, class_thres=None,
+             groups=None, method=NMS_METHOD, top_k=NMS_TOP_K):
+    """/predict などの後処理用。(残す番号, スコア)
+
+    class_thres {class_id: (score, iou)} があればクラスごと、なければクラスを区別しない
+    (従来の NMSBoxes と同じ)。スコアは soft のときだけ下げた値、それ以外は scores のまま。
+    """
+    class_aware = bool(class_thres)
+    if method == "soft":
+        return soft_nms(
+            boxes, scores, score_thres, NMS_SIGMA, class_ids=class_ids,
+            class_aware=class_aware, class_thres=class_thres, groups=groups, top_k=top_k
+        )
+    if method == "cv2":
+        keep = nms_cv2(
+            boxes, scores, iou_thres, score_thres, class_ids=class_ids,
+            class_aware=class_aware, class_thres=class_thres, groups=groups, top_k=top_k
+        )
+        return keep, scores
+    keep = nms(
+        boxes, scores, iou_thres, score_thres, class_ids=class_ids, class_aware=class_aware,
+        class_thres=class_thres, groups=groups, top_k=top_k,
+        center_thres=NMS_CENTER_THRES if method == "center" else 0.0
+    )
+    return keep, scores
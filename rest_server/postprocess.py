@@ -0,0 +1,86 @@
+import numpy as np
+
+# =====================
+# YOLOv8 ONNX 出力のベクトル化デコード
+# =====================
+# outputs[0][0] は (C, N) = (4 + クラス数, アンカー数)。
+# 旧実装はアンカーごとに Python ループで np.argmax していたが、
+# ここでは (C, N) 全体を一度に処理する。
+
+
+def decode_yolo(preds, conf_thres=0.3):
+    """(C, N) の出力から閾値以上のアンカーを取り出す
+
+    戻り値: (cx, cy, bw, bh, scores, class_ids)
+    いずれも 1 次元配列で、入力のアンカー順を保つ。
+    """
+    class_scores = preds[4:]
+    class_ids = np.argmax(class_scores, axis=0)
+    scores = np.take_along_axis(class_scores, class_ids[None, :], axis=0)[0]
+
+    keep = scores >= conf_thres
+    xc, yc, bw, bh = preds[0:4, keep]
+
+    return xc, yc, bw, bh, scores[keep], class_ids[keep]
+
+
+# =====================
+# letterbox 入力 → 画像座標 (app.py)
+# =====================
+def letterbox_to_xywh(decoded, ratio, dw, dh, img_w, img_h):
+    """Ultralytics 互換の逆変換＋クリップ
+
+    戻り値: boxes (M, 4) int [x, y, w, h], scores (M,), class_ids (M,)
+    """
+    xc, yc, bw, bh, scores, class_ids = decoded
+
+    x = (xc - bw / 2 - dw) / ratio
+    y = (yc - bh / 2 - dh) / ratio
+    w_box = bw / ratio
+    h_box = bh / ratio
+
+    x = np.clip(x, 0, img_w - 1).astype(np.int64)
+    y = np.clip(y, 0, img_h - 1).astype(np.int64)
+    w_box = np.minimum(img_w - x, w_box).astype(np.int64)
+    h_box = np.minimum(img_h - y, h_box).astype(np.int64)
+
+    boxes = np.stack([x, y, w_box, h_box], axis=1)
+    return boxes, scores, class_ids
+
+
+# =====================
+# リサイズ(引き伸ばし)入力 → 画像座標 (app2.py / app3.py)
+# =====================
+def stretch_to_xywh(decoded, scale_x, scale_y, offset=(0, 0), clip_size=None):
+    """cv2.resize で引き伸ばした入力からの逆変換
+
+    clip_size=(w, h) を渡すと四隅を画像内にクリップする (app2.py)。
+    渡さない場合は左上座標に offset (ROI 左上) を足す (app3.py)。
+
+    戻り値: boxes (M, 4) int [x, y, w, h], scores (M,), class_ids (M,)
+    """
+    xc, yc, bw, bh, scores, class_ids = decoded
+
+    if clip_size is not None:
+        # center → corner
+        x1 = ((xc - bw / 2) * scale_x).astype(np.int64)
+        y1 = ((yc - bh / 2) * scale_y).astype(np.int64)
+        x2 = ((xc + bw / 2) * scale_x).astype(np.int64)
+        y2 = ((yc + bh / 2) * scale_y).astype(np.int64)
+
+        x1 = np.maximum(0, x1)
+        y1 = np.maximum(0, y1)
+        x2 = np.minimum(clip_size[0], x2)
+        y2 = np.minimum(clip_size[1], y2)
+
+        boxes = np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)
+        return boxes, scores, class_ids
+
+    # ROI基準 bbox → 元画像座標
+    x = ((xc - bw / 2) * scale_x + offset[0]).astype(np.int64)
+    y = ((yc - bh / 2) * scale_y + offset[1]).astype(np.int64)
+    w_box = (bw * scale_x).astype(np.int64)
+    h_box = (bh * scale_y).astype(np.int64)
+
+    boxes = np.stack([x, y, w_box, h_box], axis=1)
+    return boxes, scores, class_ids
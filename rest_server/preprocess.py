@@ -0,0 +1,99 @@
+import threading
+
+import cv2
+import numpy as np
+
+# =====================
+# 前処理（確保済みバッファへ直接書き込む）
+# =====================
+# 旧実装は letterbox → cvtColor → astype(float32) → /255 → transpose → expand_dims と
+# 1280×1280×3 の一時配列を 5 つほど作り、最後の blob も非連続 (transpose のビュー) で
+# ONNX Runtime 側でさらにコピーされていた。
+#
+# ここではスレッドごとに uint8 のキャンバスと NCHW の入力テンソルを 1 回だけ確保し、
+#   1. cv2.resize の dst にキャンバス (の一部) を渡して縮小
+#   2. BGR→RGB の入れ替えと /255 を 1 パスで入力テンソルへ書き込む
+# だけで済ませる。結果は旧実装とビット単位で一致する。
+
+PAD_COLOR = (114, 114, 114)
+
+
+def input_dtype(sess):
+    """モデル入力の dtype (FP16 モデルなら float16)"""
+    return np.float16 if sess.get_inputs()[0].type == "tensor(float16)" else np.float32
+
+
+def normalize_into(src, out):
+    """BGR uint8 (H, W, 3) → RGB / 255 の (3, H, W) を out に書き込む"""
+    for c in range(3):
+        np.divide(src[:, :, 2 - c], np.float32(255), out=out[c],
+                  dtype=np.float32, casting="unsafe")
+    return out
+
+
+class InputBuffers(threading.local):
+    """スレッドごとの前処理バッファ
+
+    返す blob は同じスレッドの次の呼び出しで上書きされる。
+    scheduler.run は推論が終わるまで戻らないので、その間に再利用されることはない。
+    """
+
+    def __init__(self, size, dtype=np.float32):
+        self.size = size
+        self.canvas = np.empty((size, size, 3), np.uint8)
+        self.blob = np.empty((1, 3, size, size), dtype)
+
+    # --------------------
+    # Ultralytics互換 letterbox (app.py)
+    # --------------------
+    def letterbox(self, img, color=PAD_COLOR, scaleup=True, out=None):
+        """戻り値: blob (1, 3, size, size), ratio, (dw, dh)
+
+        out (3, size, size) を渡すと blob の代わりにそこへ書き込んで返す (複数 ROI のバッチ)。
+        """
+        size = self.size
+        shape = img.shape[:2]  # (h, w)
+
+        r = min(size / shape[0], size / shape[1])
+        if not scaleup:
+            r = min(r, 1.0)
+
+        new_unpad = (int(round(shape[1] * r)), int(round(shape[0] * r)))
+        dw = (size - new_unpad[0]) / 2
+        dh = (size - new_unpad[1]) / 2
+
+        top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+        bottom, right = top + new_unpad[1], left + new_unpad[0]
+
+        canvas = self.canvas
+        canvas[:top] = color
+        canvas[bottom:] = color
+        canvas[top:bottom, :left] = color
+        canvas[top:bottom, right:] = color
+
+        region = canvas[top:bottom, left:right]
+        if shape[::-1] != new_unpad:
+            cv2.resize(img, new_unpad, dst=region, interpolation=cv2.INTER_LINEAR)
+        else:
+            region[:] = img
+
+        if out is not None:
+            return normalize_into(canvas, out), r, (dw, dh)
+        normalize_into(canvas, self.blob[0])
+        return self.blob, r, (dw, dh)
+
+    # --------------------
+    # 引き伸ばしリサイズ (app2.py / app3.py)
+    # --------------------
+    def stretch(self, img, out=None):
+        """戻り値: blob (1, 3, size, size)。out は letterbox と同じ"""
+        size = self.size
+        if img.shape[:2] == (size, size):
+            src = img
+        else:
+            src = cv2.resize(img, (size, size), dst=self.canvas)
+        if out is not None:
+            return normalize_into(src, out)
+        normalize_into(src, self.blob[0])
+        return self.blob
+
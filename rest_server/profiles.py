@@ -0,0 +1,270 @@
+import argparse
+import glob
+import os
+
+import cv2
+import onnxruntime as ort
+
+from preprocess import InputBuffers
+
+# =====================
+# 実行プロファイル (FP32 / FP16 / INT8)
+# =====================
+# MODEL_PROFILE で読み込むモデルを選ぶ。FP16 / INT8 は best.onnx から事前に作っておく
+# (このファイルを直接実行する。下の main 参照)。
+#
+#   fp32 : best.onnx そのまま
+#   fp16 : best.fp16.onnx   (重み・演算を FP16 に。CPU では対応していない演算は FP32 のまま)
+#   int8 : best.int8.onnx   (dynamic: 重みだけ INT8 / static: 校正画像で活性も INT8 の QDQ)
+#
+# ORT_OPT_LEVEL はグラフ最適化のレベル。最適化後のグラフ
+# best.<profile>.opt-<level>-<ep>.onnx があればそれを最適化なしで読む (起動時間の短縮。
+# 元のモデルの方が新しければ使わない)。ORT_SAVE_OPTIMIZED=1 なら起動時に書き出し、
+# `python profiles.py --optimize` ならデプロイ前に作っておける。
+# レベル all の最適化はハードウェア依存なので、ファイル名に実際に使われた実行プロバイダを
+# 入れている (CPU の世代が違うマシンでは作り直すこと)。
+
+MODEL_PROFILE = os.environ.get("MODEL_PROFILE", "fp32")
+ORT_OPT_LEVEL = os.environ.get("ORT_OPT_LEVEL", "all")
+ORT_SAVE_OPTIMIZED = os.environ.get("ORT_SAVE_OPTIMIZED", "0") == "1"
+
+PROFILES = ("fp32", "fp16", "int8")
+OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+DEFAULT_PROVIDERS = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def profile_path(model_path, profile=MODEL_PROFILE):
+    """プロファイルのモデルファイル (best.onnx -> best.fp16.onnx など)"""
+    if profile not in PROFILES:
+        raise ValueError(f"MODEL_PROFILE must be one of {', '.join(PROFILES)}")
+    if profile == "fp32":
+        return model_path
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.{profile}{ext}"
+
+
+def optimized_path(path, opt_level, provider):
+    root, ext = os.path.splitext(path)
+    ep = provider.replace("ExecutionProvider", "").lower()
+    return f"{root}.opt-{opt_level}-{ep}{ext}"
+
+
+def available_providers(providers=DEFAULT_PROVIDERS):
+    available = ort.get_available_providers()
+    return [p for p in providers if p in available]
+
+
+# 呼び出し元の SessionOptions から引き継ぐ設定 (SessionOptions はコピーできないので 1 つずつ写す。
+# add_session_config_entry などで足した項目は引き継がない)
+_OPTION_ATTRS = (
+    "intra_op_num_threads", "inter_op_num_threads", "execution_mode", "execution_order",
+    "enable_cpu_mem_arena", "enable_mem_pattern", "enable_mem_reuse", "enable_profiling",
+    "profile_file_prefix", "log_severity_level", "log_verbosity_level", "logid",
+    "use_deterministic_compute", "use_per_session_threads",
+)
+
+
+def _session_options(sess_options, opt_level):
+    """sess_options を書き換えないよう、写した新しい SessionOptions に最適化レベルを設定する"""
+    so = ort.SessionOptions()
+    if sess_options is not None:
+        for name in _OPTION_ATTRS:
+            setattr(so, name, getattr(sess_options, name))
+    so.graph_optimization_level = OPT_LEVELS[opt_level]
+    return so
+
+
+def create_session(model_path, profile=MODEL_PROFILE, opt_level=ORT_OPT_LEVEL,
+                   save_optimized=ORT_SAVE_OPTIMIZED, sess_options=None,
+                   providers=DEFAULT_PROVIDERS):
+    """プロファイルのモデルで InferenceSession を作る。(sess, 読み込んだファイル) を返す
+
+    sess_options は書き換えない。最適化済みグラフのファイル名は、実際にセッションで
+    使われた実行プロバイダ (sess.get_providers()[0]) で付ける (CUDA が使えず CPU に
+    落ちたときに、CPU 向けのグラフを CUDA の名前で残さない)。
+    """
+    path = profile_path(model_path, profile)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} not found; build it with "
+            f"`python profiles.py --model {model_path} --profiles {profile}`"
+        )
+    if opt_level not in OPT_LEVELS:
+        raise ValueError(f"ORT_OPT_LEVEL must be one of {', '.join(OPT_LEVELS)}")
+
+    providers = available_providers(providers)
+    if opt_level == "disable":
+        so = _session_options(sess_options, opt_level)
+        return ort.InferenceSession(path, sess_options=so, providers=providers), path
+
+    cached = optimized_path(path, opt_level, providers[0])
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        # 最適化済みなので、読み込み時の最適化は省く
+        so = _session_options(sess_options, "disable")
+        sess = ort.InferenceSession(cached, sess_options=so, providers=providers)
+        if sess.get_providers()[0] == providers[0]:
+            return sess, cached
+        # 別のプロバイダに落ちた。そのプロバイダ向けではないグラフなので元のモデルから作る
+        del sess
+
+    so = _session_options(sess_options, opt_level)
+    if not save_optimized:
+        return ort.InferenceSession(path, sess_options=so, providers=providers), path
+
+    # 複数のワーカーが同時に書いても壊れないよう、別名で書いてから置き換える
+    tmp = f"{path}.opt-{os.getpid()}.tmp"
+    so.optimized_model_filepath = tmp
+    try:
+        sess = ort.InferenceSession(path, sess_options=so, providers=providers)
+        os.replace(tmp, optimized_path(path, opt_level, sess.get_providers()[0]))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return sess, path
+
+
+# =====================
+# FP16 / INT8 モデルの作成
+# =====================
+def build_fp16(model_path, out_path, keep_io_types=True, exclude=None):
+    """FP16 モデルを作る。keep_io_types=False なら入力も float16 (preprocess.input_dtype で判定)"""
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = convert_float_to_float16(
+        onnx.load(model_path),
+        keep_io_types=keep_io_types,
+        node_block_list=exclude or None,
+    )
+    onnx.save(model, out_path)
+
+
+def calibration_images(folder):
+    paths = sorted(
+        p for p in glob.glob(os.path.join(folder, "**", "*"), recursive=True)
+        if p.lower().endswith(IMAGE_EXTS)
+    )
+    if not paths:
+        raise FileNotFoundError(f"no images in {folder}")
+    return paths
+
+
+def build_int8(model_path, out_path, mode="dynamic", calib_dir=None, input_size=1280,
+               fit="stretch", limit=200, exclude=None):
+    """INT8 モデルを作る
+
+    dynamic : 重みだけ INT8 (校正不要)
+    static  : calib_dir の画像を本番と同じ前処理 (fit) で流して活性の範囲を決める (QDQ 形式)
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # 量子化前に形状推論と基本的な最適化をかけておく (推奨手順)。
+    # CNN なので ONNX の形状推論で足り、symbolic (sympy が要る) は使わない
+    prepared = out_path + ".prep.onnx"
+    quant_pre_process(model_path, prepared, skip_symbolic_shape=True)
+    try:
+        if mode == "dynamic":
+            quantize_dynamic(
+                prepared, out_path,
+                weight_type=QuantType.QInt8, per_channel=True,
+                nodes_to_exclude=exclude or [],
+            )
+            return
+        if mode != "static":
+            raise ValueError("mode must be dynamic or static")
+        if calib_dir is None:
+            raise ValueError("static quantization needs calibration images")
+
+        input_name = ort.InferenceSession(
+            model_path, providers=["CPUExecutionProvider"]
+        ).get_inputs()[0].name
+        paths = calibration_images(calib_dir)[:limit]
+        buffers = InputBuffers(input_size)
+
+        class Reader(CalibrationDataReader):
+
+            def __init__(self):
+                self._it = iter(paths)
+
+            def get_next(self):
+                for path in self._it:
+                    img = cv2.imread(path, cv2.IMREAD_COLOR)
+                    if img is None:
+                        continue
+                    if fit == "letterbox":
+                        blob = buffers.letterbox(img)[0]
+                    else:
+                        blob = buffers.stretch(img)
+                    return {input_name: blob.copy()}
+                return None
+
+        quantize_static(
+            prepared, out_path, Reader(),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+            per_channel=True,
+            nodes_to_exclude=exclude or [],
+        )
+    finally:
+        os.remove(prepared)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FP16 / INT8 のモデルを作る")
+    parser.add_argument("--model", default="best.onnx")
+    parser.add_argument(
+        "--profiles",
+        help="作るプロファイルをカンマ区切り (既定は fp16,int8。--optimize では MODEL_PROFILE)"
+    )
+    parser.add_argument("--int8", choices=("dynamic", "static"), default="dynamic")
+    parser.add_argument("--calib", help="static 量子化の校正画像フォルダ")
+    parser.add_argument("--calib-limit", type=int, default=200)
+    parser.add_argument("--input-size", type=int, default=1280)
+    parser.add_argument("--fit", choices=("stretch", "letterbox"), default="stretch",
+                        help="校正画像の前処理 (app.py は letterbox、app2/app3 は stretch)")
+    parser.add_argument("--fp16-io", action="store_true",
+                        help="FP16 モデルの入出力も float16 にする (既定は float32 のまま)")
+    parser.add_argument("--exclude", default="", help="量子化 / FP16 化しないノード名 (カンマ区切り)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="作らずに、既存のモデルの最適化済みグラフだけ書き出す (ORT_OPT_LEVEL)")
+    args = parser.parse_args(argv)
+    if args.profiles is None:
+        # --optimize は作ったモデルではなく、サーバーが読むモデルの最適化済みグラフを書き出す
+        args.profiles = MODEL_PROFILE if args.optimize else "fp16,int8"
+
+    if args.optimize:
+        for profile in args.profiles.split(","):
+            sess, _ = create_session(args.model, profile=profile, save_optimized=True)
+            path = optimized_path(
+                profile_path(args.model, profile), ORT_OPT_LEVEL, sess.get_providers()[0]
+            )
+            print(f"{profile}: {path}")
+        return
+
+    exclude = [n for n in args.exclude.split(",") if n]
+    for profile in args.profiles.split(","):
+        out = profile_path(args.model, profile)
+        if profile == "fp16":
+            build_fp16(args.model, out, keep_io_types=not args.fp16_io, exclude=exclude)
+        elif profile == "int8":
+            build_int8(
+                args.model, out, mode=args.int8, calib_dir=args.calib,
+                input_size=args.input_size, fit=args.fit, limit=args.calib_limit,
+                exclude=exclude,
+            )
+        else:
+            continue
+        print(f"{profile}: {out} ({os.path.getsize(out) / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# =====================
+# 複数 ROI・多角形 ROI・クラスごとのしきい値（/predict）
+# =====================
+# 1 枚の写真にある複数の束を数えるのに、ROI ごとに同じ画像を送り直さなくて済むよう、
+# /predict のフォームで ROI の一覧とクラスごとのしきい値を受け取る。
+#
+#   rois=[[x1, y1, x2, y2], {"id": "A", "box": [x1, y1, x2, y2]},
+#         {"id": "B", "polygon": [[x, y], [x, y], ...]}]
+#   thresholds={"pipe": {"score": 0.4, "nms": 0.45}, "muku": {"score": 0.5}}
+#
+# 画像は 1 回だけデコードし、各 ROI の切り出しをまとめて 1 つの blob で推論する。
+# 多角形は外接矩形で推論し、中心が多角形の外にある検出を NMS の前に捨てる。
+# thresholds を渡すと NMS はクラスごとになり、書かれていないクラスはプリセットの値を使う。
+
+PREDICT_MAX_ROIS = int(os.environ.get("PREDICT_MAX_ROIS", "32"))    # 1 リクエストの ROI 数の上限
+
+
+class Roi(namedtuple("Roi", "id box polygon")):
+    """box は外接矩形 (x1, y1, x2, y2)、polygon は ((x, y), ...) か None (矩形)"""
+
+    __slots__ = ()
+
+
+def _box(value):
+    try:
+        x1, y1, x2, y2 = (int(v) for v in value)
+    except (TypeError, ValueError):
+        raise ValueError("roi box must be [x1, y1, x2, y2]")
+    x1, x2 = sorted([x1, x2])
+    y1, y2 = sorted([y1, y2])
+    return x1, y1, x2, y2
+
+
+def _polygon(value):
+    try:
+        points = tuple((int(x), int(y)) for x, y in value)
+    except (TypeError, ValueError):
+        raise ValueError("roi polygon must be [[x, y], ...]")
+    if len(points) < 3:
+        raise ValueError("roi polygon needs at least 3 points")
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return points, (min(xs), min(ys), max(xs), max(ys))
+
+
+def parse_rois(text, max_rois=PREDICT_MAX_ROIS):
+    """フォームの rois (JSON) → [Roi, ...]。不正な値は ValueError"""
+    try:
+        items = json.loads(text)
+    except ValueError:
+        raise ValueError("rois must be a JSON array")
+    if not isinstance(items, list) or not items:
+        raise ValueError("rois must be a non-empty JSON array")
+    if len(items) > max_rois:
+        raise ValueError(f"too many rois (max {max_rois})")
+
+    rois = []
+    for i, item in enumerate(items):
+        if isinstance(item, list):
+            rois.append(Roi(i, _box(item), None))
+            continue
+        if not isinstance(item, dict):
+            raise ValueError("each roi must be [x1, y1, x2, y2] or an object")
+        roi_id = item.get("id", i)
+        if not isinstance(roi_id, (str, int)):
+            raise ValueError("roi id must be a string or an integer")
+        if "polygon" in item:
+            polygon, box = _polygon(item["polygon"])
+            rois.append(Roi(roi_id, box, polygon))
+        elif "box" in item:
+            rois.append(Roi(roi_id, _box(item["box"]), None))
+        else:
+            raise ValueError("roi object needs box or polygon")
+    return rois
+
+
+def parse_class_thresholds(text, names):
+    """フォームの thresholds (JSON) → ((class_id, score, nms), ...)
+
+    score / nms を省いたクラスは None (プリセットの値)。空なら ()。
+    """
+    if not text:
+        return ()
+    try:
+        items = json.loads(text)
+    except ValueError:
+        raise ValueError("thresholds must be a JSON object")
+    if not isinstance(items, dict):
+        raise ValueError("thresholds must be a JSON object")
+
+    thresholds = []
+    for name, values in items.items():
+        if name not in names:
+            raise ValueError(f"unknown class in thresholds: {name}")
+        if not isinstance(values, dict):
+            raise ValueError("thresholds must map class names to {score, nms}")
+        try:
+            score = values.get("score")
+            nms = values.get("nms")
+            score = None if score is None else float(score)
+            nms = None if nms is None else float(nms)
+        except (TypeError, ValueError):
+            raise ValueError("threshold values must be numbers")
+        if any(v is not None and not 0 <= v <= 1 for v in (score, nms)):
+            raise ValueError("threshold values must be between 0 and 1")
+        thresholds.append((names.index(name), score, nms))
+    return tuple(sorted(thresholds))
+
+
+def resolve_thresholds(class_thres, score_thres, nms_thres):
+    """((class_id, score, nms), ...) の None をプリセットの値で埋めた {class_id: (score, nms)}"""
+    return {
+        cls: (score_thres if score is None else score, nms_thres if nms is None else nms)
+        for cls, score, nms in class_thres
+    }
+
+
+def decode_size(rois):
+    """縮小デコードの倍率を決める大きさ (どの ROI も input_size を下回らないよう最小を取る)"""
+    return (
+        min(r.box[2] - r.box[0] for r in rois),
+        min(r.box[3] - r.box[1] for r in rois),
+    )
+
+
+def polygon_mask(polygon, origin, size, factor=1):
+    """多角形の内側を 1 にしたマスク (倍率 factor で展開した画像の、origin を左上とする size の範囲)"""
+    w, h = size
+    mask = np.zeros((h, w), np.uint8)
+    points = np.array(
+        [((x // factor) - origin[0], (y // factor) - origin[1]) for x, y in polygon],
+        np.int32
+    )
+    cv2.fillPoly(mask, [points], 1)
+    return mask
+
+
+def centers_inside(mask, boxes, origin=(0, 0)):
+    """[x, y, w, h] の中心が mask の内側にあるか (bool 配列)。origin は boxes の座標でのマスク左上"""
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    h, w = mask.shape
+    cx = boxes[:, 0] + boxes[:, 2] // 2 - origin[0]
+    cy = boxes[:, 1] + boxes[:, 3] // 2 - origin[1]
+    # マスクの外 (ROI の外接矩形の外) の中心は、端の画素が多角形の内側でも外側とする
+    in_bounds = (cx >= 0) & (cx < w) & (cy >= 0) & (cy < h)
+    inside = mask[np.clip(cy, 0, h - 1), np.clip(cx, 0, w - 1)].astype(bool)
+    return in_bounds & inside
@@ -0,0 +1,474 @@
+from flask import Flask, request, jsonify, send_file
+from flask_cors import CORS
+
+import cv2
+import io
+import base64
+import json
+import logging
+import os
+
+import numpy as np
+
+from batching import BatchScheduler, BoundRunner
+from cache import DetectionCache, cache_key, model_hash
+from decode import clip_roi, decode_upload, reduce_roi
+from detections import (
+    build_result, build_rois_result, detections_response, draw_labels, draw_markers,
+    draw_rois, preview_options, render_preview, response_mode, roi_counts
+)
+from emails import emails_bp
+from metrics import install_metrics, stage
+from nms import METHODS as NMS_METHODS, NMS_METHOD
+from preprocess import InputBuffers, input_dtype
+from profiles import MODEL_PROFILE, create_session, profile_path
+from rois import decode_size, parse_class_thresholds, parse_rois
+from startup import Startup
+from stream import stream_blueprint
+from workers import (
+    INFER_WORKERS, WorkerBusy, WorkerError, WorkerPool, detect_image, detect_rois,
+    session_options
+)
+
+# =====================
+# 推論サーバー（app.py / app2.py / app3.py を 1 つに）
+# =====================
+# 3 本のスクリプトはモデルの読み込み・前処理・後処理・emails API をそれぞれ持ち、
+# 別々に起動するとモデルもプロセスの数だけメモリに載っていた。
+# ここではモデルを 1 回だけ読み込み、違いはプリセットとして選ぶ。
+#
+#   app  : letterbox、ROI あり（ROI 左上基準）、NMS 0.3 / 0.3、画像応答は counts + base64 の JSON
+#   app2 : stretch、画像全体、NMS 1e-4 / 0.5、画像応答は JPEG
+#   app3 : stretch、ROI あり（画像の座標）、NMS 0.3 / 0.5、画像応答は JPEG
+#
+# 既定のプリセットは SERVER_PRESET。リクエストごとに preset=app|app2|app3 で選べ、
+# fit=letterbox|stretch で前処理だけ変えることもできる。応答形式は従来どおり response=。
+# rois= で複数の ROI (多角形も可)、thresholds= でクラスごとのしきい値を渡せる (rois.py)。
+# nms=hard|center|soft|cv2 で重複除去の方法を選べる (既定は NMS_METHOD。nms.py)。
+#
+# 本番は gunicorn で preload して複数ワーカーを fork する（gunicorn.conf.py）。
+# マスターで読み込んだモデルの重みは、コピーオンライトで全ワーカーが共有する。
+#
+#   cd rest_server
+#   gunicorn -c gunicorn.conf.py server:app
+
+SERVER_PRESET = os.environ.get("SERVER_PRESET", "app3")
+SERVER_EMAILS = os.environ.get("SERVER_EMAILS", "1") == "1"     # emails API / SSE も載せる
+
+# ログ（LOG_LEVEL=DEBUG でリクエストごとの詳細、LOG_BOXES=1 で検出 1 件ごと）
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+log = logging.getLogger(__name__)
+
+# 起動の各段階と最初の推論までの時間を記録（/ready）
+startup = Startup()
+startup.phase("import")
+
+# =====================
+# モデル設定
+# =====================
+MODEL_PATH = "best.onnx"
+INPUT_SIZE = 1280
+NAMES = ["pipe", "muku"]
+
+PRESETS = {
+    "app": {
+        "fit": "letterbox", "roi": True, "frame": "roi",
+        "score_thres": 0.3, "nms_thres": 0.3, "image": "counts",
+    },
+    "app2": {
+        "fit": "stretch", "roi": False, "frame": "image",
+        "score_thres": 1e-4, "nms_thres": 0.5, "image": "jpeg",
+    },
+    "app3": {
+        "fit": "stretch", "roi": True, "frame": "image",
+        "score_thres": 0.3, "nms_thres": 0.5, "image": "jpeg",
+    },
+}
+FITS = ("letterbox", "stretch")
+
+# マイクロバッチ設定（同時リクエストをまとめて推論）
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "5"))
+ORT_IOBINDING = os.environ.get("ORT_IOBINDING", "0") == "1"   # IOBinding で入出力を渡す
+# intra-op スレッド数（0 なら ONNX Runtime の既定。fork するなら 1 にする。gunicorn.conf.py 参照）
+ORT_INTRA_THREADS = int(os.environ.get("ORT_INTRA_THREADS", "0"))
+
+# =====================
+# 推論ワーカー（INFER_WORKERS>0 ならデコード〜NMS を別プロセスで）
+# =====================
+# fork するので、セッションやスレッドを作る前に起動する
+worker_pool = WorkerPool(MODEL_PATH, input_size=INPUT_SIZE) if INFER_WORKERS > 0 else None
+
+# =====================
+# ONNX Runtime
+# =====================
+# MODEL_PROFILE=fp32/fp16/int8 で読み込むモデルを選ぶ（profiles.py）
+sess, model_file = create_session(
+    MODEL_PATH,
+    sess_options=session_options(ORT_INTRA_THREADS, 1) if ORT_INTRA_THREADS > 0 else None
+)
+startup.phase("session")
+input_name = sess.get_inputs()[0].name
+log.info("ONNX model: %s profile: %s input: %s", model_file, MODEL_PROFILE, input_name)
+
+# 推論結果キャッシュ（モデルを差し替えたら別キーになる）
+MODEL_HASH = model_hash(profile_path(MODEL_PATH))
+result_cache = DetectionCache()
+
+scheduler = BatchScheduler(
+    sess, input_name,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    io_binding=ORT_IOBINDING
+)
+
+# 前処理はスレッドごとの確保済みバッファに書き込む
+INPUT_DTYPE = input_dtype(sess)   # FP16 モデルなら float16
+buffers = InputBuffers(INPUT_SIZE, dtype=INPUT_DTYPE)
+
+# =====================
+# ウォームアップ（終わってから受け付ける）
+# =====================
+startup.warm_up(
+    BoundRunner(sess, input_name) if ORT_IOBINDING
+    else lambda blob: sess.run(None, {input_name: blob}),
+    INPUT_SIZE, INPUT_DTYPE
+)
+startup.mark_ready()
+
+
+# =====================
+# 推論API
+# =====================
+def predict(default_preset):
+    if "image" not in request.files:
+        return jsonify({"error": "no image"}), 400
+
+    # プリセットと前処理
+    name = request.form.get("preset") or default_preset
+    if name not in PRESETS:
+        return jsonify({"error": f"preset must be one of {', '.join(PRESETS)}"}), 400
+    preset = PRESETS[name]
+    fit = request.form.get("fit") or preset["fit"]
+    if fit not in FITS:
+        return jsonify({"error": "fit must be letterbox or stretch"}), 400
+
+    # 応答形式（image / json / msgpack）
+    try:
+        mode = response_mode(request)
+        preview_size, preview_format = preview_options(request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    tiled = request.form.get("tiled") in ("1", "true")
+    nms_method = request.form.get("nms") or NMS_METHOD
+    if nms_method not in NMS_METHODS:
+        return jsonify({"error": f"nms must be one of {', '.join(NMS_METHODS)}"}), 400
+
+    # 複数 ROI とクラスごとのしきい値
+    try:
+        class_thres = parse_class_thresholds(request.form.get("thresholds"), NAMES)
+        rois = parse_rois(request.form["rois"]) if request.form.get("rois") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if rois is not None:
+        return predict_rois(
+            name, preset, fit, rois, class_thres, nms_method, mode, preview_size,
+            preview_format, tiled
+        )
+
+    # --------------------
+    # ROI 座標（Nuxtから。app2 は画像全体）
+    # --------------------
+    roi = None
+    if preset["roi"]:
+        try:
+            x1 = int(request.form.get("x1"))
+            y1 = int(request.form.get("y1"))
+            x2 = int(request.form.get("x2"))
+            y2 = int(request.form.get("y2"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "invalid roi"}), 400
+        x1, x2 = sorted([x1, x2])
+        y1, y2 = sorted([y1, y2])
+        roi = (x1, y1, x2, y2)
+
+    # --------------------
+    # 画像読み込み
+    # --------------------
+    # 画像を返さない応答形式では、ROI が入力サイズを下回らない範囲で縮小デコードする
+    img_bytes = request.files["image"].read()
+    reduce = mode != "image" and not tiled
+    params = dict(
+        fit=fit, roi=roi, frame=preset["frame"], tiled=tiled,
+        score_thres=preset["score_thres"], nms_thres=preset["nms_thres"],
+        class_thres=class_thres, nms_method=nms_method
+    )
+
+    # 同じ画像・ROI・プリセットの再送なら推論を省く
+    key = cache_key(
+        img_bytes, MODEL_HASH, name, fit, roi, tiled, reduce, class_thres, nms_method
+    )
+    cached = result_cache.get(key)
+
+    if cached is None and worker_pool is not None:
+        # デコード〜NMS をワーカープロセスで（描画しないならフロントではデコードしない）
+        try:
+            with stage("worker"):
+                cached = worker_pool.detect(img_bytes, reduce=reduce, **params)
+        except WorkerBusy as e:
+            return jsonify({"error": str(e)}), 503
+        except WorkerError as e:
+            return jsonify({"error": str(e)}), 400
+        result_cache.put(key, cached)
+
+    if cached is not None and mode != "image" and not preview_size:
+        # 描画しないならデコードも不要
+        img, factor, orig_size = None, cached.factor, cached.orig_size
+    else:
+        with stage("decode"):
+            img, factor, orig_size = decode_upload(
+                img_bytes,
+                roi_size=(x2 - x1, y2 - y1) if roi is not None else None,
+                input_size=INPUT_SIZE,
+                letterbox=fit == "letterbox",
+                reduce=reduce
+            )
+        if img is None:
+            return jsonify({"error": "invalid image"}), 400
+
+    orig_w, orig_h = orig_size
+    if roi is not None:
+        roi = clip_roi(roi, orig_size)
+        if roi is None:
+            return jsonify({"error": "empty roi"}), 400
+        params["roi"] = roi
+
+    if cached is None:
+        cached = detect_image(
+            img, factor, orig_size, scheduler.run, buffers, INPUT_SIZE,
+            max_batch_size=scheduler.max_batch_size, **params
+        )
+        result_cache.put(key, cached)
+
+    # 以降は NMS 後の検出だけを扱う
+    boxes, scores, class_ids, indices = cached.unpack()
+    keep = indices.flatten() if len(indices) > 0 else []
+    log.debug(
+        "preset=%s fit=%s roi=%s decode_scale=%d tiles=%d kept=%d",
+        name, fit, roi, factor, cached.n_tiles, len(keep)
+    )
+
+    # 縮小デコードした画像上の ROI（app2 は画像全体）
+    x1, y1, x2, y2 = roi if roi is not None else (0, 0, orig_w, orig_h)
+    rx1, ry1, rx2, ry2 = reduce_roi((x1, y1, x2, y2), factor)
+    roi_img = img[ry1:ry2, rx1:rx2] if img is not None else None
+
+    # --------------------
+    # 検出結果だけ返す（描画は Nuxt 側）
+    # --------------------
+    if mode != "image":
+        # 画像全体を stretch した検出はもう元画像の座標（workers.detect_image）
+        scale = 1 if roi is None and fit == "stretch" else factor
+        offset = (rx1, ry1) if preset["frame"] == "roi" else (0, 0)
+        result = build_result(
+            boxes, scores, class_ids, keep, NAMES,
+            (orig_w, orig_h), offset=offset, scale=scale
+        )
+        if roi is not None:
+            result["roi"] = [x1, y1, x2, y2]
+        result["tiles"] = cached.n_tiles
+        result["decode_scale"] = factor
+        preview = None
+        if preview_size:
+            with stage("render"):
+                preview = render_preview(
+                    roi_img, result["boxes"], preview_size, preview_format,
+                    origin=(rx1 * factor, ry1 * factor), factor=factor
+                )
+        with stage("encode"):
+            return detections_response(result, mode, preview, preview_format)
+
+    # --------------------
+    # サーバーで描画して返す（ROI 基準の検出は ROI に、画像基準の検出は画像全体に）
+    # --------------------
+    canvas = roi_img if preset["frame"] == "roi" else img
+    if preset["image"] == "counts":
+        with stage("render"):
+            img_draw, counts = draw_markers(
+                canvas, boxes, scores, class_ids, keep, NAMES,
+                request.form.getlist("classes[]")
+            )
+        with stage("encode"):
+            _, buf = cv2.imencode(".jpg", img_draw)
+            img_base64 = base64.b64encode(buf).decode("utf-8")
+        return jsonify({"counts": counts, "image": img_base64, "tiles": cached.n_tiles})
+
+    with stage("render"):
+        img_draw = draw_labels(canvas, boxes, scores, class_ids, keep, NAMES)
+    with stage("encode"):
+        _, buf = cv2.imencode(".jpg", img_draw)
+    return send_file(io.BytesIO(buf.tobytes()), mimetype="image/jpeg")
+
+
+def predict_rois(name, preset, fit, rois, class_thres, nms_method, mode, preview_size,
+                 preview_format, tiled):
+    """rois= 付きの /predict: 画像を 1 回だけデコードし、全 ROI をまとめて推論する
+
+    座標はどのプリセットでもアップロードされた画像の座標 (ROI ごとの左上基準にはしない)。
+    """
+    img_bytes = request.files["image"].read()
+    reduce = mode != "image" and not tiled
+    params = dict(
+        fit=fit, tiled=tiled, score_thres=preset["score_thres"],
+        nms_thres=preset["nms_thres"], class_thres=class_thres, nms_method=nms_method
+    )
+
+    key = cache_key(
+        img_bytes, MODEL_HASH, name, fit, tuple(rois), tiled, reduce, class_thres, nms_method
+    )
+    cached = result_cache.get(key)
+
+    if cached is None and worker_pool is not None:
+        try:
+            with stage("worker"):
+                cached = worker_pool.detect(img_bytes, reduce=reduce, rois=rois, **params)
+        except WorkerBusy as e:
+            return jsonify({"error": str(e)}), 503
+        except WorkerError as e:
+            return jsonify({"error": str(e)}), 400
+        result_cache.put(key, cached)
+
+    if cached is not None and mode != "image" and not preview_size:
+        img, factor, orig_size = None, cached[0].factor, cached[0].orig_size
+    else:
+        with stage("decode"):
+            img, factor, orig_size = decode_upload(
+                img_bytes, roi_size=decode_size(rois), input_size=INPUT_SIZE,
+                letterbox=fit == "letterbox", reduce=reduce
+            )
+        if img is None:
+            return jsonify({"error": "invalid image"}), 400
+
+    if cached is None:
+        try:
+            cached = detect_rois(
+                img, factor, orig_size, rois, scheduler.run, buffers, INPUT_SIZE,
+                max_batch_size=scheduler.max_batch_size, **params
+            )
+        except WorkerError as e:
+            return jsonify({"error": str(e)}), 400
+        result_cache.put(key, cached)
+
+    n_tiles = sum(det.n_tiles for det in cached)
+    log.debug(
+        "preset=%s fit=%s rois=%d decode_scale=%d tiles=%d kept=%d",
+        name, fit, len(rois), factor, n_tiles, sum(len(det.boxes) for det in cached)
+    )
+
+    if mode != "image":
+        result = build_rois_result(cached, rois, NAMES, orig_size, scale=factor)
+        result["tiles"] = n_tiles
+        result["decode_scale"] = factor
+        preview = None
+        if preview_size:
+            with stage("render"):
+                preview = render_preview(
+                    img, [box for item in result["rois"] for box in item["boxes"]],
+                    preview_size, preview_format, factor=factor
+                )
+        with stage("encode"):
+            return detections_response(result, mode, preview, preview_format)
+
+    # 全 ROI の検出を画像全体に描き、ROI の枠を重ねる
+    boxes = np.concatenate([det.boxes for det in cached]).tolist()
+    scores = np.concatenate([det.scores for det in cached]).tolist()
+    class_ids = np.concatenate([det.class_ids for det in cached]).tolist()
+    keep = range(len(boxes))
+    per_roi = roi_counts(cached, rois, NAMES)
+
+    if preset["image"] == "counts":
+        with stage("render"):
+            img_draw, counts = draw_markers(
+                img, boxes, scores, class_ids, keep, NAMES, request.form.getlist("classes[]")
+            )
+            draw_rois(img_draw, rois, factor)
+        with stage("encode"):
+            _, buf = cv2.imencode(".jpg", img_draw)
+            img_base64 = base64.b64encode(buf).decode("utf-8")
+        return jsonify({
+            "counts": counts, "rois": per_roi, "image": img_base64, "tiles": n_tiles
+        })
+
+    with stage("render"):
+        img_draw = draw_rois(draw_labels(img, boxes, scores, class_ids, keep, NAMES), rois, factor)
+    with stage("encode"):
+        _, buf = cv2.imencode(".jpg", img_draw)
+    # JPEG 応答では ROI ごとの件数をヘッダーで返す
+    response = send_file(io.BytesIO(buf.tobytes()), mimetype="image/jpeg")
+    response.headers["X-ROI-Counts"] = json.dumps(per_roi)
+    response.headers["Access-Control-Expose-Headers"] = "X-ROI-Counts"
+    return response
+
+
+# バッチ推論メトリクス
+def predict_stats():
+    stats = {
+        **scheduler.stats(),
+        "cache": result_cache.stats(),
+        "startup": startup.report(),
+    }
+    if worker_pool is not None:
+        stats["workers"] = worker_pool.stats()
+    return jsonify(stats)
+
+
+# レディネス（ウォームアップとワーカーの準備が済むまで 503。pid はどのプロセスが答えたか）
+def ready():
+    report = startup.report()
+    report["pid"] = os.getpid()
+    if worker_pool is not None:
+        workers_ready = worker_pool.stats()["ready"]
+        report["workers_ready"] = workers_ready
+        report["ready"] = report["ready"] and workers_ready >= worker_pool.workers
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+# =====================
+# Flask
+# =====================
+def create_app(preset=SERVER_PRESET, emails=SERVER_EMAILS):
+    """preset を既定にした Flask アプリ（モデル・キャッシュ・スケジューラは共有）"""
+    if preset not in PRESETS:
+        raise ValueError(f"SERVER_PRESET must be one of {', '.join(PRESETS)}")
+    settings = PRESETS[preset]
+
+    app = Flask(__name__)
+    CORS(app)
+    # 段ごとの所要時間・DB・SSE を /metrics で返す（PROFILE_ENABLE=1 なら /debug/profile も）
+    install_metrics(app)
+    startup.install(app)
+    if emails:
+        app.register_blueprint(emails_bp)
+
+    # フレームストリーム（/predict/stream、既定のプリセットと同じしきい値）
+    app.register_blueprint(stream_blueprint(
+        scheduler.run, INPUT_SIZE, NAMES, dtype=INPUT_DTYPE, fit=settings["fit"],
+        score_thres=settings["score_thres"], nms_thres=settings["nms_thres"]
+    ))
+
+    app.add_url_rule(
+        "/predict", "predict", lambda: predict(preset), methods=["POST"]
+    )
+    app.add_url_rule("/predict/stats", "predict_stats", predict_stats)
+    app.add_url_rule("/ready", "ready", ready)
+    return app
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    app.run(host="localhost", port=5000, threaded=True, debug=True)
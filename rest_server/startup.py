@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from flask import g, request
+
+log = logging.getLogger(__name__)
+
+# =====================
+# 起動時のウォームアップとレディネス
+# =====================
+# 最初の sess.run はグラフの準備やメモリアリーナの拡張を払うので、再起動直後や
+# スケールアウトした直後の 1 リクエスト目が数秒かかる。
+# 起動時 (モジュール読み込み時) に INPUT_SIZE のダミー入力で WARMUP_RUNS 回推論してから
+# 受け付けを始め、/ready はそれが終わる (ワーカーがいればその準備も終わる) まで 503 を返す。
+#
+# 起動の各段階の所要時間と、プロセス開始から最初の推論応答までの時間
+# (time-to-first-prediction) を記録して /ready と /predict/stats で返す。
+
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "3"))
+# ウォームアップするバッチサイズ (マイクロバッチやタイル推論で使う大きさも温めるなら "1,8" など)
+WARMUP_BATCHES = [
+    int(v) for v in os.environ.get("WARMUP_BATCHES", "1").split(",") if v.strip()
+]
+
+
+def process_start_time():
+    """このプロセスが起動した時刻 (time.time() 基準)。/proc がなければ読み込み時刻"""
+    try:
+        with open("/proc/self/stat") as f:
+            # comm に空白が入ることがあるので ")" の後ろから数える
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = int(fields[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class Startup:
+
+    def __init__(self):
+        self.started = process_start_time()
+        self.phases = {}                   # 段階名 -> 秒
+        self.warmup_runs = 0
+        self.ready_at = None
+        self.first_prediction_at = None
+        self.first_prediction_latency = None
+        self._lock = threading.Lock()
+        self._phase_start = self.started
+
+    def phase(self, name):
+        """前回の phase() 呼び出し (最初はプロセス起動) からここまでを name の所要時間として記録"""
+        now = time.time()
+        self.phases[name] = now - self._phase_start
+        self._phase_start = now
+
+    def warm_up(self, run, input_size, dtype=np.float32, runs=WARMUP_RUNS,
+                batches=WARMUP_BATCHES):
+        """run(blob) をダミー入力で runs 回ずつ呼ぶ"""
+        for batch in batches:
+            blob = np.zeros((batch, 3, input_size, input_size), dtype=dtype)
+            for _ in range(runs):
+                run(blob)
+                self.warmup_runs += 1
+        self.phase("warmup")
+
+    def mark_ready(self):
+        self.ready_at = time.time()
+        log.info("ready in %.2fs %s", self.ready_at - self.started, self.phases)
+
+    def first_prediction(self, latency):
+        """最初の推論応答だけ記録する"""
+        if self.first_prediction_at is not None:
+            return
+        with self._lock:
+            if self.first_prediction_at is None:
+                self.first_prediction_at = time.time()
+                self.first_prediction_latency = latency
+                log.info(
+                    "first prediction %.2fs after start (request %.0f ms)",
+                    self.first_prediction_at - self.started, latency * 1000
+                )
+
+    def install(self, app, endpoint="predict"):
+        """endpoint の最初の 200 応答を first_prediction として記録するフックを登録"""
+
+        @app.before_request
+        def _start_timer():
+            if self.first_prediction_at is None and request.endpoint == endpoint:
+                g.request_started = time.perf_counter()
+
+        @app.after_request
+        def _record_first_prediction(response):
+            started = g.get("request_started")
+            if started is not None and response.status_code == 200:
+                self.first_prediction(time.perf_counter() - started)
+            return response
+
+    def report(self):
+        def since_start(t):
+            return None if t is None else round(t - self.started, 3)
+
+        return {
+            "ready": self.ready_at is not None,
+            "phases_s": {k: round(v, 3) for k, v in self.phases.items()},
+            "warmup_runs": self.warmup_runs,
+            "ready_after_s": since_start(self.ready_at),
+            "first_prediction_after_s": since_start(self.first_prediction_at),
+            "first_prediction_latency_ms": (
+                None if self.first_prediction_latency is None
+                else round(self.first_prediction_latency * 1000, 1)
+            ),
+        }
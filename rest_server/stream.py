@@ -0,0 +1,419 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from decode import jpeg_end
+from detections import build_result
+from metrics import REGISTRY
+from nms import suppress
+from postprocess import decode_yolo, letterbox_to_xywh, stretch_to_xywh
+from preprocess import InputBuffers
+
+# =====================
+# フレームストリーム推論
+# =====================
+# /predict は 1 リクエスト 1 枚なので、カメラ映像だとフレームごとに往復が要る。
+# /predict/stream はフレームの列を受け取り、フレームごとの検出を SSE で返し続ける。
+#
+#   POST /predict/stream            本文に JPEG を連結して送り続ける (chunked / MJPEG)
+#   GET  /predict/stream?source=... サーバー上の動画ファイル (STREAM_VIDEO_DIR 内) か
+#                                    カメラ (device:0、STREAM_ALLOW_DEVICES=1 のとき)
+#
+# デコード → 推論 → 後処理 (NMS・応答の組み立て) をそれぞれ別スレッドで流す。
+# 推論が追いつかないときは、デコード済みで待っているフレームを新しいものに置き換える
+# (古いフレームを捨てる。drop=0 なら捨てずに待つ)。skip=N なら N+1 枚に 1 枚だけ推論する。
+#
+# 推論は各アプリの scheduler.run を通すので、他のストリームや /predict とまとめてバッチになる。
+
+STREAM_QUEUE = int(os.environ.get("STREAM_QUEUE", "1"))            # 推論待ちにしておくフレーム数
+STREAM_VIDEO_DIR = os.environ.get("STREAM_VIDEO_DIR", "")           # source= で読めるディレクトリ
+STREAM_ALLOW_DEVICES = os.environ.get("STREAM_ALLOW_DEVICES", "0") == "1"
+STREAM_MAX_FRAME_MB = float(os.environ.get("STREAM_MAX_FRAME_MB", "16"))
+STREAM_KEEPALIVE = 15.0      # 秒。この間フレームが出なければコメント行を送る
+READ_CHUNK = 64 * 1024
+
+_END = object()
+
+# /metrics の接続数は、このプロセスで作った全アプリ (server.app とシムのアプリなど) の合計
+_clients = set()
+_clients_lock = threading.Lock()
+REGISTRY.gauge(
+    "predict_stream_clients", "Connected /predict/stream clients.", lambda: len(_clients)
+)
+
+
+def _event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class StreamError(Exception):
+    pass
+
+
+# =====================
+# フレームの読み込み (デコードスレッドで動く)
+# =====================
+def jpeg_frames(stream, max_bytes=None):
+    """本文に連結された JPEG を 1 枚ずつデコードする
+
+    JPEG の間にあるもの (multipart/x-mixed-replace の区切りやヘッダー) は読み飛ばす。
+    """
+    max_bytes = max_bytes or int(STREAM_MAX_FRAME_MB * 1024 * 1024)
+    buf = bytearray()
+    index = 0
+    eof = False
+    while True:
+        start = buf.find(b"\xff\xd8")
+        end = None
+        if start >= 0:
+            try:
+                end = jpeg_end(buf, start)
+            except ValueError:
+                # SOI に見えただけのゴミ。1 バイト進めて探し直す
+                del buf[:start + 1]
+                continue
+        if end is not None:
+            img = cv2.imdecode(np.frombuffer(bytes(buf[start:end]), np.uint8), cv2.IMREAD_COLOR)
+            del buf[:end]
+            if img is not None:
+                yield index, None, img
+                index += 1
+            continue
+        if eof:
+            return
+        if start > 0:
+            del buf[:start]
+        if len(buf) > max_bytes:
+            raise StreamError("frame too large")
+        chunk = stream.read(READ_CHUNK)
+        if not chunk:
+            eof = True
+        buf += chunk
+
+
+def capture_frames(cap, realtime=True):
+    """cv2.VideoCapture から読む。realtime なら動画の fps の速さで読む (カメラと同じ条件)"""
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+    interval = 1.0 / fps if realtime and fps > 0 else 0.0
+    started = time.monotonic()
+    index = 0
+    try:
+        while True:
+            if interval:
+                delay = started + index * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            ok, img = cap.read()
+            if not ok:
+                return
+            yield index, cap.get(cv2.CAP_PROP_POS_MSEC), img
+            index += 1
+    finally:
+        cap.release()
+
+
+def open_source(source):
+    """source= の値から VideoCapture。許可されていない場所なら StreamError"""
+    if source.startswith("device:"):
+        if not STREAM_ALLOW_DEVICES:
+            raise StreamError("devices are not enabled (STREAM_ALLOW_DEVICES=1)")
+        try:
+            cap = cv2.VideoCapture(int(source.split(":", 1)[1]))
+        except ValueError:
+            raise StreamError("device must be device:<index>")
+    else:
+        if not STREAM_VIDEO_DIR:
+            raise StreamError("video files are not enabled (STREAM_VIDEO_DIR)")
+        root = os.path.realpath(STREAM_VIDEO_DIR)
+        path = os.path.realpath(os.path.join(root, source))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise StreamError("video not found")
+        cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise StreamError("cannot open source")
+    return cap
+
+
+# =====================
+# デコード → 推論 → 後処理 のパイプライン
+# =====================
+class FramePipeline:
+    """frames の各フレームに infer → post をかけ、post の結果を順に返すイテレーター
+
+    frames : (index, pts_ms, img) を返すイテレーター (デコードスレッドで回す)
+    infer  : img -> 中間結果 (推論スレッド)
+    post   : (中間結果, img) -> dict (後処理スレッド)
+    """
+
+    def __init__(self, frames, infer, post, queue_size=STREAM_QUEUE, drop=True, skip=0):
+        self.frames = frames
+        self.infer = infer
+        self.post = post
+        self.drop = drop
+        self.skip = max(0, int(skip))
+
+        self._decoded = queue.Queue(max(1, queue_size))
+        self._inferred = queue.Queue(2)
+        self._out = queue.Queue(8)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.inferred = 0
+        self.emitted = 0
+        self.started = time.monotonic()
+
+        self._threads = [
+            threading.Thread(target=self._decode_loop, name="stream-decode", daemon=True),
+            threading.Thread(target=self._infer_loop, name="stream-infer", daemon=True),
+            threading.Thread(target=self._post_loop, name="stream-post", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _put(self, q, item):
+        """止められるまで待って入れる"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _decode_loop(self):
+        try:
+            for index, pts, img in self.frames:
+                if self._stop.is_set():
+                    return
+                self.received += 1
+                if self.skip and index % (self.skip + 1):
+                    self.skipped += 1
+                    continue
+                item = (index, pts, time.monotonic(), img)
+                if not self.drop:
+                    if not self._put(self._decoded, item):
+                        return
+                    continue
+                # 推論待ちが埋まっていたら、待っている古いフレームを捨てて入れ替える
+                while True:
+                    try:
+                        self._decoded.put_nowait(item)
+                        break
+                    except queue.Full:
+                        try:
+                            self._decoded.get_nowait()
+                            with self._lock:
+                                self.dropped += 1
+                        except queue.Empty:
+                            pass
+        except Exception as e:
+            self._put(self._out, e)
+            self._stop.set()
+            return
+        finally:
+            close = getattr(self.frames, "close", None)
+            if close is not None:
+                close()
+        self._put(self._decoded, _END)
+
+    def _infer_loop(self):
+        while True:
+            item = self._get(self._decoded)
+            if item is _END:
+                self._put(self._inferred, _END)
+                return
+            index, pts, received, img = item
+            try:
+                state = self.infer(img)
+            except Exception as e:
+                self._put(self._out, e)
+                self._stop.set()
+                return
+            self.inferred += 1
+            if not self._put(self._inferred, (index, pts, received, img, state)):
+                return
+
+    def _post_loop(self):
+        while True:
+            item = self._get(self._inferred)
+            if item is _END:
+                self._put(self._out, _END)
+                return
+            index, pts, received, img, state = item
+            try:
+                result = self.post(state, img)
+            except Exception as e:
+                self._put(self._out, e)
+                self._stop.set()
+                return
+            result["frame"] = index
+            if pts is not None:
+                result["pts_ms"] = round(pts, 1)
+            result["latency_ms"] = round((time.monotonic() - received) * 1000, 1)
+            with self._lock:
+                result["dropped"] = self.dropped
+            if not self._put(self._out, result):
+                return
+
+    def get(self, timeout=None):
+        """次の結果。終わりなら None、待ち時間切れなら queue.Empty、段の例外はそのまま送出"""
+        item = self._out.get(timeout=timeout)
+        if item is _END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        self.emitted += 1
+        return item
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            return {
+                "received": self.received,
+                "skipped": self.skipped,
+                "dropped": self.dropped,
+                "inferred": self.inferred,
+                "emitted": self.emitted,
+                "seconds": round(elapsed, 3),
+                "fps": round(self.inferred / elapsed, 2) if elapsed > 0 else 0.0,
+            }
+
+
+# =====================
+# /predict/stream
+# =====================
+def stream_blueprint(run, input_size, names, dtype=np.float32, fit="stretch",
+                     conf_thres=0.3, score_thres=0.3, nms_thres=0.5):
+    """アプリごとの推論設定で /predict/stream の Blueprint を作る
+
+    fit / しきい値は各アプリの /predict と同じにする
+    (app.py: letterbox 0.3/0.3、app2.py: stretch 1e-4/0.5、app3.py: stretch 0.3/0.5)。
+    boxes はフレームの座標 [x, y, w, h]。
+    """
+    bp = Blueprint("stream", __name__)
+    buffers = InputBuffers(input_size, dtype=dtype)
+    active = set()
+    totals = {"streams": 0, "frames": 0, "dropped": 0, "skipped": 0}
+    lock = threading.Lock()
+
+    def infer(img):
+        if fit == "letterbox":
+            blob, ratio, pad = buffers.letterbox(img)
+        else:
+            blob, ratio, pad = buffers.stretch(img), None, None
+        # blob は次のフレームで上書きされるので、出力だけ持ち出す
+        return run(blob)[0][0], ratio, pad
+
+    def post(state, img):
+        preds, ratio, pad = state
+        h, w = img.shape[:2]
+        decoded = decode_yolo(preds, conf_thres=conf_thres)
+        if fit == "letterbox":
+            boxes, scores, class_ids = letterbox_to_xywh(decoded, ratio, pad[0], pad[1], w, h)
+        else:
+            boxes, scores, class_ids = stretch_to_xywh(
+                decoded, w / input_size, h / input_size, clip_size=(w, h)
+            )
+        keep, scores = suppress(boxes, scores, class_ids, score_thres, nms_thres)
+        return build_result(boxes, scores, class_ids, keep, names, (w, h))
+
+    def events(pipeline):
+        with lock:
+            active.add(pipeline)
+            totals["streams"] += 1
+        with _clients_lock:
+            _clients.add(pipeline)
+        try:
+            yield _event("start", {"drop": pipeline.drop, "skip": pipeline.skip})
+            while True:
+                try:
+                    result = pipeline.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                except Exception as e:
+                    yield _event("error", {"error": str(e)})
+                    break
+                if result is None:
+                    break
+                yield _event("detections", result)
+            yield _event("end", pipeline.stats())
+        finally:
+            # クライアントが切断したときもここで止める
+            pipeline.close()
+            stats = pipeline.stats()
+            with lock:
+                active.discard(pipeline)
+                totals["frames"] += stats["inferred"]
+                totals["dropped"] += stats["dropped"]
+                totals["skipped"] += stats["skipped"]
+            with _clients_lock:
+                _clients.discard(pipeline)
+
+    def options(default_drop):
+        try:
+            skip = int(request.args.get("skip", "0"))
+        except ValueError:
+            raise StreamError("skip must be an integer")
+        drop = request.args.get("drop")
+        drop = default_drop if drop is None else drop in ("1", "true")
+        return drop, skip
+
+    @bp.route("/predict/stream", methods=["POST"])
+    def stream_upload():
+        try:
+            drop, skip = options(default_drop=True)
+        except StreamError as e:
+            return jsonify({"error": str(e)}), 400
+        # request はこのスレッドのものなので、本文のストリームそのものを渡す
+        pipeline = FramePipeline(jpeg_frames(request.stream), infer, post, drop=drop, skip=skip)
+        return Response(events(pipeline), mimetype="text/event-stream")
+
+    @bp.route("/predict/stream", methods=["GET"])
+    def stream_source():
+        source = request.args.get("source")
+        if not source:
+            return jsonify({"error": "no source"}), 400
+        device = source.startswith("device:")
+        # カメラは read() がフレームの来る速さで返るので、速度調整はファイルだけ
+        realtime = not device and request.args.get("realtime", "1") in ("1", "true")
+        try:
+            # ファイルを速度どおりに読まないなら、全フレームを推論する
+            drop, skip = options(default_drop=realtime or device)
+            cap = open_source(source)
+        except StreamError as e:
+            return jsonify({"error": str(e)}), 400
+        pipeline = FramePipeline(
+            capture_frames(cap, realtime=realtime), infer, post, drop=drop, skip=skip
+        )
+        return Response(events(pipeline), mimetype="text/event-stream")
+
+    @bp.route("/predict/stream/stats")
+    def stream_stats():
+        with lock:
+            return jsonify({
+                "active": [p.stats() for p in active],
+                **totals,
+            })
+
+    return bp
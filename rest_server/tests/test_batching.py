@@ -0,0 +1,134 @@
+"""batching.py のバッチの上限と /metrics
+
+    cd rest_server && python -m pytest -q tests
+"""
+import gc
+import os
+import sys
+import threading
+import weakref
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batching  # noqa: E402
+from batching import BatchScheduler  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+
+
+class _Input:
+    name = "images"
+    shape = ["batch", 3, 4, 4]
+
+
+class FakeSession:
+    """入力をそのまま返し、sess.run ごとのバッチの枚数を記録する"""
+
+    def __init__(self):
+        self.sizes = []
+
+    def get_inputs(self):
+        return [_Input()]
+
+    def run(self, output_names, feeds):
+        blob = feeds["images"]
+        self.sizes.append(blob.shape[0])
+        return [blob * 2]
+
+
+def blob(n, start):
+    return np.arange(start, start + n * 48, dtype=np.float32).reshape(n, 3, 4, 4)
+
+
+def test_batches_never_exceed_max_batch_size():
+    sess = FakeSession()
+    scheduler = BatchScheduler(sess, "images", max_batch_size=4, max_wait_ms=50)
+    blobs = [blob(n, i * 1000) for i, n in enumerate((3, 3, 2, 1, 10, 4))]
+    results = [None] * len(blobs)
+
+    def send(i):
+        results[i] = scheduler.run(blobs[i])
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(len(blobs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+
+    assert sess.sizes and max(sess.sizes) <= 4
+    assert sum(sess.sizes) == sum(b.shape[0] for b in blobs)
+    # 分けたり次のバッチへ回したりしても、各リクエストには自分の出力が順に返る
+    for b, outputs in zip(blobs, results):
+        np.testing.assert_array_equal(outputs[0], b * 2)
+
+
+def test_queue_depth_and_batch_size_on_metrics():
+    sess = FakeSession()
+    scheduler = BatchScheduler(sess, "images", max_batch_size=4, max_wait_ms=1)
+    scheduler.run(blob(2, 0))
+
+    text = REGISTRY.render()
+    assert "# TYPE predict_batch_queue_depth gauge" in text
+    assert "predict_batch_queue_depth 0" in text
+    assert "# TYPE predict_batch_size histogram" in text
+    assert 'predict_batch_size_bucket{le="2"}' in text
+
+
+def test_queue_depth_sums_every_scheduler():
+    class Blocked(FakeSession):
+        """run() が release されるまで返らない"""
+
+        def __init__(self):
+            super().__init__()
+            self.started = threading.Event()
+            self.release = threading.Event()
+
+        def run(self, output_names, feeds):
+            self.started.set()
+            self.release.wait(10)
+            return super().run(output_names, feeds)
+
+    sess = Blocked()
+    first = BatchScheduler(sess, "images", max_batch_size=1, max_wait_ms=1)
+    BatchScheduler(FakeSession(), "images")       # 後から作ったスケジューラ
+
+    threads = [threading.Thread(target=first.run, args=(blob(1, i),)) for i in range(3)]
+    threads[0].start()
+    assert sess.started.wait(10)
+    for t in threads[1:]:
+        t.start()
+    while first.queue_depth() < 2:
+        threading.Event().wait(0.01)
+    try:
+        assert "predict_batch_queue_depth 2" in REGISTRY.render().splitlines()
+    finally:
+        sess.release.set()
+        for t in threads:
+            t.join(10)
+
+
+def test_discarded_scheduler_stops_and_is_not_restarted_after_fork(monkeypatch):
+    monkeypatch.setattr(batching, "IDLE_CHECK", 0.05)
+    discarded = BatchScheduler(FakeSession(), "images")
+    thread, ref = discarded._thread, weakref.ref(discarded)
+    del discarded
+    gc.collect()
+    assert ref() is None
+    thread.join(5)
+    assert not thread.is_alive()
+
+    live = BatchScheduler(FakeSession(), "images", max_batch_size=4, max_wait_ms=1)
+    pid = os.fork()
+    if pid == 0:
+        # 子では生きているスケジューラの分だけスレッドを作り直し、推論できる
+        try:
+            names = [t.name for t in threading.enumerate()]
+            ok = names.count("batch-scheduler") == len(batching._schedulers)
+            b = blob(2, 0)
+            ok = ok and np.array_equal(live.run(b)[0], b * 2)
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
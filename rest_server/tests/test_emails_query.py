@@ -0,0 +1,36 @@
+"""emails_query.py の一括更新の入力チェック
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from emails_query import bulk_delete_ids, bulk_update_rows  # noqa: E402
+
+
+def test_bulk_update_rows_keeps_omitted_columns_null():
+    rows = bulk_update_rows([{"id": 1, "name": "a"}, {"id": 2, "email": "b@example.com"}])
+    assert rows == [(1, "a", None), (2, None, "b@example.com")]
+
+
+@pytest.mark.parametrize("items", [
+    [{"id": True, "name": "a"}],
+    [{"id": "1", "name": "a"}],
+    [{"name": "a"}],
+    [1],
+    [{"id": 1, "name": 3}],
+    [{"id": 1, "email": ["a@example.com"]}],
+])
+def test_bulk_update_rows_rejects_bad_rows(items):
+    with pytest.raises(ValueError, match="row 0"):
+        bulk_update_rows(items)
+
+
+def test_bulk_delete_ids_rejects_bool():
+    assert bulk_delete_ids([1, {"id": 2}]) == [1, 2]
+    with pytest.raises(ValueError):
+        bulk_delete_ids([False])
@@ -0,0 +1,59 @@
+"""listener.py のイベント ID (ChangeLog)
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from listener import ChangeLog  # noqa: E402
+
+
+def in_child(fn):
+    """fork した子で fn() を呼び、返した文字列を受け取る"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            out = fn()
+            code = 0
+        except BaseException as e:
+            out, code = repr(e), 1
+        os.write(w, out.encode())
+        os._exit(code)
+    os.close(w)
+    with os.fdopen(r) as f:
+        out = f.read()
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0, out
+    return out
+
+
+def test_forked_logs_reject_each_others_ids():
+    # gunicorn --preload と同じく、マスターで作ったログをワーカーが引き継ぐ
+    changes = ChangeLog(16)
+
+    def issue():
+        with changes.lock:
+            changes.append([("insert", 1, {"id": 1})] * 3)
+        return changes.event_id(changes.seq)
+
+    a_id = in_child(issue)
+
+    def check():
+        own = issue()
+        assert changes.parse_event_id(own) == 3
+        # 別のワーカーの ID は seq が範囲内でも受け付けない (全件を送り直す)
+        assert changes.parse_event_id(a_id) is None
+        return own
+
+    b_id = in_child(check)
+    assert a_id.rsplit(".", 1)[0] != b_id.rsplit(".", 1)[0]
+    assert changes.parse_event_id(a_id) is None
+    assert changes.parse_event_id(b_id) is None
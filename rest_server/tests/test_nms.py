@@ -0,0 +1,103 @@
+"""nms.py の hard NMS が cv2.dnn.NMSBoxes と同じ結果になること
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nms  # noqa: E402
+from nms import suppress  # noqa: E402
+
+
+def nms_boxes(boxes, scores, score_thres, iou_thres, class_ids=None, class_thres=None):
+    """NMSBoxes をそのまま呼ぶ参照 (class_thres があればクラスごとに 1 回)"""
+    if not class_thres:
+        indices = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), score_thres, iou_thres)
+        return np.asarray(indices, np.int64).reshape(-1)
+    kept = []
+    for cls in np.unique(class_ids):
+        idx = np.flatnonzero(class_ids == cls)
+        score, iou = class_thres.get(int(cls), (score_thres, iou_thres))
+        indices = cv2.dnn.NMSBoxes(boxes[idx].tolist(), scores[idx].tolist(), score, iou)
+        kept.append(idx[np.asarray(indices, np.int64).reshape(-1)])
+    kept = np.concatenate(kept) if kept else np.empty(0, np.int64)
+    # suppress はスコアの高い順 (同点は番号順) で返す
+    return kept[np.lexsort((kept, -scores[kept]))]
+
+
+def random_boxes(rng, n, extent):
+    """まばらな検出。面積 0 / 負の幅の検出と、極端に大きい検出も混ぜる"""
+    x = rng.integers(-10, extent, n)
+    y = rng.integers(-10, extent, n)
+    w = rng.integers(-3, 40, n)
+    h = rng.integers(0, 40, n)
+    big = rng.random(n) < 0.03
+    w[big] *= 8
+    return np.stack([x, y, w, h], axis=1)
+
+
+def dense_boxes(rng, n):
+    """同じ場所に固まった検出 (束の写真のように組が多い)"""
+    centers = rng.integers(0, 120, (max(1, n // 12), 2))
+    c = centers[rng.integers(0, len(centers), n)] + rng.integers(-4, 5, (n, 2))
+    size = rng.integers(18, 30, (n, 2))
+    return np.concatenate([c - size // 2, size], axis=1)
+
+
+def scores_for(rng, n):
+    # 同点も出るよう丸める
+    return np.round(rng.random(n), int(rng.integers(1, 4))).astype(np.float32)
+
+
+@pytest.fixture(params=["grid", "dense-fallback"])
+def pair_limit(request, monkeypatch):
+    if request.param == "dense-fallback":
+        # 組を作らずに順に比べる経路
+        monkeypatch.setattr(nms, "PAIR_LIMIT", 0)
+    return request.param
+
+
+@pytest.mark.parametrize("kind", ["random", "dense"])
+def test_hard_matches_nms_boxes(kind, pair_limit):
+    rng = np.random.default_rng(0)
+    for _ in range(150):
+        n = int(rng.integers(0, 250))
+        boxes = random_boxes(rng, n, int(rng.integers(20, 400))) if kind == "random" \
+            else dense_boxes(rng, n)
+        scores = scores_for(rng, n)
+        class_ids = rng.integers(0, 2, n)
+        score_thres = float(rng.choice([0.0, 1e-4, 0.3]))
+        iou_thres = float(rng.choice([0.0, 0.3, 0.5, 0.99, 1.0]))
+
+        keep, out_scores = suppress(boxes, scores, class_ids, score_thres, iou_thres,
+                                    method="hard")
+        np.testing.assert_array_equal(
+            keep, nms_boxes(boxes, scores, score_thres, iou_thres)
+        )
+        assert out_scores is scores
+
+
+@pytest.mark.parametrize("kind", ["random", "dense"])
+def test_hard_per_class_thresholds_match_nms_boxes(kind, pair_limit):
+    rng = np.random.default_rng(1)
+    for _ in range(150):
+        n = int(rng.integers(0, 250))
+        boxes = random_boxes(rng, n, int(rng.integers(20, 400))) if kind == "random" \
+            else dense_boxes(rng, n)
+        scores = scores_for(rng, n)
+        class_ids = rng.integers(0, 3, n)
+        # クラス 2 はしきい値を書かない (プリセットの値)
+        class_thres = {0: (0.2, 0.4), 1: (0.5, 0.7)}
+
+        keep, _ = suppress(boxes, scores, class_ids, 0.3, 0.5, class_thres=class_thres,
+                           method="hard")
+        np.testing.assert_array_equal(
+            keep, nms_boxes(boxes, scores, 0.3, 0.5, class_ids, class_thres)
+        )
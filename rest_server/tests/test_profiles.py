@@ -0,0 +1,98 @@
+"""profiles.py のコマンドライン
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip("onnx")
+from onnx import TensorProto, helper, numpy_helper  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import onnxruntime  # noqa: E402
+import profiles  # noqa: E402
+
+
+def write_model(path):
+    """1x3x8x8 → Conv → Relu の小さなモデル (レベル all なら Conv と Relu が融合される)"""
+    weight = numpy_helper.from_array(np.ones((4, 3, 3, 3), np.float32), "w")
+    graph = helper.make_graph(
+        [
+            helper.make_node("Conv", ["images", "w"], ["conv"], pads=[1, 1, 1, 1]),
+            helper.make_node("Relu", ["conv"], ["output0"]),
+        ],
+        "tiny",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, [1, 3, 8, 8])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, [1, 4, 8, 8])],
+        initializer=[weight],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(path))
+
+
+def test_optimize_alone_writes_served_profile(tmp_path, monkeypatch, capsys):
+    model = tmp_path / "best.onnx"
+    write_model(model)
+    monkeypatch.setattr(profiles, "MODEL_PROFILE", "fp32")
+
+    # best.fp16.onnx / best.int8.onnx が無くても fp32 の最適化済みグラフだけ書き出す
+    profiles.main(["--model", str(model), "--optimize"])
+
+    expected = profiles.optimized_path(
+        str(model), profiles.ORT_OPT_LEVEL, profiles.available_providers()[0]
+    )
+    assert os.path.exists(expected)
+    assert capsys.readouterr().out.strip() == f"fp32: {expected}"
+    assert sorted(os.listdir(tmp_path)) == sorted(["best.onnx", os.path.basename(expected)])
+
+    # 書き出したグラフは (最適化なしで) そのまま読み込める
+    sess, path = profiles.create_session(str(model), profile="fp32")
+    assert path == expected
+    out = sess.run(None, {"images": np.ones((1, 3, 8, 8), np.float32)})[0]
+    assert out.shape == (1, 4, 8, 8)
+
+
+def test_create_session_leaves_caller_options_untouched(tmp_path):
+    model = tmp_path / "best.onnx"
+    write_model(model)
+    so = onnxruntime.SessionOptions()
+    so.intra_op_num_threads = 2
+    so.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+
+    profiles.create_session(str(model), profile="fp32", opt_level="all",
+                            save_optimized=True, sess_options=so)
+    # 最適化済みグラフを読むとき (レベル disable) も同じ
+    profiles.create_session(str(model), profile="fp32", opt_level="all", sess_options=so)
+
+    assert so.graph_optimization_level == onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    assert so.optimized_model_filepath == ""
+    assert so.intra_op_num_threads == 2
+
+
+def test_optimized_graph_is_named_after_the_provider_actually_used(tmp_path, monkeypatch):
+    model = tmp_path / "best.onnx"
+    write_model(model)
+    # CUDA を頼んだが、セッションは CPU に落ちる
+    monkeypatch.setattr(
+        profiles, "available_providers",
+        lambda providers=None: ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    )
+
+    with pytest.warns(UserWarning):
+        sess, _ = profiles.create_session(str(model), profile="fp32", save_optimized=True)
+    assert sess.get_providers()[0] == "CPUExecutionProvider"
+
+    cpu = profiles.optimized_path(str(model), profiles.ORT_OPT_LEVEL, "CPUExecutionProvider")
+    assert sorted(os.listdir(tmp_path)) == sorted(["best.onnx", os.path.basename(cpu)])
+
+    # CUDA の名前で残っていた (CPU 向けの) グラフは使わずに元のモデルから作る
+    cuda = profiles.optimized_path(str(model), profiles.ORT_OPT_LEVEL, "CUDAExecutionProvider")
+    os.rename(cpu, cuda)
+    with pytest.warns(UserWarning):
+        _, loaded = profiles.create_session(str(model), profile="fp32")
+    assert loaded == str(model)
@@ -0,0 +1,38 @@
+"""rois.py の多角形 ROI
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rois import centers_inside, parse_rois, polygon_mask  # noqa: E402
+
+
+def test_centers_just_outside_a_rectangle_roi_are_outside():
+    (roi,) = parse_rois('[{"id": "A", "polygon": [[100, 50], [200, 50], [200, 150], [100, 150]]}]')
+    origin = roi.box[:2]
+    size = (roi.box[2] - roi.box[0], roi.box[3] - roi.box[1])
+    mask = polygon_mask(roi.polygon, origin, size)
+
+    boxes = [
+        [140, 90, 20, 20],      # 中央
+        [100, 50, 2, 2],        # 左上の角の内側
+        [90, 90, 10, 10],       # 左に 5 px はみ出した中心 (95, 95)
+        [195, 90, 20, 20],      # 右の外 (205, 100)
+        [140, 150, 10, 10],     # 下の外 (145, 155)
+        [140, 30, 10, 10],      # 上の外 (145, 35)
+    ]
+    np.testing.assert_array_equal(
+        centers_inside(mask, boxes, origin), [True, True, False, False, False, False]
+    )
+
+
+def test_centers_inside_polygon_only():
+    (roi,) = parse_rois('[{"polygon": [[0, 0], [100, 0], [0, 100]]}]')
+    mask = polygon_mask(roi.polygon, roi.box[:2], (100, 100))
+    boxes = [[10, 10, 10, 10], [70, 70, 10, 10]]
+    np.testing.assert_array_equal(centers_inside(mask, boxes), [True, False])
@@ -0,0 +1,43 @@
+"""stream.py の /metrics の接続数
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import REGISTRY  # noqa: E402
+from stream import stream_blueprint  # noqa: E402
+
+
+def make_app():
+    app = flask.Flask(__name__)
+    app.register_blueprint(stream_blueprint(lambda blob: None, 64, ["pipe"]))
+    return app
+
+
+def clients_gauge():
+    for line in REGISTRY.render().splitlines():
+        if line.startswith("predict_stream_clients "):
+            return int(line.split()[1])
+    return None
+
+
+def test_clients_gauge_counts_every_app():
+    # シム (app.py) を読み込むと server.app とシムのアプリの両方が作られる
+    first, second = make_app(), make_app()
+
+    response = first.test_client().post("/predict/stream", data=b"", buffered=False)
+    chunks = response.response
+    assert next(iter(chunks)).startswith(b"event: start")
+    # 後から作ったアプリではなく、接続のあるアプリのクライアントも数える
+    assert clients_gauge() == 1
+
+    response.close()
+    assert clients_gauge() == 0
+    assert second.test_client().get("/predict/stream/stats").get_json()["active"] == []
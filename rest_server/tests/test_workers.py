@@ -0,0 +1,124 @@
+"""workers.py のプロセスプール: ワーカーが落ちたとき
+
+    cd rest_server && python -m pytest -q tests
+"""
+import os
+import signal
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip("onnx")
+from onnx import TensorProto, helper, numpy_helper  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import Detections  # noqa: E402
+from workers import WorkerBusy, WorkerPool  # noqa: E402
+
+INPUT_SIZE = 32
+
+
+def write_yolo(path):
+    """(B, 3, 32, 32) → (B, 6, 16) の YOLO 形式の出力を返す小さなモデル (クラス 2 つ)"""
+    weight = numpy_helper.from_array(np.ones((6, 3, 1, 1), np.float32), "w")
+    shape = numpy_helper.from_array(np.array([0, 6, 16], np.int64), "shape")
+    graph = helper.make_graph(
+        [
+            helper.make_node("AveragePool", ["images"], ["pool"], kernel_shape=[8, 8],
+                             strides=[8, 8]),
+            helper.make_node("Conv", ["pool", "w"], ["conv"]),
+            helper.make_node("Reshape", ["conv", "shape"], ["output0"]),
+        ],
+        "tiny-yolo",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT,
+                                       ["batch", 3, INPUT_SIZE, INPUT_SIZE])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, ["batch", 6, 16])],
+        initializer=[weight, shape],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(path))
+
+
+def wait_for(condition, limit=30.0):
+    deadline = time.monotonic() + limit
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def pool(tmp_path):
+    model = tmp_path / "best.onnx"
+    write_yolo(model)
+    pool = WorkerPool(str(model), workers=1, input_size=INPUT_SIZE, slot_mb=1, timeout=30)
+    wait_for(lambda: pool.stats()["ready"] == 1)
+    yield pool
+    for w in pool._workers:
+        if w.proc.is_alive():
+            os.kill(w.proc.pid, signal.SIGCONT)
+    pool.close()
+
+
+@pytest.fixture
+def jpeg():
+    return cv2.imencode(".jpg", np.full((40, 40, 3), 128, np.uint8))[1].tobytes()
+
+
+def detect_in_thread(pool, data):
+    out = {}
+
+    def run():
+        started = time.monotonic()
+        try:
+            out["result"] = pool.detect(data)
+        except Exception as e:
+            out["error"] = e
+        out["seconds"] = time.monotonic() - started
+
+    t = threading.Thread(target=run)
+    t.start()
+    return t, out
+
+
+def test_killed_worker_fails_its_task_and_is_respawned(pool, jpeg):
+    assert isinstance(pool.detect(jpeg), Detections)
+    pid = pool._workers[0].proc.pid
+
+    # タスクを渡したワーカーを止め、結果を返す前に落とす
+    os.kill(pid, signal.SIGSTOP)
+    t, out = detect_in_thread(pool, jpeg)
+    wait_for(lambda: pool.stats()["in_flight"] == 1)
+    os.kill(pid, signal.SIGKILL)
+    t.join(10)
+
+    # INFER_TIMEOUT (30 秒) を待たずに失敗し、スロットは戻る
+    assert isinstance(out.get("error"), WorkerBusy)
+    assert out["seconds"] < 10
+    stats = pool.stats()
+    assert stats["free_slots"] == stats["slots"]
+    assert stats["in_flight"] == 0
+    assert stats["restarts"] == 1
+
+    # 作り直したワーカーで続けて推論できる
+    wait_for(lambda: pool.stats()["ready"] == 1)
+    assert pool._workers[0].proc.pid != pid
+    assert isinstance(pool.detect(jpeg), Detections)
+
+
+def test_slot_of_a_timed_out_task_returns_when_the_worker_dies(pool, jpeg):
+    pool.timeout = 0.3
+    pid = pool._workers[0].proc.pid
+    os.kill(pid, signal.SIGSTOP)
+    with pytest.raises(WorkerBusy, match="timed out"):
+        pool.detect(jpeg)
+    assert pool.stats()["free_slots"] == pool.slots - 1
+
+    os.kill(pid, signal.SIGKILL)
+    wait_for(lambda: pool.stats()["free_slots"] == pool.slots, limit=10)
+    assert pool.stats()["in_flight"] == 0
@@ -0,0 +1,138 @@
+import math
+import os
+
+import cv2
+import numpy as np
+
+from postprocess import decode_yolo
+from preprocess import normalize_into
+
+# =====================
+# タイル分割推論 (大きな画像用)
+# =====================
+# 6000×4000 などの写真を丸ごと 1280 に縮めると小さなパイプ端が数画素になって
+# 見落とすので、元解像度のまま重なりのあるタイルに分けて推論する。
+#
+#   1. 画像 (または ROI) を TILE_SIZE 角・TILE_OVERLAP 画素重ねたタイルに分割
+#   2. タイルをまとめて 1 つの blob (最大 scheduler.max_batch_size 枚ずつ) で推論
+#   3. 各タイルの検出をタイル左上を足して画像座標へ戻す
+#   4. 呼び出し側の NMS (nms.py) で全タイル分をまとめて重複除去
+#
+# タイル境界で切れた検出は、隣のタイルに丸ごと写っているはずなので捨てる
+# (TILE_OVERLAP は対象物の最大サイズより大きくしておくこと)。
+
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1280"))          # 元画像上のタイル一辺 (画素)
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "256"))     # 隣り合うタイルの重なり (画素)
+TILE_EDGE_MARGIN = 2                                          # この画素以内で境界に接する検出は「切れている」とみなす
+
+PAD_COLOR = 114
+
+
+def tile_starts(length, tile, overlap):
+    """1 軸方向のタイル開始位置。最後のタイルは画像の端に揃える"""
+    if length <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    n = math.ceil((length - tile) / step) + 1
+    starts = [min(i * step, length - tile) for i in range(n)]
+    return sorted(set(starts))
+
+
+def tile_grid(w, h, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """[(x0, y0, x1, y1), ...] (行優先)。画像がタイルより小さい辺はそのまま 1 枚"""
+    return [
+        (x0, y0, min(x0 + tile, w), min(y0 + tile, h))
+        for y0 in tile_starts(h, tile, overlap)
+        for x0 in tile_starts(w, tile, overlap)
+    ]
+
+
+def tiles_to_blob(img, tiles, tile, input_size, dtype=np.float32):
+    """タイル群を (n, 3, input_size, input_size) の blob にする
+
+    端で tile 角に満たないタイルは右下を PAD_COLOR で埋め、
+    tile != input_size のときは tile 角ごと input_size に縮小する。
+    """
+    blob = np.empty((len(tiles), 3, input_size, input_size), dtype)
+    canvas = np.empty((tile, tile, 3), np.uint8)
+
+    for i, (x0, y0, x1, y1) in enumerate(tiles):
+        crop = img[y0:y1, x0:x1]
+        if crop.shape[0] == tile and crop.shape[1] == tile:
+            src = crop
+        else:
+            canvas[:] = PAD_COLOR
+            canvas[:y1 - y0, :x1 - x0] = crop
+            src = canvas
+        if tile != input_size:
+            src = cv2.resize(src, (input_size, input_size), interpolation=cv2.INTER_LINEAR)
+
+        normalize_into(src, blob[i])
+
+    return blob
+
+
+def _tile_boxes(preds, tile_box, img_w, img_h, scale, conf_thres):
+    """1 タイル分の (C, N) 出力 → 画像座標の [x1, y1, x2, y2] (float)"""
+    xc, yc, bw, bh, scores, class_ids = decode_yolo(preds, conf_thres=conf_thres)
+    x0, y0, x1, y1 = tile_box
+
+    bx1 = np.maximum((xc - bw / 2) * scale, 0) + x0
+    by1 = np.maximum((yc - bh / 2) * scale, 0) + y0
+    bx2 = np.minimum((xc + bw / 2) * scale + x0, x1)
+    by2 = np.minimum((yc + bh / 2) * scale + y0, y1)
+
+    # 画像の外周ではない (= 隣にタイルがある) 境界に接している検出は切れている
+    m = TILE_EDGE_MARGIN
+    cut = (
+        ((x0 > 0) & (bx1 <= x0 + m))
+        | ((x1 < img_w) & (bx2 >= x1 - m))
+        | ((y0 > 0) & (by1 <= y0 + m))
+        | ((y1 < img_h) & (by2 >= y1 - m))
+    )
+    keep = ~cut & (bx2 > bx1) & (by2 > by1)
+
+    return (
+        np.stack([bx1, by1, bx2, by2], axis=1)[keep],
+        scores[keep],
+        class_ids[keep],
+    )
+
+
+def tiled_detect(img, run, input_size, conf_thres=0.3, tile=TILE_SIZE,
+                 overlap=TILE_OVERLAP, max_batch_size=8, offset=(0, 0),
+                 dtype=np.float32):
+    """画像をタイル分割して推論し、NMS 前の検出を画像座標で返す
+
+    run は scheduler.run (blob → outputs)。offset は ROI 左上など、
+    返す座標に足す値。dtype はモデル入力の型 (preprocess.input_dtype)。
+
+    戻り値: boxes (M, 4) int [x, y, w, h], scores (M,), class_ids (M,), タイル数
+    """
+    img_h, img_w = img.shape[:2]
+    tiles = tile_grid(img_w, img_h, tile, overlap)
+    scale = tile / input_size
+
+    all_boxes, all_scores, all_ids = [], [], []
+    for start in range(0, len(tiles), max_batch_size):
+        chunk = tiles[start:start + max_batch_size]
+        outputs = run(tiles_to_blob(img, chunk, tile, input_size, dtype))
+        for preds, tile_box in zip(outputs[0], chunk):
+            boxes, scores, class_ids = _tile_boxes(
+                preds, tile_box, img_w, img_h, scale, conf_thres
+            )
+            all_boxes.append(boxes)
+            all_scores.append(scores)
+            all_ids.append(class_ids)
+
+    xyxy = np.concatenate(all_boxes)
+    x = xyxy[:, 0].astype(np.int64)
+    y = xyxy[:, 1].astype(np.int64)
+    boxes = np.stack([
+        x + offset[0],
+        y + offset[1],
+        xyxy[:, 2].astype(np.int64) - x,
+        xyxy[:, 3].astype(np.int64) - y,
+    ], axis=1)
+
+    return boxes, np.concatenate(all_scores), np.concatenate(all_ids), len(tiles)
@@ -0,0 +1,554 @@
+import atexit
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+from multiprocessing import connection as mp_connection
+from multiprocessing import shared_memory
+
+import numpy as np
+import onnxruntime as ort
+
+from cache import Detections
+from decode import clip_roi, decode_upload, reduce_roi
+from metrics import stage
+from nms import NMS_METHOD, suppress
+from postprocess import decode_yolo, letterbox_to_xywh, stretch_to_xywh
+from preprocess import InputBuffers, input_dtype
+from profiles import create_session
+from rois import centers_inside, decode_size, polygon_mask, resolve_thresholds
+from startup import Startup
+from tiling import tiled_detect
+
+# =====================
+# プロセスプール推論
+# =====================
+# Flask のスレッドは 1 つの InferenceSession を共有し、デコード・前処理・後処理・NMS は
+# GIL の下で動くので、コア数が多くても数コアで頭打ちになる。
+# INFER_WORKERS=N にすると、N 個のワーカープロセスがそれぞれセッションを持ち、
+# デコードから NMS までを丸ごと受け持つ。フロント (Flask) は画像の bytes を
+# 共有メモリのスロットに書き込んでスロット番号だけを送り、NMS 後の検出
+# (cache.Detections) を受け取る。
+#
+# ワーカーは fork で作るので、セッションやスレッドを作る前 (モジュール読み込み時) に起動する。
+
+INFER_WORKERS = int(os.environ.get("INFER_WORKERS", "0"))                  # 0 ならスレッド内で推論
+INFER_INTRA_THREADS = int(os.environ.get("INFER_INTRA_THREADS", "0"))      # 0 なら コア数 / ワーカー数
+INFER_INTER_THREADS = int(os.environ.get("INFER_INTER_THREADS", "1"))
+INFER_SLOT_MB = float(os.environ.get("INFER_SLOT_MB", "32"))               # 共有メモリ 1 スロットの大きさ
+INFER_TIMEOUT = float(os.environ.get("INFER_TIMEOUT", "60"))               # 秒
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerBusy(WorkerError):
+    """スロットが空かない・ワーカーが時間内に返さない (503 にする)"""
+
+
+def session_options(intra_threads, inter_threads):
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = intra_threads
+    so.inter_op_num_threads = inter_threads
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return so
+
+
+# =====================
+# ワーカー側: デコード → 推論 → NMS
+# =====================
+def detect_upload(data, run, buffers, input_size, fit="stretch", roi=None,
+                  tiled=False, reduce=False, conf_thres=0.3, score_thres=0.3,
+                  nms_thres=0.5, frame="image", max_batch_size=8, rois=None,
+                  class_thres=(), nms_method=NMS_METHOD):
+    """アップロードされた bytes から NMS 後の検出を返す (デコードして detect_image)
+
+    rois (rois.Roi の list) を渡すと detect_rois で ROI ごとの検出のタプルを返す。
+    """
+    if rois is not None:
+        roi_size = decode_size(rois)
+    else:
+        roi_size = (roi[2] - roi[0], roi[3] - roi[1]) if roi is not None else None
+    with stage("decode"):
+        img, factor, orig_size = decode_upload(
+            data, roi_size=roi_size, input_size=input_size,
+            letterbox=fit == "letterbox", reduce=reduce
+        )
+    if img is None:
+        raise WorkerError("invalid image")
+    if rois is not None:
+        return detect_rois(
+            img, factor, orig_size, rois, run, buffers, input_size, fit=fit, tiled=tiled,
+            conf_thres=conf_thres, score_thres=score_thres, nms_thres=nms_thres,
+            class_thres=class_thres, max_batch_size=max_batch_size, nms_method=nms_method
+        )
+    return detect_image(
+        img, factor, orig_size, run, buffers, input_size, fit=fit, roi=roi, tiled=tiled,
+        conf_thres=conf_thres, score_thres=score_thres, nms_thres=nms_thres,
+        frame=frame, max_batch_size=max_batch_size, class_thres=class_thres,
+        nms_method=nms_method
+    )
+
+
+def _conf_thres(conf_thres, class_thres):
+    """クラスごとの score がデコード時の足切りより低ければ足切りも下げる"""
+    return min([conf_thres] + [score for _, score, _ in class_thres if score is not None])
+
+
+def _to_xywh(preds, fit, letterbox_params, roi_size, offset, orig_size, input_size,
+             conf_thres, whole=False):
+    """1 枚分の (C, N) 出力 → boxes [x, y, w, h], scores, class_ids (detect_image と同じ座標)"""
+    decoded = decode_yolo(preds, conf_thres=conf_thres)
+    roi_w, roi_h = roi_size
+    if fit == "letterbox":
+        ratio, (dw, dh) = letterbox_params
+        boxes, scores, class_ids = letterbox_to_xywh(decoded, ratio, dw, dh, roi_w, roi_h)
+        boxes[:, 0] += offset[0]
+        boxes[:, 1] += offset[1]
+        return boxes, scores, class_ids
+    if whole:
+        orig_w, orig_h = orig_size
+        return stretch_to_xywh(
+            decoded, orig_w / input_size, orig_h / input_size, clip_size=(orig_w, orig_h)
+        )
+    return stretch_to_xywh(decoded, roi_w / input_size, roi_h / input_size, offset=offset)
+
+
+def detect_image(img, factor, orig_size, run, buffers, input_size, fit="stretch", roi=None,
+                 tiled=False, conf_thres=0.3, score_thres=0.3, nms_thres=0.5,
+                 frame="image", max_batch_size=8, class_thres=(), nms_method=NMS_METHOD):
+    """decode_upload で展開した画像から NMS 後の検出を返す (server.py の /predict と同じ座標)
+
+    fit   : "letterbox" (プリセット app) / "stretch" (app2 / app3)
+    frame : "roi" なら ROI 左上基準、"image" なら展開した画像全体の座標
+    roi=None は画像全体 (app2)。stretch の場合の boxes は元画像の座標。
+    class_thres はクラスごとのしきい値 (rois.parse_class_thresholds)。
+    nms_method は nms.METHODS のどれか。
+    """
+    conf_thres = _conf_thres(conf_thres, class_thres)
+
+    if roi is None:
+        rx1 = ry1 = 0
+        roi_img = img
+    else:
+        roi = clip_roi(roi, orig_size)
+        if roi is None:
+            raise WorkerError("empty roi")
+        rx1, ry1, rx2, ry2 = reduce_roi(roi, factor)
+        roi_img = img[ry1:ry2, rx1:rx2]
+
+    offset = (rx1, ry1) if frame == "image" else (0, 0)
+    roi_h, roi_w = roi_img.shape[:2]
+
+    if tiled:
+        with stage("tiled"):
+            boxes, scores, class_ids, n_tiles = tiled_detect(
+                roi_img, run, input_size, conf_thres=conf_thres,
+                max_batch_size=max_batch_size, dtype=buffers.blob.dtype, offset=offset
+            )
+    else:
+        n_tiles = 1
+        letterbox_params = None
+        with stage("preprocess"):
+            if fit == "letterbox":
+                blob, ratio, pad = buffers.letterbox(roi_img)
+                letterbox_params = (ratio, pad)
+            else:
+                blob = buffers.stretch(roi_img)
+        with stage("infer"):
+            preds = run(blob)[0][0]  # (C, N)
+        with stage("decode_boxes"):
+            boxes, scores, class_ids = _to_xywh(
+                preds, fit, letterbox_params, (roi_w, roi_h), offset, orig_size,
+                input_size, conf_thres, whole=roi is None
+            )
+
+    with stage("nms"):
+        indices, scores = suppress(
+            boxes, scores, class_ids, score_thres, nms_thres,
+            resolve_thresholds(class_thres, score_thres, nms_thres), method=nms_method
+        )
+    return Detections.from_nms(boxes, scores, class_ids, indices, n_tiles, factor, orig_size)
+
+
+def detect_rois(img, factor, orig_size, rois, run, buffers, input_size, fit="stretch",
+                tiled=False, conf_thres=0.3, score_thres=0.3, nms_thres=0.5,
+                class_thres=(), max_batch_size=8, nms_method=NMS_METHOD):
+    """複数の ROI (rois.Roi) の検出を、ROI ごとの Detections のタプルで返す
+
+    画像は展開済みのものを使い回し、切り出しはまとめて 1 つの blob
+    (最大 max_batch_size 枚ずつ) で推論する。座標は展開した画像全体の座標 (frame="image")。
+    多角形の ROI は、中心が多角形の外にある検出を NMS の前に捨てる。
+    NMS は全 ROI 分をまとめて 1 回 (ROI 同士は抑制しない)。
+    """
+    conf_thres = _conf_thres(conf_thres, class_thres)
+
+    crops = []      # (展開した画像上の左上, 切り出し)
+    for roi in rois:
+        box = clip_roi(roi.box, orig_size)
+        if box is None:
+            raise WorkerError(f"empty roi: {roi.id}")
+        rx1, ry1, rx2, ry2 = reduce_roi(box, factor)
+        crops.append(((rx1, ry1), img[ry1:ry2, rx1:rx2]))
+
+    found = []      # ROI ごとの (boxes, scores, class_ids, タイル数)
+    if tiled:
+        with stage("tiled"):
+            for offset, crop in crops:
+                found.append(tiled_detect(
+                    crop, run, input_size, conf_thres=conf_thres,
+                    max_batch_size=max_batch_size, dtype=buffers.blob.dtype, offset=offset
+                ))
+    else:
+        for start in range(0, len(crops), max_batch_size):
+            chunk = crops[start:start + max_batch_size]
+            letterbox_params = []
+            with stage("preprocess"):
+                blob = np.empty(
+                    (len(chunk), 3, input_size, input_size), buffers.blob.dtype
+                )
+                for j, (_, crop) in enumerate(chunk):
+                    if fit == "letterbox":
+                        _, ratio, pad = buffers.letterbox(crop, out=blob[j])
+                        letterbox_params.append((ratio, pad))
+                    else:
+                        buffers.stretch(crop, out=blob[j])
+                        letterbox_params.append(None)
+            with stage("infer"):
+                outputs = run(blob)[0]  # (n, C, N)
+            with stage("decode_boxes"):
+                for (offset, crop), preds, params in zip(chunk, outputs, letterbox_params):
+                    found.append(_to_xywh(
+                        preds, fit, params, crop.shape[1::-1], offset, orig_size,
+                        input_size, conf_thres
+                    ) + (1,))
+
+    kept = []
+    for roi, (offset, crop), (boxes, scores, class_ids, _) in zip(rois, crops, found):
+        if roi.polygon is not None:
+            mask = polygon_mask(roi.polygon, offset, crop.shape[1::-1], factor)
+            inside = centers_inside(mask, boxes, offset)
+            boxes, scores, class_ids = boxes[inside], scores[inside], class_ids[inside]
+        kept.append((boxes, scores, class_ids))
+
+    boxes = np.concatenate([k[0] for k in kept]).reshape(-1, 4)
+    scores = np.concatenate([k[1] for k in kept])
+    class_ids = np.concatenate([k[2] for k in kept])
+    groups = np.repeat(np.arange(len(kept)), [len(k[1]) for k in kept])
+    with stage("nms"):
+        indices, scores = suppress(
+            boxes, scores, class_ids, score_thres, nms_thres,
+            resolve_thresholds(class_thres, score_thres, nms_thres),
+            groups=groups, method=nms_method
+        )
+
+    results = []
+    for g, (_, _, _, n_tiles) in enumerate(found):
+        keep = indices[groups[indices] == g]
+        results.append(Detections.from_nms(
+            boxes, scores, class_ids, keep, n_tiles, factor, orig_size
+        ))
+    return tuple(results)
+
+
+def _worker_main(model_path, input_size, intra_threads, inter_threads,
+                 shm_name, slot_size, tasks, results):
+    sess, _ = create_session(
+        model_path,
+        sess_options=session_options(intra_threads, inter_threads),
+        providers=["CPUExecutionProvider"]
+    )
+    input_name = sess.get_inputs()[0].name
+    buffers = InputBuffers(input_size, dtype=input_dtype(sess))
+    shm = shared_memory.SharedMemory(name=shm_name)
+
+    def run(blob):
+        return sess.run(None, {input_name: blob})
+
+    # ウォームアップが済んでから準備完了を知らせる（/ready）
+    Startup().warm_up(run, input_size, buffers.blob.dtype)
+    results.send(("ready", os.getpid()))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, slot, nbytes, inline, params = task
+
+            view = None
+            try:
+                if inline is not None:
+                    data = inline
+                else:
+                    view = shm.buf[slot * slot_size:slot * slot_size + nbytes]
+                    data = view
+                result = detect_upload(data, run, buffers, input_size, **params)
+            except WorkerError as e:
+                result = e
+            except Exception as e:
+                result = WorkerError(f"{type(e).__name__}: {e}")
+            finally:
+                if view is not None:
+                    view.release()
+            results.send((task_id, result))
+    finally:
+        shm.close()
+        results.close()
+
+
+# =====================
+# フロント側
+# =====================
+# ワーカーごとにタスクのキューと結果のパイプを持ち、どのタスクをどのワーカーに
+# 渡したかを覚えておく。ワーカーが落ちたら (OOM、ORT の segfault など) 結果を
+# 待たずにそのワーカーのタスクを WorkerBusy で失敗させ、スロットを戻し、
+# ワーカーを作り直す。作り直しは動いているフロントからの fork になる。
+class _Pending:
+    __slots__ = ("event", "result", "slot", "abandoned", "worker")
+
+    def __init__(self, slot):
+        self.event = threading.Event()
+        self.result = None
+        self.slot = slot
+        self.abandoned = False
+        self.worker = None
+
+
+class _Worker:
+    __slots__ = ("index", "proc", "tasks", "results", "ready", "in_flight")
+
+    def __init__(self, index, proc, tasks, results):
+        self.index = index
+        self.proc = proc
+        self.tasks = tasks
+        self.results = results
+        self.ready = False
+        self.in_flight = 0
+
+
+class WorkerPool:
+
+    def __init__(self, model_path, workers=INFER_WORKERS, input_size=1280,
+                 intra_threads=INFER_INTRA_THREADS, inter_threads=INFER_INTER_THREADS,
+                 slot_mb=INFER_SLOT_MB, timeout=INFER_TIMEOUT):
+        self.workers = max(1, int(workers))
+        self.intra_threads = intra_threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.inter_threads = inter_threads
+        self.timeout = timeout
+        self.model_path = model_path
+        self.input_size = input_size
+
+        # 同時に送れる枚数 = スロット数 (ワーカー数の 2 倍: 推論中 1 + 待ち 1)
+        self.slot_size = int(slot_mb * 1024 * 1024)
+        self.slots = self.workers * 2
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slot_size * self.slots)
+        self._free = queue.Queue()
+        for i in range(self.slots):
+            self._free.put(i)
+
+        self._ctx = mp.get_context("fork")
+        self._closing = False
+        self._workers = [self._spawn(i) for i in range(self.workers)]
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.ready = 0
+        self.tasks = 0
+        self.inline = 0
+        self.errors = 0
+        self.restarts = 0
+
+        self._collector = threading.Thread(
+            target=self._collect, name="infer-results", daemon=True
+        )
+        self._collector.start()
+        atexit.register(self.close)
+
+    def _spawn(self, index):
+        tasks = self._ctx.Queue()
+        results, send = self._ctx.Pipe(duplex=False)
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(self.model_path, self.input_size, self.intra_threads, self.inter_threads,
+                  self._shm.name, self.slot_size, tasks, send),
+            name=f"infer-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        # 書き込み側は子だけが持つ (子が落ちたら読み込み側が EOF になる)
+        send.close()
+        return _Worker(index, proc, tasks, results)
+
+    # --------------------
+    # 結果の受け取り・ワーカーの監視
+    # --------------------
+    def _collect(self):
+        while not self._closing:
+            with self._lock:
+                workers = list(self._workers)
+            waitables = {}
+            for w in workers:
+                waitables[w.results] = w
+                waitables[w.proc.sentinel] = w
+            for obj in mp_connection.wait(list(waitables), timeout=1.0):
+                w = waitables[obj]
+                if obj is not w.results:
+                    self._lost(w)
+                    continue
+                try:
+                    message = w.results.recv()
+                except (EOFError, OSError):
+                    self._lost(w)
+                    continue
+                self._deliver(w, message)
+
+    def _deliver(self, w, message):
+        task_id, result = message
+        if task_id == "ready":
+            with self._lock:
+                w.ready = True
+                self.ready += 1
+            return
+        with self._lock:
+            pending = self._pending.pop(task_id, None)
+            if pending is not None:
+                pending.worker.in_flight -= 1
+        if pending is None:
+            return
+        if pending.abandoned:
+            # タイムアウトした要求のスロットは、ワーカーが読み終えたここで戻す
+            if pending.slot is not None:
+                self._free.put(pending.slot)
+            return
+        pending.result = result
+        pending.event.set()
+
+    def _lost(self, w):
+        """落ちたワーカーを作り直し、持っていたタスクをすぐに失敗させる"""
+        with self._lock:
+            if self._closing or w not in self._workers:
+                return
+        new = self._spawn(w.index)
+        with self._lock:
+            # ここから先、落ちたワーカーにはタスクを渡さない
+            self._workers[self._workers.index(w)] = new
+            self.restarts += 1
+
+        # 落ちる前に返していた結果は配る
+        try:
+            while w.results.poll():
+                self._deliver(w, w.results.recv())
+        except (EOFError, OSError):
+            pass
+        w.proc.join(timeout=5)
+        error = WorkerBusy(f"inference worker exited (code {w.proc.exitcode})")
+
+        with self._lock:
+            lost = [task_id for task_id, p in self._pending.items() if p.worker is w]
+            lost = [self._pending.pop(task_id) for task_id in lost]
+            if w.ready:
+                self.ready -= 1
+        for pending in lost:
+            if pending.abandoned:
+                if pending.slot is not None:
+                    self._free.put(pending.slot)
+            else:
+                pending.result = error
+                pending.event.set()
+
+        w.results.close()
+        w.tasks.cancel_join_thread()
+        w.tasks.close()
+
+    # --------------------
+    # 要求側
+    # --------------------
+    def detect(self, data, **params):
+        """detect_upload をワーカーで実行する。invalid image / empty roi は WorkerError"""
+        nbytes = len(data)
+        slot = None
+        if nbytes <= self.slot_size:
+            try:
+                slot = self._free.get(timeout=self.timeout)
+            except queue.Empty:
+                raise WorkerBusy("no inference slot available")
+
+        task_id = next(self._ids)
+        pending = _Pending(slot)
+        if slot is not None:
+            start = slot * self.slot_size
+            self._shm.buf[start:start + nbytes] = data
+            inline = None
+        else:
+            # スロットに収まらない画像はそのまま送る
+            inline = bytes(data)
+
+        with self._lock:
+            # 抱えているタスクの少ないワーカーへ。落ちたワーカーの検出と入れ違わないよう、
+            # 登録とキューへの投入はロックの中で行う
+            w = min(self._workers, key=lambda w: w.in_flight)
+            w.in_flight += 1
+            pending.worker = w
+            self._pending[task_id] = pending
+            self.tasks += 1
+            self.inline += inline is not None
+            w.tasks.put((task_id, slot, nbytes, inline, params))
+
+        if not pending.event.wait(self.timeout):
+            with self._lock:
+                timed_out = task_id in self._pending
+                if timed_out:
+                    # ワーカーがまだスロットを読んでいるかもしれないので、返却は結果到着時に任せる
+                    pending.abandoned = True
+            if timed_out:
+                raise WorkerBusy("inference worker timed out")
+            pending.event.wait()
+
+        if slot is not None:
+            self._free.put(slot)
+
+        if isinstance(pending.result, Exception):
+            with self._lock:
+                self.errors += 1
+            raise pending.result
+        return pending.result
+
+    def close(self):
+        if self._shm is None:
+            return
+        with self._lock:
+            self._closing = True
+            workers = list(self._workers)
+        for w in workers:
+            w.tasks.put(None)
+        for w in workers:
+            w.proc.join(timeout=5)
+            if w.proc.is_alive():
+                w.proc.terminate()
+        self._collector.join(timeout=5)
+        for w in workers:
+            w.results.close()
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "ready": self.ready,
+                "alive": sum(w.proc.is_alive() for w in self._workers),
+                "restarts": self.restarts,
+                "intra_op_threads": self.intra_threads,
+                "inter_op_threads": self.inter_threads,
+                "slots": self.slots,
+                "slot_bytes": self.slot_size,
+                "free_slots": self._free.qsize(),
+                "in_flight": len(self._pending),
+                "tasks": self.tasks,
+                "inline": self.inline,
+                "errors": self.errors,
+            }